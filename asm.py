@@ -1,22 +1,179 @@
 from instr import OpCode, getOpcodeGroup, Group, AddrMode, encode_br, encode_other, encode_one_op, encode_two_op
 from ast import literal_eval
+from collections import namedtuple
+import os
+import re
+
+# bumped whenever a change in the assembler can change the code it generates, it invalidates
+# the assembled programs cached by objfile.AsmCache
+ASSEMBLER_VERSION = 3
+
+# the sections of a program, selected by the .code and .data directives; the data section is placed after the code
+CODE = 'code'
+DATA = 'data'
+
+# the maximum nesting of includes and of macro expansions, anything deeper is most likely recursive
+MAX_NESTING = 64
+
+# a data definition without a colon after its label, eg: b10 dw 10
+DATA_LINE = re.compile(r'(\S+) +dw ', re.IGNORECASE)
+
+# lower case mnemonic -> (OpCode, Group)
+MNEMONICS = {opcode.name.lower(): (opcode, getOpcodeGroup(opcode)) for opcode in OpCode}
 
 class ParseError(Exception):
     pass
 
+# a piece of the assembled program, as produced by Assembler.stream: the words of the instruction on
+# the given source line, to be stored at adr; the words of an instruction already produced are produced
+# again, with its labels filled in, as soon as they are all defined
+Chunk = namedtuple('Chunk', ['adr', 'words', 'line'])
+
+# an instruction that uses labels, kept by a relocatable Assembler (see link.py) in order to encode it
+# again once the module is placed in the program
+Relocation = namedtuple('Relocation', ['adr', 'tokens', 'line'])
+
+class Fixup(object):
+    '''An instruction that references labels which were not defined yet
+
+    It is encoded again, in place, once all of them are defined.
+    '''
+    __slots__ = ['adr', 'line', 'tokens', 'missing', 'errors']
+
+    def __init__(self, adr, line, tokens, unresolved):
+        '''Args:
+            adr - the address of the instruction
+            line - the source line of the instruction
+            tokens - the tokenized instruction
+            unresolved - list of (label, the ParseError to be raised if it is never defined)
+        '''
+        self.adr = adr
+        self.line = line
+        self.tokens = tokens
+        self.missing = set(lbl for (lbl, error) in unresolved)
+        self.errors = unresolved
+
+
+class Macro(object):
+    '''A parameterized macro, defined between .macro NAME param, ... and .endm'''
+    __slots__ = ['name', 'params', 'lines']
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.lines = [] # the body, sanitized
+
+    def expand(self, args, expansion):
+        '''Get the body of the macro for the given arguments
+
+        The parameters and the labels defined in the body are replaced as whole words, the labels
+        are suffixed with @expansion, so the same macro can be expanded many times in a program.
+
+        Args:
+            args - the arguments, one for every parameter
+            expansion - a number that is unique to this expansion
+
+        Raises:
+            ParseError - if the number of arguments is not the number of parameters
+        '''
+        if len(args) != len(self.params):
+            raise ParseError('Macro {} requires {} arguments, given {}'.format(self.name, len(self.params), len(args)))
+
+        names = dict(zip(self.params, args))
+        for line in self.lines:
+            markIndex = line.find(':')
+            if markIndex != -1:
+                names[line[:markIndex]] = '{}@{}'.format(line[:markIndex], expansion)
+        if not names:
+            return self.lines
+
+        pattern = re.compile(r'\b(' + '|'.join(re.escape(name) for name in names) + r')\b')
+
+        return [pattern.sub(lambda match: names[match.group(0)], line) for line in self.lines]
+
+
+def includePath(path, directory):
+    '''Get the path of a file given to .include, relative to the directory of the file including it
+
+    Raises:
+        ParseError - if no file is given
+    '''
+    if len(path) >= 2 and path[0] == path[-1] and path[0] in '"\'':
+        path = path[1:-1]
+    if not path:
+        raise ParseError('.include requires a file')
+
+    return os.path.join(directory, path)
+
+
+def readSource(path, depth=0):
+    '''Read a source file and, recursively, the files it includes
+
+    Returns:
+        The bytes of all the files, in the order in which they are included, eg: to hash them
+
+    Raises:
+        OSError - if a file cannot be read
+    '''
+    with open(path, 'rb') as f:
+        source = f.read()
+
+    parts = [source]
+    if depth < MAX_NESTING:
+        sanitize = Assembler()._sanitize
+        for line in source.decode('utf-8', 'replace').splitlines():
+            (name, args) = (sanitize(line).split(' ', 1) + [''])[:2]
+            if name.lower() == '.include':
+                try:
+                    parts.append(readSource(includePath(args.strip(), os.path.dirname(path)), depth + 1))
+                except (OSError, ParseError):
+                    pass # reported by the assembler
+
+    return b'\0'.join(parts)
+
+
 class Assembler(object):
-    '''This class handles the loading and parsing of assembly files'''
+    '''This class handles the loading and parsing of assembly files
+
+    The file is assembled in a single pass: every line is encoded as soon as it is read, the labels
+    are looked up in a hash table and the instructions that use a label before its definition are
+    encoded again (fixed up) when the label is defined, so the time is linear in the size of the source.
 
-    def __init__(self, filePath):
+    Any iterable of lines can be assembled with parseLines, or streamed with stream, which doesn't
+    keep the program in memory.
+
+    The directives are:
+        .include "file" - assemble the lines of file (relative to the including file) in place
+        .macro NAME param, ... and .endm - define a macro, used like an instruction: NAME arg, ...
+        .code and .data - select the section of the following lines, the data is placed after all the code
+        .global label, ... - export labels from a module, see link.py
+    and DW value, ... (or label DW value, ...) stores words, the values are numbers or labels.
+    '''
+
+    def __init__(self, filePath=None):
         '''Initialize the Assembler class
 
         Args:
-            filePath - the path to the *.asm file to be loaded and parsed
+            filePath - the path to the *.asm file to be loaded and parsed,
+                None if the lines are given to parseLines or stream
         '''
-        self.programText = []
         self.programCode = []
         self.lblToAddr = {}
+        self.adrToLine = {} # the address of every instruction -> its line number in the file (from 1)
         self.filePath = filePath
+        self._adr = 0 # the address of the next instruction
+        self._fixups = {} # label -> the Fixups waiting for its definition
+        self._unresolved = [] # the labels used, but not yet defined, by the instruction being encoded
+        self.exports = set() # the labels given to .global
+        self.codeSize = None # the size of the code section, known at the end
+        self.relocations = None # list of Relocation, only kept if it is set to a list
+        self._section = CODE
+        self._data = [] # the (line, line number) of the data section, assembled after the code
+        self._macros = {} # lower case name -> Macro
+        self._macro = None # the Macro whose body is being read
+        self._expansions = 0 # the number of macros expanded, to make their labels unique
+        self._dirs = [os.path.dirname(filePath) if filePath else ''] # the directories of the included files
+        self._depth = 0 # the nesting of the macro expansions
 
 
     def _validatePath(self):
@@ -48,9 +205,8 @@ class Assembler(object):
             line = line[:comment_start]
 
         line = line.strip() # remove spaces from both ends
-        # remove tabs & spaces from inside the string
-        line = ' '.join(line.split('\t'))
-        line = ' '.join(line.split(' '))
+        # remove tabs from inside the string
+        line = line.replace('\t', ' ')
 
         return line
 
@@ -72,21 +228,11 @@ class Assembler(object):
         if len(line) < 1:
             raise ParseError('Invalid assembly line: ' + ' '.join(line))
 
-        op = None
-
-        for opcode in OpCode:
-            if opcode.name.lower() == line[0].lower():
-                op = opcode
-                break
+        (opcode, group) = MNEMONICS.get(line[0].lower(), (None, None))
 
-        if op is None:
+        if opcode is None:
             raise ParseError('Cannot find valid opcode for: ' + ' '.join(line))
 
-        group = getOpcodeGroup(op)
-
-        if group is None:
-            raise ParseError('Cannot find valid instruction type for: ' + ' '.join(line))
-
         return (opcode, group)
 
     def _parseOperand(self, operand):
@@ -99,10 +245,27 @@ class Assembler(object):
             A tuple containing the addressing mode (AddrMode), the register (as a number) and the offset
             If one of the register number or offset doesn't apply, it will be 0
             Eg: R5: (AddrMode.DIRECT, 5, 0)
+            A label is an immediate operand, if it is not defined yet its offset is 0 and it is
+            added to _unresolved
 
         Raises:
             ParseError - when the parsing fails
         '''
+        adr = self.lblToAddr.get(operand)
+        if adr is not None:
+            return (AddrMode.IMMEDIATE, 0, adr)
+
+        try:
+            return self._parseOperandSyntax(operand)
+        except ParseError as e:
+            if len(operand) < 1 or operand[0] == '(':
+                raise
+            # it may be a label defined later, the error is reported only if it is never defined
+            self._unresolved.append((operand, e))
+            return (AddrMode.IMMEDIATE, 0, 0)
+
+    def _parseOperandSyntax(self, operand):
+        '''Parse an operand which is not a label, see _parseOperand'''
         mode = None
         r = 0
         offset = 0
@@ -145,13 +308,15 @@ class Assembler(object):
 
 
     def _parseLiteral(self, literal):
+        try:
+            return int(literal, 0) # the common case, much faster than literal_eval
+        except ValueError:
+            pass
+
         try:
             return literal_eval(literal)
         except (ValueError, SyntaxError):
-            if self.firstPass:
-                return 0 # on the first pass we don't have to care whether the constants are parse-able or not
-            else:
-                raise ParseError('Cannot parse {} as a number'.format(literal))
+            raise ParseError('Cannot parse {} as a number'.format(literal))
 
     def _parseOperands(self, opcode, group, line):
         '''Parse the operands on a line, given the fact that we already know the opcode
@@ -221,7 +386,7 @@ class Assembler(object):
         split_line = line.split(' ', 1)
 
         #remove spaces from the arguments
-        split_line = list(map(lambda x: x.replace(' ', ''), split_line))
+        split_line = [token.replace(' ', '') for token in split_line]
 
         l = len(split_line)
 
@@ -232,61 +397,274 @@ class Assembler(object):
 
         return split_line
 
-    def _replaceLabels(self):
-        '''Replace label names with addresses
+    def _defineLabel(self, label):
+        '''Define a label at the current address and fix up the instructions waiting for it
+
+        Returns:
+            A list with a Chunk for every instruction that had no other label to wait for
+
+        Raises:
+            ParseError - if the label is already defined
+        '''
+        if label in self.lblToAddr:
+            raise ParseError('Label {} is defined more than once'.format(label))
+
+        self.lblToAddr[label] = self._adr
+
+        chunks = []
+        for fixup in self._fixups.pop(label, ()):
+            fixup.missing.discard(label)
+            if not fixup.missing:
+                chunks.append(Chunk(fixup.adr, self._encode(fixup.tokens), fixup.line))
+
+        return chunks
+
+    def _parseData(self, tokens):
+        '''Encode the words of a DW line, every operand is a number or a label'''
+        if len(tokens) < 2 or '' in tokens[1:]:
+            raise ParseError('DW requires a list of values, given: ' + ' '.join(tokens))
+
+        words = []
+        for operand in tokens[1:]:
+            (mode, r, val) = self._parseOperand(operand)
+            if mode != AddrMode.IMMEDIATE:
+                raise ParseError('DW values must be numbers or labels, given ' + operand)
+            if not -2**15 <= val < 2**16:
+                raise ParseError('DW values must fit in 16 bits, given ' + operand)
+            words.append(val)
+
+        return words
+
+    def _encode(self, tokens):
+        '''Encode a tokenized instruction, the labels not defined yet are encoded as 0 and left in _unresolved'''
+        self._unresolved = []
+        if tokens[0].lower() == 'dw':
+            return self._parseData(tokens)
+        (opcode, group) = self._parseOpcode(tokens)
+
+        return self._parseOperands(opcode, group, tokens)
+
+    def _splitLine(self, line):
+        '''Split a line of the source in the label it defines and its tokenized instruction
+
+        Returns:
+            (label, tokens), each one is None if the line doesn't have it
+
+        Raises:
+            ParseError - if the line is not standard assembly, see _tokenize
+        '''
+        return self._split(self._sanitize(line))
+
+    def _split(self, line):
+        '''Same as _splitLine, for a line that is already sanitized'''
+        if line == '' or not self._ignoreLine(line):
+            return (None, None)
+
+        label = None
+        markIndex = line.find(':')
+        if markIndex != -1: # the line starts with a label
+            label = line[:markIndex]
+            line = line[markIndex+1:].strip() # remove the label from the line
+            if line == '': # the whole line is just a label
+                return (label, None)
+        else:
+            match = DATA_LINE.match(line)
+            if match is not None:
+                label = match.group(1)
+                line = line[match.end(1):].strip()
+
+        return (label, self._tokenize(line))
+
+    def _directive(self, line, lineNumber):
+        '''Handle a directive, see the class description
+
+        Returns:
+            A list of Chunk, the instructions assembled from an included file
+
+        Raises:
+            ParseError - if the directive is unknown or its arguments are invalid
         '''
-        replacedText = []
+        (name, args) = (line.split(' ', 1) + [''])[:2]
+        name = name.lower()
+        args = args.strip()
+
+        if name in ('.code', '.data'):
+            if args:
+                raise ParseError('{} takes no arguments, given: {}'.format(name, args))
+            self._section = CODE if name == '.code' else DATA
+        elif name == '.include':
+            return self._include(includePath(args, self._dirs[-1]), lineNumber)
+        elif name == '.macro':
+            tokens = self._tokenize(args)
+            if not tokens[0] or '' in tokens[1:]:
+                raise ParseError('Invalid macro definition: ' + line)
+            if tokens[0].lower() in MNEMONICS or tokens[0].lower() == 'dw':
+                raise ParseError('Macro {} has the name of an instruction'.format(tokens[0]))
+            self._macro = Macro(tokens[0], tokens[1:])
+        elif name == '.global':
+            labels = [label.strip() for label in args.split(',')]
+            if '' in labels:
+                raise ParseError('Invalid list of labels: ' + line)
+            self.exports.update(labels)
+        elif name == '.endm':
+            raise ParseError('.endm without .macro')
+        else:
+            raise ParseError('Unknown directive: ' + line)
 
-        for line in self.programText:
-            replaced_line = [line[0]]
-            for token in line[1:]:
-                replaced_token = token
-                for k, v in self.lblToAddr.items():
-                    if k == token:
-                        # replace the label name with its address
-                        replaced_token = str(v)
-                        break
+        return []
 
-                replaced_line.append(replaced_token)
+    def _include(self, path, lineNumber):
+        '''Assemble the lines of an included file, their line number is the one of the .include'''
+        if len(self._dirs) > MAX_NESTING:
+            raise ParseError('Too many nested includes, {} is probably including itself'.format(path))
+        try:
+            f = open(path)
+        except OSError as e:
+            raise ParseError('Cannot include {}: {}'.format(path, e.strerror))
 
-            replacedText.append(replaced_line)
+        chunks = []
+        self._dirs.append(os.path.dirname(path))
+        try:
+            with f:
+                for line in f:
+                    chunks += self._assembleLine(line, lineNumber)
+        finally:
+            self._dirs.pop()
+
+        return chunks
+
+    def _expand(self, macro, args, lineNumber):
+        '''Assemble the body of a macro, its line number is the one of the line using the macro'''
+        if self._depth >= MAX_NESTING:
+            raise ParseError('Too many nested macros, {} is probably using itself'.format(macro.name))
+
+        self._expansions += 1
+        chunks = []
+        self._depth += 1
+        try:
+            for line in macro.expand(args, self._expansions):
+                chunks += self._assembleLine(line, lineNumber)
+        finally:
+            self._depth -= 1
 
-        self.programText = replacedText
+        return chunks
 
-    def _getInstrSize(self, line):
-        '''Compute the length of an instruction
+    def _assembleLine(self, line, lineNumber):
+        '''Assemble a line of the source: define its label and encode its instruction
 
         Args:
-            line - the line containing the instruction to compute the size of
-        Returns: the length of the instruction on the line passes as argument
+            line - the line, as read from the file
+            lineNumber - the number of the line in the file, from 1
+
+        Returns:
+            A list of Chunk: the instructions fixed up by the label and the instruction on the line
+        '''
+        line = self._sanitize(line)
+        if self._macro is not None:
+            return self._readMacro(line)
+        if line[:1] == '.':
+            return self._directive(line, lineNumber)
+        if self._section == DATA and self._data is not None:
+            self._data.append((line, lineNumber))
+            return []
+
+        (label, tokens) = self._split(line)
+
+        chunks = []
+        if label is not None:
+            chunks = self._defineLabel(label)
+        if tokens is None:
+            return chunks
+
+        macro = self._macros.get(tokens[0].lower())
+        if macro is not None:
+            return chunks + self._expand(macro, tokens[1:], lineNumber)
+
+        words = self._encode(tokens)
+        chunks.append(Chunk(self._adr, words, lineNumber))
+
+        if self.relocations is not None and \
+                (self._unresolved or any(operand in self.lblToAddr for operand in tokens[1:])):
+            self.relocations.append(Relocation(self._adr, tokens, lineNumber))
+
+        if self._unresolved:
+            fixup = Fixup(self._adr, lineNumber, tokens, self._unresolved)
+            for lbl in fixup.missing:
+                self._fixups.setdefault(lbl, []).append(fixup)
+
+        # the words are already encoded (and dw lines are not instructions), so their count is the size,
+        # instr.decode is only needed to find the size of words that come from memory
+        self._adr += len(words)
+
+        return chunks
+
+    def _readMacro(self, line):
+        '''Add a line to the body of the macro being defined, until .endm'''
+        name = line.split(' ', 1)[0].lower()
+        if name == '.endm':
+            self._macros[self._macro.name.lower()] = self._macro
+            self._macro = None
+        elif name == '.macro':
+            raise ParseError('Macros cannot be defined inside macro {}: {}'.format(self._macro.name, line))
+        elif line:
+            self._macro.lines.append(line)
+
+        return []
+
+    def _endCode(self):
+        '''Assemble the data section, after all the code, see stream'''
+        if self._macro is not None:
+            raise ParseError('Macro {} is not closed by .endm'.format(self._macro.name))
+
+        self.codeSize = self._adr
+        (data, self._data) = (self._data, None)
+        for (line, lineNumber) in data:
+            yield from self._assembleLine(line, lineNumber)
+
+    def _checkFixups(self):
+        '''Report the labels that were used, but never defined
+
+        Raises:
+            ParseError - the one that the first of these operands caused
         '''
-        (opcode, group) = self._parseOpcode(self._tokenize(line))
-        return len(self._parseOperands(opcode, group, self._tokenize(line)))
+        if not self._fixups:
+            return
 
-    def _labelsToAddr(self):
-        '''Translate the labels found in code to real addresses'''
-        ct = 0 # address counter
-        definitionlessText = []
+        fixup = min((fixup for fixups in self._fixups.values() for fixup in fixups), key=lambda f: f.adr)
+        for (lbl, error) in fixup.errors:
+            if lbl in fixup.missing:
+                raise error
 
-        #search for label definitions
-        for line in self.programText:
-            markIndex = line.find(':')
+    def stream(self, lines):
+        '''Assemble the lines one at a time
+
+        Only the labels and the instructions waiting for labels are kept, the words are handed out
+        as soon as they are encoded: the instructions that use a label before its definition are
+        produced with 0 in its place and produced again, at the same address, once it is defined.
+        Storing every chunk at its address, in order, gives the program that parse returns.
+
+        Args:
+            lines - any iterable of source lines, eg: an open file, sys.stdin or a generator
 
-            if markIndex == len(line) - 1: # the whole line is just a label
-                # store it without the ":"
-                self.lblToAddr[line[:-1]] = ct
-            elif markIndex != -1: # the line starts with a label
-                self.lblToAddr[line[:markIndex]] = ct
-                ct += self._getInstrSize(line[markIndex+1:].strip())
-                definitionlessText.append(line[markIndex+1:].strip()) # remove the label from the line
-            else: # there is no label definition on this line
-                ct += self._getInstrSize(line.strip())
-                definitionlessText.append(line.strip())
+        Returns:
+            A generator of Chunk
+
+        Raises:
+            ParseError - if a line cannot be parsed, or at the end if a label is never defined
+        '''
+        for (lineNumber, line) in enumerate(lines, 1):
+            yield from self._assembleLine(line, lineNumber)
 
-        #print(self.lblToAddr)
+        yield from self._endCode()
+        self._checkFixups()
 
-        self.programText = definitionlessText
+    def parseLines(self, lines):
+        '''Parse the given source lines, see parse and stream'''
+        for (adr, words, line) in self.stream(lines):
+            self.programCode[adr:adr + len(words)] = words
+            self.adrToLine[adr] = line
 
+        return self.programCode
 
     def parse(self):
         '''Parse the loaded file
@@ -299,31 +677,7 @@ class Assembler(object):
             raise ParseError('Validation for {} failed'.format(self.filePath))
 
         with open(self.filePath) as f:
-            for line in f:
-                line = self._sanitize(line)
-                if line != '':
-                    self.programText.append(line)
-
-        self.programText = list(filter(self._ignoreLine, self.programText))
-
-        self.firstPass = True
-        self._labelsToAddr()
-        self.firstPass = False
-        #print(self.programText)
-
-        tokenizedText = []
-        for line in self.programText:
-            tokenizedText.append(self._tokenize(line))
-        self.programText = tokenizedText
-
-        self._replaceLabels()
-
-        for line in self.programText:
-            #print(line)
-            (opcode, group) = self._parseOpcode(line)
-            self.programCode += self._parseOperands(opcode, group, line)
-
-        return self.programCode
+            return self.parseLines(f)
 
 
     def _ignoreLine(self, line):
@@ -335,7 +689,7 @@ class Assembler(object):
 
         Returns: False if the line should be ignored, True otherwise
         '''
-        if line[0] == '.' or line == 'END':
+        if line == 'END':
             return False
 
         return True
\ No newline at end of file
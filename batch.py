@@ -0,0 +1,196 @@
+#! /usr/bin/python3.5
+'''Assemble and run many programs in parallel
+
+Every program is assembled and run in a worker process, the results are printed as JSON lines,
+in the order in which the programs finish.
+
+Usage:
+    ./batch.py -j 8 --max-cycles 1000000 --timeout 10 'submissions/*.asm' examples/mul.asm
+'''
+from uinstr import MPM
+from seq import Seq, Cpu, StopReason
+from ucomp import CompiledSeq
+from objfile import assemble
+
+from multiprocessing.connection import wait
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+# the engines that can run a job, both implement Seq.run
+ENGINES = {
+    'micro': Seq,
+    'compiled': CompiledSeq,
+}
+
+# the number of micro-cycles executed between two checks of the job's timeout
+TIMEOUT_CHECK_CYCLES = 10000
+
+# the seconds a job is given after its timeout to stop by itself, before its process is killed
+KILL_GRACE = 2.0
+
+def expandPaths(patterns):
+    '''Turn a list of paths and glob patterns into a list of paths
+
+    The patterns that match nothing are kept as they are, so they are reported as missing files.
+    '''
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths += matches if matches else [pattern]
+
+    return paths
+
+
+def runJob(path, maxCycles=None, timeout=None, engine='compiled', cacheDir=None):
+    '''Assemble and run a program
+
+    Args:
+        path - the *.asm (or *.obj) file
+        maxCycles - the micro-cycle budget of the program, None for no limit
+        timeout - the maximum run time in seconds, None for no limit
+        engine - the name of the sequencer to run the program with, see ENGINES
+        cacheDir - the directory of the assembly cache (see objfile.AsmCache), None to parse every program
+
+    Returns:
+        A JSON serializable dict with the stop reason, the executed micro-cycles and instructions,
+        the final registers and flags; or the error (type and message) if the program could not
+        be assembled or run
+    '''
+    start = time.perf_counter()
+    result = {'path': path}
+    try:
+        cpu = Cpu(assemble(path, cacheDir).words)
+        seq = ENGINES[engine](MPM, cpu)
+
+        cycles = 0
+        instructions = 0
+        while True:
+            chunk = None
+            if timeout is not None:
+                chunk = TIMEOUT_CHECK_CYCLES
+            if maxCycles is not None:
+                chunk = maxCycles - cycles if chunk is None else min(chunk, maxCycles - cycles)
+
+            run = seq.run(maxCycles=chunk)
+            cycles += run.cycles
+            instructions += run.instructions
+            reason = run.reason.value
+
+            if run.reason != StopReason.CYCLE_LIMIT or (maxCycles is not None and cycles >= maxCycles):
+                break
+            if timeout is not None and time.perf_counter() - start >= timeout:
+                reason = 'timeout'
+                break
+
+        result.update({
+            'reason': reason,
+            'cycles': cycles,
+            'instructions': instructions,
+            'registers': list(cpu.r),
+            'flags': {'z': cpu.z, 'c': cpu.c, 'v': cpu.v, 's': cpu.s},
+            'pc': cpu.pc,
+            'sp': cpu.sp,
+        })
+    except Exception as e:
+        # eg: ParseError, ObjectError, InvalidInstruction, a missing file
+        result.update({'error': type(e).__name__, 'message': str(e)})
+
+    result['elapsed'] = time.perf_counter() - start
+
+    return result
+
+
+def _runJobInWorker(conn, args):
+    conn.send(runJob(*args))
+    conn.close()
+
+
+def runBatch(paths, workers=None, maxCycles=None, timeout=None, engine='compiled', cacheDir=None):
+    '''Run every program in a process of its own, at most workers of them at the same time
+
+    A job checks its timeout itself, between two chunks of TIMEOUT_CHECK_CYCLES micro-cycles, but it can't
+    while it is assembling or inside a long chunk, so the jobs still running KILL_GRACE seconds after
+    their timeout are killed from here. A killed job or a worker that died (eg: out of memory, a
+    segfault) only loses its own result, the others go on.
+
+    Args:
+        paths - the *.asm (or *.obj) files
+        workers - the number of processes, the number of CPUs if None
+        maxCycles, timeout, engine, cacheDir - see runJob, they apply to every program
+
+    Returns:
+        A generator of the runJob results, in the order in which the programs finish; a killed job
+        gives {'path', 'reason': 'timeout', 'elapsed'} and a dead worker gives
+        {'path', 'error': 'WorkerCrashed', 'message', 'elapsed'}
+    '''
+    workers = workers or os.cpu_count()
+    pending = list(reversed(paths))
+    running = {} # the result pipe of a job -> (process, path, start)
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                path = pending.pop()
+                (receiver, sender) = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_runJobInWorker,
+                    args=(sender, (path, maxCycles, timeout, engine, cacheDir)), daemon=True)
+                process.start()
+                sender.close()
+                running[receiver] = (process, path, time.perf_counter())
+
+            waitFor = None
+            if timeout is not None:
+                oldest = min(start for (process, path, start) in running.values())
+                waitFor = max(0, oldest + timeout + KILL_GRACE - time.perf_counter())
+
+            for conn in wait(list(running), waitFor):
+                (process, path, start) = running.pop(conn)
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    process.join()
+                    result = {'path': path, 'error': 'WorkerCrashed',
+                        'message': 'the worker exited with code {}'.format(process.exitcode),
+                        'elapsed': time.perf_counter() - start}
+                conn.close()
+                process.join()
+                yield result
+
+            if timeout is not None:
+                now = time.perf_counter()
+                for (conn, (process, path, start)) in list(running.items()):
+                    if now - start >= timeout + KILL_GRACE:
+                        process.terminate()
+                        process.join()
+                        conn.close()
+                        del running[conn]
+                        yield {'path': path, 'reason': 'timeout', 'elapsed': now - start}
+    finally:
+        # the caller stopped iterating early
+        for (conn, (process, path, start)) in running.items():
+            process.terminate()
+            process.join()
+            conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assemble and run many programs in parallel')
+    parser.add_argument('files', nargs='+', help='the *.asm (or *.obj) files or glob patterns matching them')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='the number of worker processes (default: %(default)s)')
+    parser.add_argument('--max-cycles', type=int, help='the micro-cycle budget of every program')
+    parser.add_argument('--timeout', type=float, help='the maximum run time of every program, in seconds')
+    parser.add_argument('-e', '--engine', choices=sorted(ENGINES), default='compiled',
+        help='the sequencer running the programs (default: %(default)s)')
+    parser.add_argument('--cache', metavar='DIR',
+        help='keep the assembled programs in DIR, the sources that did not change are not parsed again')
+    args = parser.parse_args()
+
+    for result in runBatch(expandPaths(args.files), args.jobs, args.max_cycles, args.timeout, args.engine,
+            args.cache):
+        print(json.dumps(result), flush=True)
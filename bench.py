@@ -0,0 +1,374 @@
+#! /usr/bin/python3.5
+'''Benchmarks for the assembler and the execution engines
+
+Every workload (the examples and the synthetic kernels, scaled by --scale) is assembled and run
+by every engine --repeat times; the median and the variance of the timings are reported, along
+with the derived throughputs: assembled lines/s, micro-cycles/s and guest instructions/s.
+
+Usage:
+    ./bench.py --json results.json
+    ./bench.py --compare results.json --tolerance 0.1
+'''
+from uinstr import MPM
+from seq import Seq, Cpu, StopReason
+from ucomp import CompiledSeq
+from isa import IsaEngine
+from block import BlockEngine
+from asm import Assembler
+
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+EXAMPLES = ['examples/factorial.asm', 'examples/mul.asm', 'examples/br.asm']
+
+def arithmeticKernel(scale):
+    '''A long loop of register arithmetic'''
+    return '''
+    mov r1, {}
+LOOP:
+    add r2, r1
+    xor r3, r2
+    sub r4, r3
+    and r5, r4
+    or r6, r5
+    dec r1
+    bne LOOP
+'''.format(min(1000 * scale, 0x7FFF))
+
+
+def callKernel(scale):
+    '''Chains of nested calls, as deep as the stack allows'''
+    return '''
+    mov r1, {}
+OUTER:
+    mov r2, 24
+    call DEEP
+    dec r1
+    bne OUTER
+    jmp DONE
+DEEP:
+    dec r2
+    beq BACK
+    call DEEP
+BACK:
+    ret
+DONE:
+'''.format(min(20 * scale, 0x7FFF))
+
+
+def copyKernel(scale):
+    '''A memory to memory copy loop, repeated over the same buffers'''
+    size = 64
+    buffers = '    nop\n' * size
+    return '''
+    mov r4, {}
+AGAIN:
+    mov r1, SRC
+    mov r2, DST
+    mov r3, {}
+COPY:
+    mov (r2), (r1)
+    inc r1
+    inc r2
+    dec r3
+    bne COPY
+    dec r4
+    bne AGAIN
+    jmp DONE
+SRC:
+{}DST:
+{}DONE:
+'''.format(min(10 * scale, 0x7FFF), size, buffers, buffers)
+
+KERNELS = OrderedDict([
+    ('arithmetic', arithmeticKernel),
+    ('calls', callKernel),
+    ('copy', copyKernel),
+])
+
+# the number of labeled blocks of largeSource, they all fit in the 16 bit address space
+LARGE_BLOCKS = 4000
+
+def largeSource(lines):
+    '''A long program, only assembled: blocks of 8 lines, each one with a label, comments,
+    forward and backward references to the labels around it and all the addressing modes
+
+    Past LARGE_BLOCKS blocks the labels are not defined anymore, only referenced
+    '''
+    count = (lines + 7) // 8
+    defined = min(count, LARGE_BLOCKS)
+    blocks = []
+    for k in range(count):
+        blocks.append('''{}	mov	r1, {}	; block {}
+	add	r2, r1
+	mov	(r3)4, (r2)
+	cmp	r2, (r4)
+	call	B{}
+	xor	r5, 0x1F
+	jmp	B{}
+	ret
+'''.format('B{}:'.format(k) if k < LARGE_BLOCKS else '', k & 0x7FFF, k,
+            (k + 2) % defined, (k - 1) % defined))
+
+    return ''.join(blocks)
+
+
+def runEngine(engine):
+    result = engine.run()
+    if result.reason != StopReason.END:
+        raise RuntimeError('The program stopped early: {}'.format(result.reason.value))
+    return (result.cycles, result.instructions)
+
+
+def seqEngine(cpu):
+    seq = Seq(MPM, cpu)
+    return lambda: runEngine(seq)
+
+
+def compiledEngine(cpu):
+    seq = CompiledSeq(MPM, cpu)
+    return lambda: runEngine(seq)
+
+
+def isaEngine(cpu):
+    engine = IsaEngine(cpu)
+    return lambda: runEngine(engine)
+
+
+def blockEngine(cpu):
+    engine = BlockEngine(cpu)
+    return lambda: runEngine(engine)
+
+# engine name -> function that prepares a Cpu to be run by the engine, it returns the function running
+# the program to the end, which returns (micro-cycles, instructions)
+# the engines that do not go through the microprogram do not count micro-cycles
+ENGINES = OrderedDict([
+    ('micro', seqEngine),
+    ('compiled', compiledEngine),
+    ('isa', isaEngine),
+    ('block', blockEngine),
+])
+
+
+def summarize(times, work=None):
+    '''Get the statistics of the timings of a benchmark
+
+    Args:
+        times - the durations of the runs, in seconds
+        work - the amount of work done by a run, None if it is not measured
+
+    Returns:
+        A dict with the median and the variance of the times and, if work is given,
+        the work done per second, based on the median
+    '''
+    median = statistics.median(times)
+    summary = {
+        'median': median,
+        'variance': statistics.variance(times) if len(times) > 1 else 0.0,
+        'runs': len(times),
+    }
+    if work is not None:
+        summary['perSec'] = work / median if median > 0 else None
+
+    return summary
+
+
+def timeIt(setup, repeats):
+    '''Time a function repeats times
+
+    Args:
+        setup - called (untimed) before every run, returns the function to be timed
+
+    Returns:
+        (the durations of the calls in seconds, the value returned by the last call)
+    '''
+    times = []
+    value = None
+    for i in range(repeats):
+        func = setup()
+        start = time.perf_counter()
+        value = func()
+        times.append(time.perf_counter() - start)
+
+    return (times, value)
+
+
+def benchAssembler(path, repeats):
+    '''Measure how fast a file is assembled
+
+    Returns:
+        (the summary of the timings, see summarize; the assembled words)
+    '''
+    with open(path) as f:
+        lines = sum(1 for line in f)
+
+    (times, words) = timeIt(lambda: Assembler(path).parse, repeats)
+    summary = summarize(times, lines)
+    summary['lines'] = lines
+
+    return (summary, words)
+
+
+def benchEngine(engine, words, repeats):
+    '''Measure how fast an engine runs a program
+
+    Returns:
+        A dict with the timings, the executed micro-cycles and instructions and their rates
+    '''
+    prepare = ENGINES[engine]
+    (times, (cycles, instructions)) = timeIt(lambda: prepare(Cpu(words)), repeats)
+
+    summary = summarize(times)
+    summary['cycles'] = cycles
+    summary['instructions'] = instructions
+    summary['cyclesPerSec'] = cycles / summary['median'] if cycles is not None and summary['median'] > 0 else None
+    summary['instrsPerSec'] = instructions / summary['median'] if summary['median'] > 0 else None
+
+    return summary
+
+
+def benchLargeAssembly(lines, repeats, directory):
+    '''Measure how fast a generated program of the given number of lines is assembled, see largeSource
+
+    Returns:
+        The summary of the timings, see summarize
+    '''
+    path = os.path.join(directory, 'large.asm')
+    with open(path, 'w') as f:
+        f.write(largeSource(lines))
+
+    return benchAssembler(path, repeats)[0]
+
+
+def workloads(scale, directory):
+    '''Get the files to be benchmarked, the synthetic kernels are written to directory
+
+    Returns:
+        An OrderedDict of workload name -> *.asm path
+    '''
+    files = OrderedDict((os.path.splitext(os.path.basename(path))[0], path) for path in EXAMPLES)
+    for (name, kernel) in KERNELS.items():
+        path = os.path.join(directory, '{}.asm'.format(name))
+        with open(path, 'w') as f:
+            f.write(kernel(scale))
+        files[name] = path
+
+    return files
+
+
+def runSuite(scale=1, repeats=5, engines=None, log=None, asmLines=100000):
+    '''Run all the benchmarks
+
+    Args:
+        scale - multiplies the number of iterations of the synthetic kernels
+        repeats - the number of times every measurement is repeated
+        engines - the names of the engines to benchmark, all of them if None
+        log - function called with a progress message after every benchmark
+        asmLines - the size of the generated program that is only assembled, 0 to skip it
+
+    Returns:
+        The results, as a JSON serializable dict
+    '''
+    engines = list(ENGINES) if engines is None else engines
+    results = OrderedDict()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for (name, path) in workloads(scale, directory).items():
+            (asmSummary, words) = benchAssembler(path, repeats)
+            results[name] = {'asm': asmSummary, 'engines': OrderedDict()}
+            if log:
+                log('{} asm: {:.0f} lines/s'.format(name, asmSummary['perSec'] or 0))
+
+            for engine in engines:
+                summary = benchEngine(engine, words, repeats)
+                results[name]['engines'][engine] = summary
+                if log:
+                    log('{} {}: {:.0f} instrs/s, {} cycles/s'.format(name, engine, summary['instrsPerSec'] or 0,
+                        '-' if summary['cyclesPerSec'] is None else '{:.0f}'.format(summary['cyclesPerSec'])))
+
+        if asmLines:
+            summary = benchLargeAssembly(asmLines, repeats, directory)
+            results['large'] = {'asm': summary, 'engines': OrderedDict()}
+            if log:
+                log('large asm ({} lines): {:.0f} lines/s'.format(summary['lines'], summary['perSec'] or 0))
+
+    return {
+        'python': platform.python_version(),
+        'scale': scale,
+        'repeats': repeats,
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance=0.1):
+    '''Find the throughputs that got worse than in the baseline
+
+    Args:
+        current - the results of runSuite
+        baseline - the results of an earlier runSuite
+        tolerance - the relative slowdown that is still accepted
+
+    Returns:
+        A list of (benchmark, metric, baseline value, current value, relative change),
+        for every regression
+    '''
+    def metrics(results):
+        for (name, workload) in results['results'].items():
+            yield ('{} asm'.format(name), 'linesPerSec', workload['asm']['perSec'])
+            for (engine, summary) in workload['engines'].items():
+                yield ('{} {}'.format(name, engine), 'instrsPerSec', summary['instrsPerSec'])
+                yield ('{} {}'.format(name, engine), 'cyclesPerSec', summary['cyclesPerSec'])
+
+    old = {(bench, metric): value for (bench, metric, value) in metrics(baseline)}
+    regressions = []
+    for (bench, metric, value) in metrics(current):
+        before = old.get((bench, metric))
+        if not before or value is None:
+            continue
+
+        change = (value - before) / before
+        if change < -tolerance:
+            regressions.append((bench, metric, before, value, change))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the assembler and the execution engines')
+    parser.add_argument('--scale', type=int, default=1,
+        help='multiplies the iterations of the synthetic kernels (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='the number of runs of every benchmark (default: %(default)s)')
+    parser.add_argument('--engine', action='append', choices=list(ENGINES),
+        help='benchmark only this engine, can be repeated (default: all of them)')
+    parser.add_argument('--asm-lines', type=int, default=100000,
+        help='the lines of the generated program that is only assembled, 0 to skip it (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the baseline in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='the relative slowdown reported as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = runSuite(args.scale, args.repeat, args.engine, log=print, asmLines=args.asm_lines)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance)
+        for (bench, metric, before, after, change) in regressions:
+            print('REGRESSION {} {}: {:.0f} -> {:.0f} ({:+.1%})'.format(bench, metric, before, after, change))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}'.format(args.compare))
@@ -0,0 +1,212 @@
+from instr import *
+from seq import ExecEnd, StackOverflow, StopReason, RunResult, toWord, WORD_MASK
+from isa import IsaEngine
+from memory import ADDRESS_MASK
+
+import time
+
+class Block(object):
+    '''A translated basic block: a straight run of decoded instructions that
+    ends with a branch, JMP, CALL or RET'''
+    __slots__ = ['start', 'covered', 'steps', 'valid']
+
+    def __init__(self, start, covered, steps):
+        '''Init the block
+
+        Args:
+            start - the address of the first instruction
+            covered - the addresses of all the words of the instructions
+            steps - list of (address, ir, source fetch, destination fetch, handler)
+                for each instruction
+        '''
+        self.start = start
+        self.covered = covered
+        self.steps = steps
+        self.valid = True
+
+    def run(self, cpu):
+        '''Execute the block
+
+        Returns:
+            The number of executed instructions
+
+        Raises:
+            StackOverflow - args[0] is the number of instructions executed before the overflow
+        '''
+        count = 0
+        try:
+            for (adr, ir, fetchSrc, fetchDst, handler) in self.steps:
+                # the fetch, as done by IsaEngine._fetch
+                cpu.adr = adr
+                cpu.ir = ir
+                cpu.pc = (adr + 1) & ADDRESS_MASK
+
+                if fetchSrc is not None:
+                    fetchSrc(ir)
+                if fetchDst is not None:
+                    fetchDst(ir)
+                handler(ir)
+                count += 1
+
+                if not self.valid: # the block overwrote itself
+                    break
+        except StackOverflow:
+            raise StackOverflow(count)
+
+        return count
+
+
+class BlockEngine(IsaEngine):
+    '''Executes whole basic blocks, which are translated once and cached by their start address
+
+    A block is dropped from the cache as soon as a memory write of the engine touches one of its words.
+    The engine doesn't see the other writes to the memory of its Cpu (eg: Patch.apply, Cpu.load),
+    invalidate must be called after them.
+    '''
+    def __init__(self, cpu):
+        super(BlockEngine, self).__init__(cpu)
+        self.blocks = {} # start address -> Block
+        self.coveredBy = {} # address -> list of the Blocks containing it
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _endsBlock(self, opcode, group):
+        return group == Group.BRANCH or opcode in (OpCode.JMP, OpCode.CALL, OpCode.RET)
+
+    def _translate(self, start):
+        '''Translate the basic block starting at the given address
+
+        Returns:
+            The Block, or None if the instruction at start cannot be translated
+            (eg: the program ended or the instruction is invalid)
+        '''
+        cpu = self.cpu
+        steps = []
+        covered = []
+        adr = start
+
+        while cpu.inCode(adr):
+            ir = cpu.mem[adr] & WORD_MASK
+            try:
+                d = decode(ir)
+            except ValueError:
+                break
+
+            handler = self.handlers.get(d.opcode)
+            if handler is None:
+                break
+
+            fetchSrc = None
+            fetchDst = None
+            if d.group == Group.TWO_OP:
+                fetchSrc = self.srcFetch[d.mas]
+                fetchDst = self.dstFetch[d.mad]
+            elif d.group == Group.ONE_OP:
+                fetchDst = self.dstFetch[d.mad]
+
+            steps.append((adr, ir, fetchSrc, fetchDst, handler))
+            covered.extend((adr + i) & ADDRESS_MASK for i in range(d.size))
+            adr = (adr + d.size) & ADDRESS_MASK
+
+            if self._endsBlock(d.opcode, d.group):
+                break
+
+        if not steps:
+            return None
+
+        block = Block(start, tuple(covered), steps)
+        for adr in block.covered:
+            self.coveredBy.setdefault(adr, []).append(block)
+
+        return block
+
+    def _write(self, adr, val):
+        cpu = self.cpu
+        cpu.mem[adr] = toWord(val)
+
+        adr &= ADDRESS_MASK
+        if adr in self.coveredBy:
+            self._invalidate(adr)
+
+    def invalidate(self, start, end):
+        '''Drop the blocks that contain an address in [start, end), eg: after applying a Patch
+        to the memory of the Cpu:
+
+            for (adr, words) in patch.runs:
+                engine.invalidate(adr, adr + len(words))
+        '''
+        for adr in range(start, end):
+            adr &= ADDRESS_MASK
+            if adr in self.coveredBy:
+                self._invalidate(adr)
+
+    def _invalidate(self, adr):
+        '''Drop all the blocks that contain the given address'''
+        for block in self.coveredBy.pop(adr):
+            if not block.valid:
+                continue
+
+            block.valid = False
+            self.invalidations += 1
+            del self.blocks[block.start]
+
+            for covered in block.covered:
+                if covered != adr:
+                    self.coveredBy[covered].remove(block)
+                    if not self.coveredBy[covered]:
+                        del self.coveredBy[covered]
+
+    def execBlock(self):
+        '''Execute the basic block that starts at PC
+
+        Returns:
+            The number of executed instructions
+
+        Raises:
+            The same exceptions as IsaEngine.execInstr
+        '''
+        pc = self.cpu.pc
+        block = self.blocks.get(pc)
+
+        if block is None:
+            self.misses += 1
+            block = self._translate(pc)
+            if block is None:
+                # let the interpreter report why it cannot be executed
+                self.execInstr()
+                return 1
+            self.blocks[pc] = block
+        else:
+            self.hits += 1
+
+        return block.run(self.cpu)
+
+    def run(self, maxInstrs=None):
+        '''Same as IsaEngine.run, but the budget is only tested between two blocks, so it can be
+        exceeded by the instructions of a block'''
+        instructions = 0
+        start = time.perf_counter()
+        try:
+            while maxInstrs is None or instructions < maxInstrs:
+                instructions += self.execBlock()
+            reason = StopReason.INSTR_LIMIT
+        except ExecEnd:
+            reason = StopReason.END
+        except StackOverflow as e:
+            instructions += e.args[0] if e.args else 0
+            reason = StopReason.STACK_OVERFLOW
+        except (InvalidInstruction, ValueError): # no microroutine, or IR does not hold a valid instruction
+            reason = StopReason.INVALID_INSTRUCTION
+
+        return RunResult(reason, None, instructions, time.perf_counter() - start)
+
+    def cacheStats(self):
+        '''Get the translation cache counters'''
+        return {
+            'blocks': len(self.blocks),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
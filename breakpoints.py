@@ -0,0 +1,213 @@
+from seq import Breakpoint, StopReason, instanceOverride
+from uinstr import SBus, DBus, RBus, Mem, MPM_LABELS
+
+# the kinds of breakpoints and watchpoints
+PC = 'pc' # stop before the instruction at an address is executed
+MPM = 'mpm' # stop before the microinstruction at an MPM address is executed
+READ = 'read' # stop after a memory word is read (not fetched as an instruction)
+WRITE = 'write' # stop after a memory word is written
+REG_READ = 'reg read' # stop after a general register is read
+REG_WRITE = 'reg write' # stop after a general register is written
+KINDS = [PC, MPM, READ, WRITE, REG_READ, REG_WRITE]
+
+class Breakpoints(object):
+    '''The breakpoints and watchpoints of a Seq
+
+    The PC breakpoints are given to Seq.run as stopAt, so they are tested only between two instructions.
+    The other ones are tested by hooks installed in the sequencer (in its execMicroInstr and in the
+    entries of its dispatch tables that access the memory and the registers) only while at least one
+    of them is set, so a Seq without breakpoints runs at full speed. The hooks only note the accesses
+    to the watched addresses, the execution stops (Breakpoint is raised) once the micro-cycle is
+    complete, so it can be resumed normally.
+
+    Every test is a set lookup, so their number doesn't matter.
+    '''
+    def __init__(self, seq, labels=None, mpmLabels=MPM_LABELS):
+        '''Init the breakpoints of a Seq, none is set
+
+        Args:
+            seq - the Seq to stop
+            labels - the labels of the program (eg: Assembler.lblToAddr), they can be used as addresses
+            mpmLabels - the labels of the microprogram, they can be used as MPM addresses
+        '''
+        self.seq = seq
+        self.labels = {} if labels is None else labels
+        self.mpmLabels = mpmLabels
+        self.points = {kind: set() for kind in KINDS}
+        self.hits = [] # (kind, address or register) of the accesses that stopped the execution last
+        self.attached = False
+
+    def resolve(self, kind, where):
+        '''Get the address (or the register number) a breakpoint refers to
+
+        Args:
+            kind - one of KINDS
+            where - a number, a label (an MPM label for MPM), or a register (eg: R3) for REG_READ and REG_WRITE
+
+        Raises:
+            ValueError - if where cannot be resolved
+        '''
+        if isinstance(where, int):
+            return where
+
+        if kind in (REG_READ, REG_WRITE):
+            return int(where[1:] if where[:1] in ('r', 'R') else where)
+
+        labels = self.mpmLabels if kind == MPM else self.labels
+        if where in labels:
+            return labels[where]
+
+        return int(where, 0)
+
+    def add(self, kind, where):
+        '''Set a breakpoint or a watchpoint
+
+        Args:
+            kind - one of KINDS
+            where - see resolve
+
+        Returns:
+            The address (or register) of the breakpoint
+
+        Raises:
+            ValueError - if where cannot be resolved or the register doesn't exist
+        '''
+        adr = self.resolve(kind, where)
+        if kind in (REG_READ, REG_WRITE) and not 0 <= adr < len(self.seq.cpu.r):
+            raise ValueError('There is no register R{}'.format(adr))
+
+        self.points[kind].add(adr)
+        self._update()
+
+        return adr
+
+    def remove(self, kind, where):
+        '''Remove a breakpoint or a watchpoint, see add'''
+        adr = self.resolve(kind, where)
+        self.points[kind].discard(adr)
+        self._update()
+
+        return adr
+
+    def clear(self):
+        '''Remove all the breakpoints and watchpoints'''
+        for points in self.points.values():
+            points.clear()
+        self._update()
+
+    def run(self, **kwargs):
+        '''Run the Seq until a breakpoint (or another stop condition, see Seq.run) is hit
+
+        Returns:
+            The RunResult, the reason is StopReason.PC for a PC breakpoint, StopReason.BREAKPOINT for
+            an MPM breakpoint and StopReason.WATCHPOINT for a watchpoint (see hits)
+        '''
+        stopAt = set(kwargs.pop('stopAt', ()))
+        result = self.seq.run(stopAt=stopAt | self.points[PC], **kwargs)
+        if result.reason == StopReason.PC:
+            self.hits = [(PC, self.seq.cpu.pc)]
+
+        return result
+
+    def step(self):
+        '''Execute a microinstruction
+
+        Returns:
+            None, or the StopReason if a breakpoint or watchpoint was hit (see hits)
+        '''
+        try:
+            self.seq.execMicroInstr()
+        except Breakpoint as e:
+            return e.args[0]
+
+        return None
+
+    def _update(self):
+        '''Install the hooks if a breakpoint (other than a PC one) is set, remove them otherwise'''
+        self._detach()
+        if any(self.points[kind] for kind in KINDS if kind != PC):
+            self._attach()
+
+    def _attach(self):
+        seq = self.seq
+        cpu = seq.cpu
+        hits = []
+        mars = frozenset(self.points[MPM])
+        reads = frozenset(self.points[READ])
+        writes = frozenset(self.points[WRITE])
+        regReads = frozenset(self.points[REG_READ])
+        regWrites = frozenset(self.points[REG_WRITE])
+        breakpoints = self
+
+        self._tables = (seq.sbusTable, seq.dbusTable, seq.rbusTable, seq.memTable)
+        (seq.sbusTable, seq.dbusTable, seq.rbusTable, seq.memTable) = [list(table) for table in self._tables]
+
+        if reads:
+            memRead = seq.memTable[Mem.READ]
+
+            def watchedMemRead():
+                memRead()
+                if cpu.adr in reads:
+                    hits.append((READ, cpu.adr))
+
+            seq.memTable[Mem.READ] = watchedMemRead
+
+        if writes:
+            memWrite = seq.memTable[Mem.WRITE]
+
+            def watchedMemWrite():
+                memWrite()
+                if cpu.adr in writes:
+                    hits.append((WRITE, cpu.adr))
+
+            seq.memTable[Mem.WRITE] = watchedMemWrite
+
+        if regReads:
+            def watchRegRead(busReg):
+                def watchedBusReg():
+                    busReg()
+                    if cpu.rIndex in regReads:
+                        hits.append((REG_READ, cpu.rIndex))
+
+                return watchedBusReg
+
+            seq.sbusTable[SBus.REG] = watchRegRead(seq.sbusTable[SBus.REG])
+            seq.dbusTable[DBus.REG] = watchRegRead(seq.dbusTable[DBus.REG])
+
+        if regWrites:
+            rbusReg = seq.rbusTable[RBus.REG]
+
+            def watchedRbusReg(val):
+                rbusReg(val)
+                if cpu.rIndex in regWrites:
+                    hits.append((REG_WRITE, cpu.rIndex))
+
+            seq.rbusTable[RBus.REG] = watchedRbusReg
+
+        execMicroInstr = seq.execMicroInstr
+
+        def checkedExecMicroInstr():
+            execMicroInstr()
+            if hits or seq.mar in mars:
+                reason = StopReason.WATCHPOINT if hits else StopReason.BREAKPOINT
+                if seq.mar in mars:
+                    hits.append((MPM, seq.mar))
+                breakpoints.hits = list(hits)
+                del hits[:]
+                raise Breakpoint(reason)
+
+        self._execMicroInstr = instanceOverride(seq, 'execMicroInstr')
+        seq.execMicroInstr = checkedExecMicroInstr
+        self.attached = True
+
+    def _detach(self):
+        if not self.attached:
+            return
+
+        seq = self.seq
+        (seq.sbusTable, seq.dbusTable, seq.rbusTable, seq.memTable) = self._tables
+        if self._execMicroInstr is None:
+            del seq.execMicroInstr
+        else:
+            seq.execMicroInstr = self._execMicroInstr
+        self.attached = False
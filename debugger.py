@@ -1,13 +1,90 @@
-from seq import ExecEnd
+from seq import ExecEnd, StopReason, REG_HEADER, MEM_HEADER, FLAG_HEADER, STATE_HEADER, FLAG_NAMES, STATE_FIELDS
+from memory import PAGE_BITS
+from breakpoints import Breakpoints, PC, MPM, READ, WRITE, REG_READ, REG_WRITE
+from history import History
+
+from array import array
+import re
 import readline
 
+# the number of words shown by the memory command when no count is given
+MEM_WINDOW = 64
+
+ENDED = 'The program ended, use "q" to quit'
+ENDED_RECORDING = 'The program ended after {} recorded micro-cycles, use "rs" or "rc" to go back, "q" to quit'
+NOT_RECORDING = 'Not recording, use "rec" first to be able to go back'
+
+class StateView(object):
+    '''Remembers the CPU state as it was last displayed, in order to display only what changed since then
+
+    The memory is compared through its snapshots (see Memory.snapshot): only the pages written since the
+    last display are new, so finding the changed words takes a time proportional to the number of pages
+    written, not to the size of the memory.
+    '''
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.update()
+
+    def update(self):
+        '''Remember the current state, the next changes are relative to it'''
+        cpu = self.cpu
+        self.r = list(cpu.r)
+        self.flags = cpu.flags
+        self.state = [getattr(cpu, field) for field in STATE_FIELDS.values()]
+        self.pages = cpu.mem.snapshot()
+
+    def changes(self):
+        '''Format the registers, flags, memory words and internal registers that changed since the last
+        update, the state displayed becomes the current one
+
+        Returns:
+            The changed lines, under the header of their section, or a line saying nothing changed
+        '''
+        cpu = self.cpu
+        regs = [i for (i, val) in enumerate(cpu.r) if val != self.r[i]]
+        flags = [name for (name, bit) in FLAG_NAMES.items() if (cpu.flags ^ self.flags) & bit]
+        state = [name for (name, field), val in zip(STATE_FIELDS.items(), self.state) if getattr(cpu, field) != val]
+
+        old = self.pages
+        pages = cpu.mem.snapshot()
+        adrs = []
+        for (page, words) in enumerate(pages):
+            if words is old[page] or words == old[page]:
+                continue
+            (before, after) = (array('h'), array('h'))
+            before.frombytes(old[page])
+            after.frombytes(words)
+            start = page << PAGE_BITS
+            adrs.extend(start + i for (i, word) in enumerate(after) if word != before[i])
+
+        self.update()
+
+        out = []
+        if regs:
+            out.append(REG_HEADER)
+            out.extend(cpu._regLines(regs))
+        if flags:
+            out.append(FLAG_HEADER)
+            out.extend(cpu._flagLines(flags))
+        if adrs:
+            out.append(MEM_HEADER)
+            out.extend(cpu._memLines(adrs))
+        if state:
+            out.append(STATE_HEADER)
+            out.extend(cpu._internalStateLines(state))
+
+        return ''.join(out) if out else 'No changes since the last display\n'
+
+
 class Debugger(object):
     """The Debugger allows the user to step through the micro-code"""
-    def __init__(self, seq):
+    def __init__(self, seq, labels=None, record=False):
         """ Instantiate the Debugger class
 
         Args:
             seq - the seq that should be run
+            labels - the labels of the program (eg: Assembler.lblToAddr), usable in breakpoints
+            record - start recording the execution right away, see startRecording
         """
         super(Debugger, self).__init__()
         self.seq = seq
@@ -15,53 +92,209 @@ class Debugger(object):
             'stop': ['q', 'quit', 'exit', 'stop'],
             'continue': ['c', 'continue', 'cont', 'run'],
             'step': ['s', 'step'],
-            'display cpu state': ['d', 'display', 'p', 'print'],
-            'display memory': ['m', 'mem', 'memory'],
+            'display changes': ['d', 'display', 'p', 'print'],
+            'display cpu state': ['a', 'all'],
+            'display memory [ADR [COUNT]]': ['m', 'mem', 'memory'],
             'display flags': ['f', 'flags', 'flag'],
             'display registers': ['r', 'reg', 'registers'],
             'display help': ['h', 'help'],
             'display internal state': ['i', 'internal'],
+            'break at ADR or LABEL': ['b', 'break'],
+            'break at MPM ADR or LABEL': ['mb', 'mbreak'],
+            'watch writes to ADR, LABEL or Rn': ['w', 'watch'],
+            'watch reads of ADR, LABEL or Rn': ['rw', 'rwatch'],
+            'watch reads of and writes to ADR, LABEL or Rn': ['aw', 'awatch'],
+            'delete all breakpoints, or [COMMAND ARG] the one set by COMMAND ARG': ['del', 'delete'],
+            'list breakpoints': ['l', 'list'],
+            'record the execution from now on, to be able to go back': ['rec', 'record'],
+            'reverse step [COUNT]': ['rs', 'rstep'],
+            'reverse continue': ['rc', 'rcontinue'],
         }
+        self.history = History(seq)
+        self.breakpoints = Breakpoints(seq, labels)
+        if record:
+            self.startRecording()
+        self.view = StateView(seq.cpu)
+        self.memWindow = (0, MEM_WINDOW) # the start and size of the memory window displayed next
+
+    def startRecording(self):
+        '''Attach the history, so the execution can go back to any cycle executed from now on
+
+        Until then the sequencer runs without it, recording costs a wrapper around every micro-cycle and
+        a checkpoint every History.interval cycles.
+        '''
+        if self.history.attached:
+            return
+
+        # the history counts the cycles interrupted by the breakpoints only if it is attached under their hooks
+        self.breakpoints._detach()
+        self.history.attach()
+        self.breakpoints._update()
+
+    def ended(self):
+        '''Format the message shown when the program ends'''
+        if self.history.attached:
+            return ENDED_RECORDING.format(self.history.cycle)
+
+        return ENDED
 
     def getHelp(self):
         '''Display a list of available commands'''
-        cmds = ''
-        for k, v in self.actions.items():
-            cmds += '{}: {}\n'.format(k, ', '.join(v))
-        return 'Available commands:\n{}'.format(cmds)
+        cmds = ['{}: {}\n'.format(k, ', '.join(v)) for k, v in self.actions.items()]
+        return 'Available commands:\n{}'.format(''.join(cmds))
+
+    def showMem(self, args):
+        '''Display a window of the memory
+
+        Args:
+            args - the start address and the number of words, both optional (in any base Python accepts,
+                eg: 0x100); without arguments the window after the previous one is displayed, the
+                number of words is kept from the previous window
+
+        Returns:
+            The formatted words
+        '''
+        (start, count) = self.memWindow
+        if args:
+            start = int(args[0], 0)
+        if len(args) > 1:
+            count = int(args[1], 0)
+        if start < 0 or count <= 0:
+            raise ValueError('Negative address or count')
+
+        size = len(self.seq.cpu.mem)
+        if start >= size:
+            start = 0
+        self.memWindow = (start + count, count)
+
+        return self.seq.cpu._memToStr(start, count)
+
+    def _breakpointKinds(self, action, where):
+        '''Get the kinds of breakpoints (see breakpoints.KINDS) set by a command'''
+        register = re.match(r'[rR]\d+$', where) is not None
+        if action in self.actions['break at ADR or LABEL']:
+            return [PC]
+        if action in self.actions['break at MPM ADR or LABEL']:
+            return [MPM]
+        if action in self.actions['watch writes to ADR, LABEL or Rn']:
+            return [REG_WRITE if register else WRITE]
+        if action in self.actions['watch reads of ADR, LABEL or Rn']:
+            return [REG_READ if register else READ]
+        if action in self.actions['watch reads of and writes to ADR, LABEL or Rn']:
+            return [REG_READ, REG_WRITE] if register else [READ, WRITE]
+
+        raise ValueError('Unknown breakpoint command: {}'.format(action))
+
+    def setBreakpoint(self, action, args, remove=False):
+        '''Set (or remove) the breakpoints given by a command and its argument
+
+        Returns:
+            A message for the user
+        '''
+        if len(args) != 1:
+            return 'One address, label or register expected'
+
+        try:
+            for kind in self._breakpointKinds(action, args[0]):
+                if remove:
+                    self.breakpoints.remove(kind, args[0])
+                else:
+                    self.breakpoints.add(kind, args[0])
+        except ValueError as e:
+            return 'Invalid breakpoint {}: {}'.format(args[0], e)
+
+        return 'Deleted' if remove else 'Set'
+
+    def listBreakpoints(self):
+        '''Format the breakpoints that are set, a line for each one'''
+        lines = ['{} 0x{:04X}\n'.format(kind, adr) for (kind, points) in sorted(self.breakpoints.points.items())
+            for adr in sorted(points)]
+
+        return ''.join(lines) if lines else 'No breakpoints\n'
+
+    def showHits(self):
+        '''Format the breakpoints hit last'''
+        return ''.join('Hit {} 0x{:04X}\n'.format(kind, adr) for (kind, adr) in self.breakpoints.hits)
 
     def attach(self):
         '''Start the seq by attaching the debugger'''
 
         action = self.actions['step'][0]
         print(self.getHelp())
-        try:
-            while action not in self.actions['stop']:
-                last_action = action
-                action = input('> ')
-
-                if action == '':
-                    action = last_action
-
-                if action in self.actions['continue']:
-                    while True:
-                        self.seq.execMicroInstr()
-                elif action in self.actions['step']:
-                    self.seq.execMicroInstr()
-                elif action in self.actions['display cpu state']:
-                    print(self.seq.showCpu())
-                elif action in self.actions['display memory']:
-                    print(self.seq.showMem())
-                elif action in self.actions['display flags']:
-                    print(self.seq.showFlags())
-                elif action in self.actions['display registers']:
-                    print(self.seq.showReg())
-                elif action in self.actions['display help']:
-                    print(self.getHelp())
-                elif action in self.actions['display internal state']:
-                    print(self.seq.showInternalState())
-                elif action not in self.actions['stop']:
-                    print('Unknown action, use "h" to get help, "q" to quit')
-
-        except ExecEnd:
-            print(self.seq.showCpu())
+        while action not in self.actions['stop']:
+            last_action = action
+            try:
+                line = input('> ').split()
+            except EOFError:
+                break
+
+            if line:
+                (action, args) = (line[0], line[1:])
+            else:
+                (action, args) = (last_action, [])
+
+            if action in self.actions['continue']:
+                result = self.breakpoints.run()
+                if result.reason == StopReason.END:
+                    print(self.view.changes())
+                    print(self.ended())
+                    continue
+                print('Stopped: {} after {} micro-cycles'.format(result.reason.value, result.cycles))
+                if result.reason in (StopReason.PC, StopReason.BREAKPOINT, StopReason.WATCHPOINT):
+                    print(self.showHits())
+            elif action in self.actions['step']:
+                try:
+                    if self.breakpoints.step() is not None:
+                        print(self.showHits())
+                except ExecEnd:
+                    print(self.view.changes())
+                    print(self.ended())
+            elif action in self.actions['record the execution from now on, to be able to go back']:
+                self.startRecording()
+                print('Recording, the cycles are counted from here')
+            elif action in self.actions['reverse step [COUNT]']:
+                if not self.history.attached:
+                    print(NOT_RECORDING)
+                    continue
+                try:
+                    count = int(args[0], 0) if args else 1
+                except ValueError:
+                    print('Invalid count: {}'.format(args[0]))
+                    continue
+                print('At cycle {}'.format(self.history.reverseStep(count)))
+            elif action in self.actions['reverse continue']:
+                if not self.history.attached:
+                    print(NOT_RECORDING)
+                    continue
+                print('At cycle {}'.format(self.history.reverseContinue(self.breakpoints)))
+                if self.breakpoints.hits:
+                    print(self.showHits())
+            elif action in self.actions['display changes']:
+                print(self.view.changes())
+            elif action in self.actions['display cpu state']:
+                self.view.update()
+                print(self.seq.showCpu())
+            elif action in self.actions['display memory [ADR [COUNT]]']:
+                try:
+                    print(self.showMem(args))
+                except ValueError:
+                    print('Invalid address or count: {}'.format(' '.join(args)))
+            elif action in self.actions['display flags']:
+                print(self.seq.showFlags())
+            elif action in self.actions['display registers']:
+                print(self.seq.showReg())
+            elif action in self.actions['display help']:
+                print(self.getHelp())
+            elif action in self.actions['display internal state']:
+                print(self.seq.showInternalState())
+            elif action in self.actions['delete all breakpoints, or [COMMAND ARG] the one set by COMMAND ARG']:
+                if args:
+                    print(self.setBreakpoint(args[0], args[1:], remove=True))
+                else:
+                    self.breakpoints.clear()
+            elif action in self.actions['list breakpoints']:
+                print(self.listBreakpoints())
+            elif any(action in self.actions[key] for key in self.actions if key.startswith(('break', 'watch'))):
+                print(self.setBreakpoint(action, args))
+            elif action not in self.actions['stop']:
+                print('Unknown action, use "h" to get help, "q" to quit')
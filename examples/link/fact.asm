@@ -0,0 +1,22 @@
+;--------------------------------------------------------------------------------
+; FACT: R2 <- R1!, for R1 up to 8
+;--------------------------------------------------------------------------------
+.include "stack.inc"
+.global FACT
+
+FACT:
+	cmp	r1,1
+	bcs	INIT		; r1 < 1 (unsigned)
+	beq	INIT
+	SAVE	r3, r4
+	mov	r3,r1
+	dec	r1
+	call	FACT		; (k-1)!
+	mov	r4,r2
+	call	MUL		; k*(k-1)!, MUL is defined in mul.asm
+	mov	r2,r6
+	RESTORE	r3, r4
+	ret
+INIT:
+	mov	r2,1
+	ret
@@ -0,0 +1,16 @@
+;################################################################################
+;####	Factorial, linked from three modules:
+;####	./link.py -o factorial.obj examples/link/main.asm examples/link/fact.asm examples/link/mul.asm
+;################################################################################
+.code
+	mov	r5,N		; the labels are addresses
+	mov	r1,(r5)
+	call	FACT		; FACT is defined in fact.asm
+	mov	r5,RESULT
+	mov	(r5),r2
+	jmp	EXIT		; the program ends after its data
+
+.data
+N:	dw	6
+RESULT:	dw	0
+EXIT:				; the end of the program, the other modules have no data
@@ -0,0 +1,17 @@
+;--------------------------------------------------------------------------------
+; MUL: R6 <- R3*R4, the product must fit in 16 bits
+;--------------------------------------------------------------------------------
+.include "stack.inc"
+.global MUL
+
+MUL:
+	SAVE	r4, r5
+	mov	r6,0
+	cmp	r4,0
+	beq	DONE
+REP:	add	r6,r3
+	dec	r4
+	bne	REP
+DONE:
+	RESTORE	r4, r5
+	ret
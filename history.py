@@ -0,0 +1,185 @@
+from seq import Breakpoint, StopReason, instanceOverride
+from snapshot import Snapshot
+
+from bisect import bisect_left, bisect_right
+
+# the approximate size (in bytes) of a checkpoint, besides its memory pages
+CHECKPOINT_SIZE = 512
+
+class History(object):
+    '''Brings a Seq back to any micro-cycle it executed, through periodic checkpoints
+
+    While attached, the micro-cycles executed by the sequencer are counted and a Snapshot is taken every
+    interval cycles. Going back to a cycle restores the last checkpoint before it and executes the
+    microprogram again up to it, which gives the same state since the execution is deterministic, so
+    it takes a time proportional to the interval, not to the length of the run.
+
+    The checkpoints share the memory pages that were not written between them (see Memory.snapshot).
+    When they take more than the budget, the checkpoints closest to their neighbours are evicted, the
+    oldest first, so the old parts of the history get sparser (slower to go back to) while the first
+    and the last checkpoints are always kept.
+
+    Attach the history before anything else that replaces the sequencer's execMicroInstr (eg:
+    Breakpoints), in order to count the micro-cycles interrupted by them.
+    '''
+    def __init__(self, seq, interval=1000, budget=16 << 20):
+        '''Init the history of a Seq, nothing is recorded until attach is called
+
+        Args:
+            seq - the Seq to record
+            interval - the number of micro-cycles between two checkpoints
+            budget - the memory (in bytes) the checkpoints may take, approximately
+        '''
+        self.seq = seq
+        self.interval = interval
+        self.budget = budget
+        self.cycle = 0 # the micro-cycles executed since attach
+        self.cycles = [] # the cycle of every checkpoint, increasing
+        self.checkpoints = [] # the Snapshot taken at every cycle in cycles
+        self.size = 0 # the memory taken by the checkpoints, approximately
+        self.nextCheckpoint = 0 # the cycle of the next checkpoint
+        self._pages = {} # id of a memory page -> [the page, the number of checkpoints holding it]
+        self.attached = False
+
+    def attach(self):
+        '''Start recording, a checkpoint of the current state is taken'''
+        if self.attached:
+            return
+
+        seq = self.seq
+        history = self
+        execMicroInstr = seq.execMicroInstr
+
+        def countedExecMicroInstr():
+            if history.cycle >= history.nextCheckpoint:
+                history.checkpoint()
+            execMicroInstr()
+            history.cycle += 1
+
+        self._execMicroInstr = instanceOverride(seq, 'execMicroInstr')
+        seq.execMicroInstr = countedExecMicroInstr
+        self.nextCheckpoint = self.cycle
+        self.checkpoint()
+        self.attached = True
+
+    def detach(self):
+        '''Stop recording, the checkpoints are kept'''
+        if not self.attached:
+            return
+
+        if self._execMicroInstr is None:
+            del self.seq.execMicroInstr
+        else:
+            self.seq.execMicroInstr = self._execMicroInstr
+        self.attached = False
+
+    def checkpoint(self):
+        '''Take a checkpoint of the current state, unless there is one for the current cycle'''
+        i = bisect_right(self.cycles, self.cycle)
+        if i == 0 or self.cycles[i - 1] != self.cycle:
+            snapshot = Snapshot(self.seq)
+            self.cycles.insert(i, self.cycle)
+            self.checkpoints.insert(i, snapshot)
+            self._hold(snapshot, 1)
+            while self.size > self.budget and len(self.cycles) > 2:
+                self._evict()
+
+        self.nextCheckpoint = self.cycle + self.interval
+
+    def goTo(self, cycle):
+        '''Bring the sequencer back to the state it had after the given number of micro-cycles
+
+        Raises:
+            ValueError - if the history is not attached, or the cycle is before the first
+                checkpoint or after the current cycle
+        '''
+        if not self.attached:
+            raise ValueError('The history is not attached')
+        if not self.cycles[0] <= cycle <= self.cycle:
+            raise ValueError('Cycle {} is not in the history'.format(cycle))
+
+        self._restore(bisect_right(self.cycles, cycle) - 1)
+
+        # through the hooks of the sequencer, so they see every cycle (the cycles are counted by attach)
+        execMicroInstr = self.seq.execMicroInstr
+        while self.cycle < cycle:
+            try:
+                execMicroInstr()
+            except Breakpoint:
+                pass
+
+    def reverseStep(self, count=1):
+        '''Go back count micro-cycles (at most to the first checkpoint)
+
+        Returns:
+            The cycle reached
+        '''
+        self.goTo(max(self.cycle - count, self.cycles[0]))
+
+        return self.cycle
+
+    def reverseContinue(self, breakpoints):
+        '''Go back to the last cycle, before the current one, where a forward run would have stopped
+        at one of the breakpoints (or to the first checkpoint, if there is no such cycle)
+
+        The intervals between the checkpoints are executed again, the last one first, until a
+        breakpoint is hit in one of them.
+
+        Args:
+            breakpoints - a Breakpoints of the sequencer, its hits are set to the ones at the cycle reached
+
+        Returns:
+            The cycle reached
+        '''
+        now = self.cycle
+        end = now
+        for i in range(bisect_left(self.cycles, now) - 1, -1, -1):
+            self._restore(i)
+            stops = []
+            while self.cycle < end:
+                result = breakpoints.run(maxCycles=end - self.cycle, stopOnHalt=False)
+                if result.reason not in (StopReason.PC, StopReason.BREAKPOINT, StopReason.WATCHPOINT):
+                    break
+                if self.cycle < now:
+                    stops.append((self.cycle, list(breakpoints.hits)))
+
+            if stops:
+                (cycle, hits) = stops[-1]
+                self.goTo(cycle)
+                breakpoints.hits = hits
+                return cycle
+            end = self.cycles[i]
+
+        self.goTo(self.cycles[0])
+        breakpoints.hits = []
+
+        return self.cycle
+
+    def _restore(self, i):
+        '''Restore the i-th checkpoint'''
+        self.checkpoints[i].restore(self.seq)
+        self.cycle = self.cycles[i]
+        self.nextCheckpoint = self.cycle + self.interval
+
+    def _hold(self, snapshot, count):
+        '''Account for a checkpoint that is added (count 1) or evicted (count -1)'''
+        self.size += count * CHECKPOINT_SIZE
+        for page in snapshot.mem:
+            entry = self._pages.get(id(page))
+            if entry is None:
+                self._pages[id(page)] = [page, 1]
+                self.size += len(page)
+            else:
+                entry[1] += count
+                if entry[1] == 0:
+                    del self._pages[id(page)]
+                    self.size -= len(page)
+
+    def _evict(self):
+        '''Remove the checkpoint closest to its neighbours (the oldest one if there are more),
+        other than the first and the last one'''
+        cycles = self.cycles
+        i = min(range(1, len(cycles) - 1), key=lambda i: cycles[i + 1] - cycles[i - 1])
+        self._hold(self.checkpoints[i], -1)
+        del cycles[i]
+        del self.checkpoints[i]
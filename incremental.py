@@ -0,0 +1,243 @@
+from asm import Assembler, ParseError
+from instr import InvalidInstruction
+from seq import toWord
+
+from collections import namedtuple
+
+class Patch(namedtuple('Patch', ['runs', 'size'])):
+    '''The words changed by an AsmSession edit
+
+    runs is a list of (address, words), sorted by address, with the words that differ from the
+    program before the edit (the words past its end are always included); size is the length of the
+    program after the edit. If the program got shorter, the words it doesn't use anymore are zeroed.
+    '''
+    __slots__ = ()
+
+    def apply(self, mem):
+        '''Write the changed words to a memory (eg: Cpu.mem, which must be large enough for size words)'''
+        for (adr, words) in self.runs:
+            for (i, word) in enumerate(words, adr):
+                mem[i] = toWord(word)
+
+    def wordCount(self):
+        '''Get the number of words in the patch'''
+        return sum(len(words) for (adr, words) in self.runs)
+
+
+class Line(object):
+    '''A line of the source, as kept by AsmSession'''
+    __slots__ = ['label', 'tokens', 'refs', 'adr', 'words', 'error']
+
+    def __init__(self, label, tokens):
+        self.label = label # the label defined by the line, or None
+        self.tokens = tokens # the tokenized instruction, None if there is no instruction on the line
+        self.refs = set(tokens[1:]) if tokens else set() # the operands, any of them may be a label
+        self.adr = None # the address of the instruction, or of the next one if there is none on the line
+        self.words = [] # the encoded instruction
+        self.error = None # why the instruction cannot be encoded with the current labels, see AsmSession.check
+
+
+class AsmSession(object):
+    '''An assembled program that can be edited one line at a time
+
+    The session keeps the tokenized lines, the encoded instruction and the address of every line, the
+    labels and, for every operand, the lines that use it. An edit only encodes the new lines, moves the
+    lines after them only if their size changed, and encodes again only the lines that use a label whose
+    address changed, so editing a line without changing its size takes the same time for any program.
+
+    Every edit returns the Patch that turns the previous program into the new one.
+
+    The only directives allowed are .code and .data, and the lines of a data section are not moved after
+    the code, as the Assembler does.
+    '''
+    def __init__(self, lines=()):
+        '''Assemble the given source lines
+
+        Raises:
+            ParseError - if a line cannot be parsed, see edit
+        '''
+        self.lines = [] # list of Line, one for every source line
+        self.lblToAddr = {}
+        self.words = [] # the assembled program
+        self._asm = Assembler() # parses and encodes the lines, with the labels of the session
+        self._asm.lblToAddr = self.lblToAddr
+        self._labelLines = {} # label -> the Line defining it
+        self._users = {} # operand -> the Lines using it
+
+        self.edit(0, 0, lines)
+
+    def edit(self, start, end, lines):
+        '''Replace the source lines [start, end) (0 based, like a slice) with the given lines
+
+        Nothing changes if one of the new lines is invalid or defines a label that is already defined,
+        the errors that depend on the addresses of the labels (eg: a label that is not defined anymore,
+        a branch too far away) are reported by check.
+
+        Returns:
+            The Patch from the previous program to the new one
+
+        Raises:
+            ParseError, InvalidInstruction - if a new line cannot be parsed or encoded
+        '''
+        new = []
+        for text in lines:
+            (label, tokens) = self._asm._splitLine(text)
+            if tokens is not None and tokens[0][:1] == '.':
+                if label is not None or len(tokens) > 1 or tokens[0].lower() not in ('.code', '.data'):
+                    raise ParseError('Directive not supported by AsmSession: ' + text.strip())
+                tokens = None
+            line = Line(label, tokens)
+            if line.tokens is not None:
+                self._encodeWithoutLabels(line.tokens) # the syntax doesn't depend on the labels
+            new.append(line)
+
+        removed = self.lines[start:end]
+        removedLabels = set(line.label for line in removed)
+        defined = set()
+        for line in new:
+            if line.label is None:
+                continue
+            if line.label in defined or (line.label in self._labelLines and line.label not in removedLabels):
+                raise ParseError('Label {} is defined more than once'.format(line.label))
+            defined.add(line.label)
+
+        startAdr = self.lines[start].adr if start < len(self.lines) else len(self.words)
+        moved = set() # the labels whose address changed
+
+        for line in removed:
+            for operand in line.refs:
+                users = self._users[operand]
+                users.discard(line)
+                if not users:
+                    del self._users[operand]
+            if line.label is not None:
+                del self._labelLines[line.label]
+                del self.lblToAddr[line.label]
+                moved.add(line.label)
+
+        self.lines[start:end] = new
+        for line in new:
+            for operand in line.refs:
+                self._users.setdefault(operand, set()).add(line)
+            if line.label is not None:
+                self._labelLines[line.label] = line
+            if line.tokens is not None:
+                line.words = self._encode(line)
+
+        changed = set(new) # the lines that were encoded again or moved
+        moved |= self._layout(start, startAdr, start + len(new), changed)
+
+        while moved:
+            users = set()
+            for label in moved:
+                users |= self._users.get(label, set())
+            moved = set()
+
+            for line in users:
+                size = len(line.words)
+                line.words = self._encode(line)
+                changed.add(line)
+                if len(line.words) != size: # eg: a label named like a register was removed
+                    index = self.lines.index(line)
+                    moved |= self._layout(index, line.adr, index + 1, changed)
+
+        return self._patch(changed)
+
+    def setLine(self, index, line):
+        '''Replace a source line (0 based), see edit'''
+        return self.edit(index, index + 1, [line])
+
+    def check(self):
+        '''Report the first line (by address) that cannot be encoded with the current labels
+
+        Raises:
+            ParseError, InvalidInstruction - the error of the line, eg: the same ParseError that
+                Assembler.parse raises for a label that is not defined
+        '''
+        errors = [line for line in self.lines if line.error is not None]
+        if errors:
+            raise min(errors, key=lambda line: line.adr).error
+
+    def adrToLine(self):
+        '''Get the address of every instruction -> its line number (from 1), see Assembler.adrToLine'''
+        return {line.adr: i for (i, line) in enumerate(self.lines, 1) if line.tokens is not None}
+
+    def _encodeWithoutLabels(self, tokens):
+        '''Encode an instruction as if no label was defined, the labels are encoded as 0'''
+        self._asm.lblToAddr = {}
+        try:
+            return self._asm._encode(tokens)
+        finally:
+            self._asm.lblToAddr = self.lblToAddr
+
+    def _encode(self, line):
+        '''Encode the instruction on a line with the current labels, sets line.error
+
+        Returns:
+            The words of the instruction; if it cannot be encoded with the current labels, the words
+            it has without them, so that it keeps its size
+        '''
+        try:
+            words = self._asm._encode(line.tokens)
+        except (ParseError, InvalidInstruction) as e:
+            line.error = e
+            return self._encodeWithoutLabels(line.tokens)
+
+        unresolved = self._asm._unresolved
+        line.error = unresolved[0][1] if unresolved else None
+
+        return words
+
+    def _layout(self, index, adr, end, changed):
+        '''Give addresses to the lines from lines[index], which starts at adr
+
+        The lines before end are always laid out, the ones after it only until one of them
+        is already at its address, then all the following ones are too.
+
+        Args:
+            changed - the set of the moved lines, it is updated
+
+        Returns:
+            The set of the labels whose address changed
+        '''
+        moved = set()
+        for i in range(index, len(self.lines)):
+            line = self.lines[i]
+            if i >= end and line.adr == adr:
+                break
+            if line.adr != adr:
+                line.adr = adr
+                changed.add(line)
+                if line.label is not None:
+                    self.lblToAddr[line.label] = adr
+                    moved.add(line.label)
+            adr += len(line.words)
+
+        return moved
+
+    def _patch(self, changed):
+        '''Update the program with the changed lines and get the Patch to it'''
+        oldSize = len(self.words)
+        size = self.lines[-1].adr + len(self.lines[-1].words) if self.lines else 0
+        if size > oldSize:
+            self.words.extend([0] * (size - oldSize))
+
+        runs = []
+        for line in sorted(changed, key=lambda line: line.adr):
+            for (adr, word) in enumerate(line.words, line.adr):
+                if adr < oldSize and self.words[adr] == word:
+                    continue
+                self.words[adr] = word
+                if runs and runs[-1][0] + len(runs[-1][1]) == adr:
+                    runs[-1][1].append(word)
+                else:
+                    runs.append((adr, [word]))
+
+        if size < oldSize:
+            if runs and runs[-1][0] + len(runs[-1][1]) == size:
+                runs[-1][1].extend([0] * (oldSize - size))
+            else:
+                runs.append((size, [0] * (oldSize - size)))
+            del self.words[size:]
+
+        return Patch(runs, size)
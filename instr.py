@@ -1,4 +1,5 @@
 from enum import IntEnum, unique
+from collections import namedtuple
 import pdb
 
 class InvalidInstruction(Exception):
@@ -88,6 +89,116 @@ def getBrOffset(ir):
     return ir & 0xFF
 
 
+def getInstrSize(ir):
+    '''Get the number of words an instruction takes in memory (the instruction word
+    plus the immediate values and the indexes)'''
+    group = getOpcodeGroup(getOpcode(ir))
+    size = 1
+
+    if group == Group.TWO_OP:
+        if getMas(ir) in (AddrMode.IMMEDIATE, AddrMode.INDEXED):
+            size += 1
+        if getMad(ir) in (AddrMode.IMMEDIATE, AddrMode.INDEXED):
+            size += 1
+    elif group == Group.ONE_OP:
+        if getMad(ir) in (AddrMode.IMMEDIATE, AddrMode.INDEXED):
+            size += 1
+
+    return size
+
+
+# An instruction with all of its fields decoded, the fields are extracted
+# whatever the group is, the same way the CPU does
+Decoded = namedtuple('Decoded', ['opcode', 'group', 'mas', 'mad', 'rs', 'rd', 'offset', 'size'])
+
+DECODE_CACHE_SIZE = 2 ** 16
+_decodeCache = [None] * DECODE_CACHE_SIZE
+
+
+def _decode(ir):
+    opcode = getOpcode(ir)
+    return Decoded(opcode, getOpcodeGroup(opcode), getMas(ir), getMad(ir), getRs(ir), getRd(ir),
+        getBrOffset(ir), getInstrSize(ir))
+
+
+def decode(ir):
+    '''Decode an instruction, every 16 bit instruction is decoded only once
+
+    Args:
+        ir - the instruction word
+
+    Returns:
+        The Decoded instruction
+
+    Raises:
+        ValueError - if ir is not a valid instruction
+    '''
+    if 0 <= ir < DECODE_CACHE_SIZE:
+        rval = _decodeCache[ir]
+        if rval is None:
+            rval = _decodeCache[ir] = _decode(ir)
+        return rval
+
+    return _decode(ir)
+
+
+def fillDecodeCache():
+    '''Decode every valid 16 bit instruction ahead of time'''
+    for ir in range(DECODE_CACHE_SIZE):
+        if _decodeCache[ir] is None:
+            try:
+                _decodeCache[ir] = _decode(ir)
+            except ValueError:
+                pass
+
+
+def _operandToStr(mode, r, words):
+    '''Format an operand in assembly syntax, words holds the word that follows the instruction
+    (if the addressing mode needs one)'''
+    if mode == AddrMode.IMMEDIATE:
+        return '0x{:X}'.format(words[0])
+    elif mode == AddrMode.DIRECT:
+        return 'R{}'.format(r)
+    elif mode == AddrMode.INDIRECT:
+        return '(R{})'.format(r)
+
+    return '(R{}){}'.format(r, words[0])
+
+
+def disassemble(words, adr=0):
+    '''Disassemble the instruction found at adr
+
+    Args:
+        words - the memory (or the list of encoded words) holding the instruction
+        adr - the address of the instruction in words
+
+    Returns:
+        A tuple (text, size), text is the instruction in assembly syntax and size the
+        number of words it takes
+
+    Raises:
+        ValueError - if the word at adr is not a valid instruction
+    '''
+    d = decode(words[adr])
+    name = d.opcode.name
+    extra = list(words[adr + 1:adr + d.size])
+
+    if d.group == Group.TWO_OP:
+        # the source's word comes first, but the destination is written first
+        src_words = extra if d.mas in (AddrMode.IMMEDIATE, AddrMode.INDEXED) else []
+        dst_words = extra[len(src_words):]
+        text = '{} {}, {}'.format(name, _operandToStr(d.mad, d.rd, dst_words),
+            _operandToStr(d.mas, d.rs, src_words))
+    elif d.group == Group.ONE_OP:
+        text = '{} {}'.format(name, _operandToStr(d.mad, d.rd, extra))
+    elif d.group == Group.BRANCH:
+        text = '{} 0x{:X}'.format(name, d.offset)
+    else:
+        text = name
+
+    return (text, d.size)
+
+
 def checkRegister(r, opcode):
     if r >= 16:
         raise InvalidInstruction('Valid register values: R0-R15, given {} to {}'
@@ -178,30 +289,7 @@ def encode_two_op(opcode, mad, rd, mas, rs, offsetd=0, offsets=0):
     Returns:
         The encoded instruction
     '''
-    valid_addr_modes = [
-        #(SRC, DST)
-
-        #(IMM, REG)
-        (AddrMode.IMMEDIATE, AddrMode.DIRECT),
-        #(IMM, MEM)
-        (AddrMode.IMMEDIATE, AddrMode.INDIRECT),
-        (AddrMode.IMMEDIATE, AddrMode.INDEXED),
-        #(REG, REG)
-        (AddrMode.DIRECT, AddrMode.DIRECT),
-        #(REG, MEM)
-        (AddrMode.DIRECT, AddrMode.INDIRECT),
-        (AddrMode.DIRECT, AddrMode.INDEXED),
-        #(MEM, REG)
-        (AddrMode.INDIRECT, AddrMode.DIRECT),
-        (AddrMode.INDEXED, AddrMode.DIRECT),
-        #(MEM, MEM)
-        (AddrMode.INDIRECT, AddrMode.INDIRECT),
-        (AddrMode.INDIRECT, AddrMode.INDEXED),
-        (AddrMode.INDEXED, AddrMode.INDEXED),
-        (AddrMode.INDEXED, AddrMode.INDIRECT),
-    ]
-
-    if (mas, mad) not in valid_addr_modes:
+    if (mas, mad) not in VALID_TWO_OP_MODES:
         raise InvalidInstruction('Invalid addressing modes, source: {}, destination: {}, op: {}'
             .format(mas.name, mad.name, opcode.name))
 
@@ -229,6 +317,31 @@ class AddrMode(IntEnum):
     INDEXED = 0b11
 
 
+# the (source, destination) addressing modes accepted by the TWO_OP instructions
+VALID_TWO_OP_MODES = frozenset([
+    #(SRC, DST)
+
+    #(IMM, REG)
+    (AddrMode.IMMEDIATE, AddrMode.DIRECT),
+    #(IMM, MEM)
+    (AddrMode.IMMEDIATE, AddrMode.INDIRECT),
+    (AddrMode.IMMEDIATE, AddrMode.INDEXED),
+    #(REG, REG)
+    (AddrMode.DIRECT, AddrMode.DIRECT),
+    #(REG, MEM)
+    (AddrMode.DIRECT, AddrMode.INDIRECT),
+    (AddrMode.DIRECT, AddrMode.INDEXED),
+    #(MEM, REG)
+    (AddrMode.INDIRECT, AddrMode.DIRECT),
+    (AddrMode.INDEXED, AddrMode.DIRECT),
+    #(MEM, MEM)
+    (AddrMode.INDIRECT, AddrMode.INDIRECT),
+    (AddrMode.INDIRECT, AddrMode.INDEXED),
+    (AddrMode.INDEXED, AddrMode.INDEXED),
+    (AddrMode.INDEXED, AddrMode.INDIRECT),
+])
+
+
 @unique
 class Group(IntEnum):
     TWO_OP = 0x0
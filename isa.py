@@ -0,0 +1,424 @@
+from instr import *
+from uinstr import MPM, MPM_LABELS
+from seq import ExecEnd, StackOverflow, StopReason, RunResult, toWord, WORD_MASK, buildNoMicroroutineTable
+from memory import ADDRESS_MASK
+
+import time
+
+# IR -> 1 if the instruction's microroutine is not written yet, Seq.run stops before fetching them
+NO_MICROROUTINE = buildNoMicroroutineTable(MPM, MPM_LABELS)
+
+class IsaEngine(object):
+    '''Executes whole instructions straight from their encoding, without going
+    through the microprogram memory
+
+    The architectural state (registers, memory, flags, PC, SP) and the internal
+    registers (IR, ADR, MDR, T) are left exactly as Seq.run (with stopOnHalt=False)
+    leaves them at the end of every instruction, quirks included, and where it stops.
+    Interrupts are not modeled.
+    '''
+    def __init__(self, cpu):
+        '''Init the engine for the given CPU
+
+        Args:
+            cpu - the Cpu whose state will be modified by the executed instructions
+        '''
+        self.cpu = cpu
+
+        # addressing mode (as number) -> operand fetch
+        self.srcFetch = [self._srcImmediate, self._srcDirect, self._srcIndirect, self._srcIndexed]
+        self.dstFetch = [self._dstImmediate, self._dstDirect, self._dstIndirect, self._dstIndexed]
+
+        # instructions whose microroutine is implemented in the MPM
+        self.handlers = {
+            OpCode.MOV: self._mov,
+            OpCode.ADD: self._add,
+            OpCode.SUB: self._sub,
+            OpCode.CMP: self._cmp,
+            OpCode.AND: self._and,
+            OpCode.OR: self._or,
+            OpCode.XOR: self._xor,
+            OpCode.CLR: self._clr,
+            OpCode.NEG: self._neg,
+            OpCode.INC: self._inc,
+            OpCode.DEC: self._dec,
+            OpCode.ASL: self._asl,
+            OpCode.ASR: self._asr,
+            OpCode.JMP: self._jmp,
+            OpCode.CALL: self._call,
+            OpCode.PUSH: self._push,
+            OpCode.POP: self._pop,
+            OpCode.BR: self._br,
+            OpCode.BNE: self._bne,
+            OpCode.BEQ: self._beq,
+            OpCode.BPL: self._bpl,
+            OpCode.BMI: self._bmi,
+            OpCode.BCS: self._bcs,
+            OpCode.BCC: self._bcc,
+            OpCode.BVS: self._bvs,
+            OpCode.BVC: self._bvc,
+            OpCode.CLC: self._clc,
+            # the MPM clears the overflow flag for CLZ and CLS too
+            OpCode.CLV: self._clv,
+            OpCode.CLZ: self._clv,
+            OpCode.CLS: self._clv,
+            OpCode.CCC: self._ccc,
+            OpCode.SEC: self._sec,
+            OpCode.SEV: self._sev,
+            OpCode.SEZ: self._sez,
+            OpCode.SES: self._ses,
+            OpCode.SCC: self._scc,
+            OpCode.NOP: self._nop,
+            OpCode.RET: self._ret,
+        }
+
+    def _fetch(self):
+        '''Fetch the instruction pointed by PC into IR
+
+        Raises:
+            ExecEnd - when PC left the code
+            InvalidInstruction - when the instruction's microroutine is not written yet
+
+            In both cases nothing is changed, as Seq.run stops before the instruction fetch
+        '''
+        cpu = self.cpu
+        if not cpu.inCode(cpu.pc):
+            raise ExecEnd()
+
+        ir = cpu.mem[cpu.pc] & WORD_MASK
+        if NO_MICROROUTINE[ir]:
+            raise InvalidInstruction('{} has no microroutine yet'.format(getOpcode(ir).name))
+
+        cpu.adr = cpu.pc
+        cpu.ir = ir
+        cpu.pc = (cpu.pc + 1) & ADDRESS_MASK
+
+    def execInstr(self):
+        '''Execute a whole instruction
+
+        Raises:
+            ExecEnd - when there are no more instructions to execute
+            StackOverflow - when the stack limit is exceeded
+            InvalidInstruction - when the instruction has no microroutine in the MPM
+            ValueError - when IR does not hold a valid instruction
+        '''
+        self._fetch()
+
+        ir = self.cpu.ir
+        d = decode(ir)
+
+        try:
+            handler = self.handlers[d.opcode]
+        except KeyError:
+            raise InvalidInstruction('{} is not implemented by the microprogram'.format(d.opcode.name))
+
+        if d.group == Group.TWO_OP:
+            self.srcFetch[d.mas](ir)
+            self.dstFetch[d.mad](ir)
+        elif d.group == Group.ONE_OP:
+            self.dstFetch[d.mad](ir)
+
+        handler(ir)
+
+    def run(self, maxInstrs=None):
+        '''Execute instructions until the program ends, it faults or the budget is exhausted
+
+        Args:
+            maxInstrs - the maximum number of instructions to execute, None for no limit
+
+        Returns:
+            A RunResult, as Seq.run (with stopOnHalt=False), the cycles are None since the
+            microprogram is not executed
+        '''
+        instructions = 0
+        start = time.perf_counter()
+        try:
+            while maxInstrs is None or instructions < maxInstrs:
+                self.execInstr()
+                instructions += 1
+            reason = StopReason.INSTR_LIMIT
+        except ExecEnd:
+            reason = StopReason.END
+        except StackOverflow:
+            reason = StopReason.STACK_OVERFLOW
+        except (InvalidInstruction, ValueError): # no microroutine, or IR does not hold a valid instruction
+            reason = StopReason.INVALID_INSTRUCTION
+
+        return RunResult(reason, None, instructions, time.perf_counter() - start)
+
+    # source operand -> T
+
+    def _srcImmediate(self, ir):
+        cpu = self.cpu
+        cpu.adr = cpu.pc
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.pc = (cpu.pc + 1) & ADDRESS_MASK
+        cpu.t = cpu.mdr
+
+    def _srcDirect(self, ir):
+        cpu = self.cpu
+        cpu.rIndex = getRs(ir)
+        cpu.t = cpu.r[cpu.rIndex]
+
+    def _srcIndirect(self, ir):
+        cpu = self.cpu
+        cpu.rIndex = getRs(ir)
+        cpu.adr = cpu.r[cpu.rIndex]
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.t = cpu.mdr
+
+    def _srcIndexed(self, ir):
+        cpu = self.cpu
+        cpu.adr = cpu.pc
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.pc = (cpu.pc + 1) & ADDRESS_MASK
+        cpu.rIndex = getRs(ir)
+        cpu.adr = cpu.r[cpu.rIndex] + cpu.mdr
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.t = cpu.mdr
+
+    # destination operand -> MDR
+
+    def _dstImmediate(self, ir):
+        cpu = self.cpu
+        cpu.adr = cpu.pc
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.pc = (cpu.pc + 1) & ADDRESS_MASK
+
+    def _dstDirect(self, ir):
+        cpu = self.cpu
+        cpu.rIndex = getRd(ir)
+        cpu.mdr = cpu.r[cpu.rIndex]
+
+    def _dstIndirect(self, ir):
+        cpu = self.cpu
+        cpu.rIndex = getRd(ir)
+        cpu.adr = cpu.r[cpu.rIndex]
+        cpu.mdr = cpu.mem[cpu.adr]
+
+    def _dstIndexed(self, ir):
+        cpu = self.cpu
+        cpu.adr = cpu.pc
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.pc = (cpu.pc + 1) & ADDRESS_MASK
+        cpu.rIndex = getRd(ir)
+        cpu.adr = cpu.mdr + cpu.r[cpu.rIndex]
+        cpu.mdr = cpu.mem[cpu.adr]
+
+    def _write(self, adr, val):
+        '''Store val in memory at adr'''
+        self.cpu.mem[adr] = toWord(val)
+
+    def _writeBack(self, ir):
+        '''Store MDR in the destination operand (the register or the memory word)'''
+        cpu = self.cpu
+        if getMad(ir) == AddrMode.DIRECT:
+            cpu.r[cpu.rIndex] = toWord(cpu.mdr)
+        else:
+            self._write(cpu.adr, cpu.mdr)
+
+    def _setCond(self, val):
+        '''Apply the condition flags for the ALU result val'''
+        cpu = self.cpu
+        cpu.z = val == 0
+        cpu.s = val < 0
+        # the ALU doesn't compute the carry and overflow yet
+        cpu.c = False
+        cpu.v = False
+
+    def _decSp(self):
+        cpu = self.cpu
+        if cpu.sp > cpu.STACK_LIMIT - cpu.STACK_SIZE:
+            cpu.sp -= 1
+        else:
+            raise StackOverflow()
+
+    # TWO_OP instructions, T holds the source and MDR the destination
+
+    def _mov(self, ir):
+        self.cpu.mdr = self.cpu.t
+        self._writeBack(ir)
+
+    def _add(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.t + cpu.mdr
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _sub(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr - cpu.t
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _cmp(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr - cpu.t
+        self._setCond(cpu.mdr)
+
+    def _and(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr & cpu.t
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _or(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr | cpu.t
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _xor(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr ^ cpu.t
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    # ONE_OP instructions, MDR holds the operand
+
+    def _clr(self, ir):
+        cpu = self.cpu
+        if getMad(ir) == AddrMode.DIRECT:
+            cpu.r[cpu.rIndex] = 0
+        else:
+            # the microroutine writes MDR back unchanged
+            self._write(cpu.adr, cpu.mdr)
+
+    def _neg(self, ir):
+        cpu = self.cpu
+        cpu.mdr = ~cpu.mdr
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _inc(self, ir):
+        cpu = self.cpu
+        cpu.mdr = 1 + cpu.mdr
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _dec(self, ir):
+        cpu = self.cpu
+        cpu.mdr = -1 + cpu.mdr
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _asl(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr << 1
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _asr(self, ir):
+        cpu = self.cpu
+        cpu.mdr = cpu.mdr >> 1
+        self._setCond(cpu.mdr)
+        self._writeBack(ir)
+
+    def _jmp(self, ir):
+        self.cpu.pc = self.cpu.mdr & ADDRESS_MASK
+
+    def _call(self, ir):
+        cpu = self.cpu
+        cpu.t = cpu.mdr
+        cpu.mdr = cpu.pc
+        self._decSp()
+        cpu.adr = cpu.sp
+        self._write(cpu.adr, cpu.mdr)
+        cpu.pc = cpu.t & ADDRESS_MASK
+
+    def _push(self, ir):
+        cpu = self.cpu
+        # the register is pushed whatever the addressing mode is
+        cpu.rIndex = getRd(ir)
+        cpu.mdr = cpu.r[cpu.rIndex]
+        self._decSp()
+        cpu.adr = cpu.sp
+        self._write(cpu.adr, cpu.mdr)
+
+    def _pop(self, ir):
+        cpu = self.cpu
+        cpu.adr = cpu.sp
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.r[cpu.rIndex] = toWord(cpu.mdr)
+        cpu.sp += 1
+
+    # BRANCH instructions
+
+    def _br(self, ir):
+        self.cpu.pc = getBrOffset(ir)
+
+    def _bne(self, ir):
+        if not self.cpu.z:
+            self._br(ir)
+
+    def _beq(self, ir):
+        if self.cpu.z:
+            self._br(ir)
+
+    def _bpl(self, ir):
+        if not self.cpu.s:
+            self._br(ir)
+
+    def _bmi(self, ir):
+        if self.cpu.s:
+            self._br(ir)
+
+    def _bcs(self, ir):
+        if self.cpu.c:
+            self._br(ir)
+
+    def _bcc(self, ir):
+        if not self.cpu.c:
+            self._br(ir)
+
+    def _bvs(self, ir):
+        if self.cpu.v:
+            self._br(ir)
+
+    def _bvc(self, ir):
+        if not self.cpu.v:
+            self._br(ir)
+
+    # OTHER instructions
+
+    def _clc(self, ir):
+        self.cpu.c = False
+
+    def _clv(self, ir):
+        self.cpu.v = False
+
+    def _ccc(self, ir):
+        cpu = self.cpu
+        cpu.c = False
+        cpu.v = False
+        cpu.s = False
+        cpu.z = False
+
+    def _sec(self, ir):
+        self.cpu.c = True
+
+    def _sev(self, ir):
+        self.cpu.v = True
+
+    def _sez(self, ir):
+        self.cpu.z = True
+
+    def _ses(self, ir):
+        self.cpu.s = True
+
+    def _scc(self, ir):
+        cpu = self.cpu
+        cpu.c = True
+        cpu.v = True
+        cpu.s = True
+        cpu.z = True
+
+    def _nop(self, ir):
+        pass
+
+    def _ret(self, ir):
+        cpu = self.cpu
+        cpu.adr = cpu.sp
+        cpu.mdr = cpu.mem[cpu.adr]
+        cpu.pc = cpu.mdr & ADDRESS_MASK
+        cpu.sp += 1
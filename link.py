@@ -0,0 +1,383 @@
+#! /usr/bin/python3.5
+'''Assemble modules separately and link them in a program
+
+Every module is assembled on its own, as if it was placed at address 0, and its labels are local to it
+unless they are exported with .global. The linker places the code of the modules one after the other,
+in the given order (the first one starts at address 0, where the CPU starts), then their data sections,
+and encodes again every instruction that uses a label, with the final address of the label; the labels
+that a module doesn't define are the ones exported by the other modules.
+
+Usage:
+    ./link.py -o factorial.obj examples/link/main.asm examples/link/fact.asm examples/link/mul.asm
+    ./main.py factorial.obj
+'''
+from asm import Assembler, ParseError, Relocation, readSource, ASSEMBLER_VERSION
+from instr import InvalidInstruction
+from objfile import Program
+from seq import toWord
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+
+# the module file format, all the numbers are little endian:
+#   HEADER: magic, format version, assembler version, the number of words, the size of the code section,
+#       the number of line map entries, labels and relocations
+#   the words, as signed 16 bit numbers
+#   LINE: an (address, line number) pair for every instruction
+#   LABEL: the address of every label, its flags (LABEL_EXPORTED, LABEL_DATA) and the length of its (UTF-8) name,
+#       followed by the name
+#   RELOCATION: the address and the source line of every instruction using a label and the length of its
+#       tokens (joined by spaces, as UTF-8), followed by them
+MAGIC = b'CPUM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIII')
+LINE = struct.Struct('<II')
+LABEL = struct.Struct('<IBH')
+RELOCATION = struct.Struct('<IIH')
+
+LABEL_EXPORTED = 1
+LABEL_DATA = 2 # the label is in the data section, it can be at the same address as the end of the code
+
+class LinkError(Exception):
+    pass
+
+class ModuleAssembler(Assembler):
+    '''Assembles a module: the labels it doesn't define are left to the linker and the instructions
+    that use labels are kept in relocations
+    '''
+    def __init__(self, filePath=None):
+        super().__init__(filePath)
+        self.relocations = []
+        self.dataLabels = set()
+
+    def _defineLabel(self, label):
+        if self._data is None: # assembling the data section
+            self.dataLabels.add(label)
+
+        return super()._defineLabel(label)
+
+    def _checkFixups(self):
+        pass # the labels that are not defined by the module are checked by link
+
+
+class Module(object):
+    '''An assembled module, it can be placed anywhere in a program'''
+    def __init__(self, words, codeSize, lblToAddr, exports, dataLabels, relocations, adrToLine, path=None):
+        '''Init the module
+
+        Args:
+            words - the encoded module, as if it was placed at address 0: the code followed by the data
+            codeSize - the number of words of the code
+            lblToAddr - dict of label -> address in the module
+            exports - the set of the labels exported by the module
+            dataLabels - the set of the labels defined in the data section
+            relocations - list of Relocation, the instructions that use labels
+            adrToLine - dict of instruction address -> source line
+            path - the source file, used in the error messages
+        '''
+        self.words = words if isinstance(words, array) and words.typecode == 'h' \
+            else array('h', [toWord(word) for word in words])
+        self.codeSize = codeSize
+        self.lblToAddr = lblToAddr
+        self.exports = exports
+        self.dataLabels = dataLabels
+        self.relocations = relocations
+        self.adrToLine = adrToLine
+        self.path = path
+
+    @classmethod
+    def fromAssembler(cls, asm):
+        '''Get the module assembled by a ModuleAssembler, parse() must have been called
+
+        Raises:
+            LinkError - if the module exports a label that it doesn't define
+        '''
+        for label in sorted(asm.exports):
+            if label not in asm.lblToAddr:
+                raise LinkError('{} exports {}, which it does not define'.format(asm.filePath, label))
+
+        return cls(asm.programCode, asm.codeSize, asm.lblToAddr, asm.exports, asm.dataLabels, asm.relocations,
+            asm.adrToLine, asm.filePath)
+
+    def address(self, adr, codeBase, dataBase):
+        '''Get the address in the program of an instruction of the module, given where its sections are placed'''
+        return codeBase + adr if adr < self.codeSize else dataBase + adr - self.codeSize
+
+    def labelAddress(self, label, codeBase, dataBase):
+        '''Get the address in the program of a label of the module, see address'''
+        adr = self.lblToAddr[label]
+
+        return dataBase + adr - self.codeSize if label in self.dataLabels else codeBase + adr
+
+    def save(self, path):
+        '''Write the module to a file'''
+        words = array('h', self.words)
+        if sys.byteorder != 'little':
+            words.byteswap()
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, ASSEMBLER_VERSION, len(words), self.codeSize, len(self.adrToLine),
+                len(self.lblToAddr), len(self.relocations)))
+            f.write(words.tobytes())
+            f.write(b''.join(LINE.pack(adr, line) for (adr, line) in sorted(self.adrToLine.items())))
+            for (lbl, adr) in sorted(self.lblToAddr.items(), key=lambda item: item[1]):
+                name = lbl.encode('utf-8')
+                flags = (LABEL_EXPORTED if lbl in self.exports else 0) | (LABEL_DATA if lbl in self.dataLabels else 0)
+                f.write(LABEL.pack(adr, flags, len(name)))
+                f.write(name)
+            for (adr, tokens, line) in self.relocations:
+                text = ' '.join(tokens).encode('utf-8')
+                f.write(RELOCATION.pack(adr, line, len(text)))
+                f.write(text)
+
+    @classmethod
+    def load(cls, path):
+        '''Read a module written by save
+
+        Raises:
+            LinkError - if the file is not a module, has an unknown version, was written by another
+                version of the assembler or is truncated
+        '''
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        try:
+            (magic, version, asmVersion, wordCount, codeSize, lineCount, labelCount, relocationCount) = \
+                HEADER.unpack_from(data)
+        except struct.error:
+            raise LinkError('{} is not a module'.format(path))
+        if magic != MAGIC:
+            raise LinkError('{} is not a module'.format(path))
+        if version != VERSION or asmVersion != ASSEMBLER_VERSION:
+            raise LinkError('{} has the unsupported version {}.{}'.format(path, version, asmVersion))
+
+        try:
+            offset = HEADER.size
+            end = offset + 2 * wordCount
+            if end > len(data):
+                raise LinkError('{} is truncated'.format(path))
+            words = array('h')
+            words.frombytes(data[offset:end])
+            if sys.byteorder != 'little':
+                words.byteswap()
+            offset = end
+
+            adrToLine = dict(LINE.iter_unpack(data[offset:offset + LINE.size * lineCount]))
+            offset += LINE.size * lineCount
+
+            lblToAddr = {}
+            exports = set()
+            dataLabels = set()
+            for i in range(labelCount):
+                (adr, flags, length) = LABEL.unpack_from(data, offset)
+                offset += LABEL.size
+                lbl = data[offset:offset + length].decode('utf-8')
+                offset += length
+                lblToAddr[lbl] = adr
+                if flags & LABEL_EXPORTED:
+                    exports.add(lbl)
+                if flags & LABEL_DATA:
+                    dataLabels.add(lbl)
+
+            relocations = []
+            for i in range(relocationCount):
+                (adr, line, length) = RELOCATION.unpack_from(data, offset)
+                offset += RELOCATION.size
+                relocations.append(Relocation(adr, data[offset:offset + length].decode('utf-8').split(' '), line))
+                offset += length
+        except (struct.error, UnicodeDecodeError):
+            raise LinkError('{} is truncated or corrupted'.format(path))
+
+        if len(adrToLine) != lineCount or offset > len(data):
+            raise LinkError('{} is truncated'.format(path))
+
+        return cls(words, codeSize, lblToAddr, exports, dataLabels, relocations, adrToLine, path)
+
+
+class ModuleCache(object):
+    '''An on-disk cache of assembled modules, see objfile.AsmCache
+
+    The modules are named after the hash of their source, including the files it includes, so only
+    the modules that changed are assembled again before linking.
+    '''
+    def __init__(self, directory):
+        '''Init the cache, the directory is created if it does not exist'''
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, path):
+        '''Get the path of the cached module assembled from the given source file'''
+        digest = hashlib.sha256(str(ASSEMBLER_VERSION).encode('ascii') + b'\0' + readSource(path))
+
+        return os.path.join(self.directory, digest.hexdigest() + '.mod')
+
+    def get(self, path):
+        '''Get the module assembled from the given source file, None if it is not in the cache'''
+        try:
+            module = Module.load(self.path(path))
+        except (OSError, LinkError):
+            return None
+        module.path = path
+
+        return module
+
+    def put(self, module):
+        '''Add a module to the cache'''
+        (fd, tmpPath) = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        try:
+            module.save(tmpPath)
+            os.replace(tmpPath, self.path(module.path))
+        except OSError:
+            os.unlink(tmpPath)
+            raise
+
+
+def assembleModule(path, cacheDir=None):
+    '''Assemble a module, or get it from the cache
+
+    Args:
+        path - the *.asm file
+        cacheDir - the directory of the ModuleCache, None to always assemble the module
+
+    Returns:
+        A Module
+
+    Raises:
+        ParseError, InvalidInstruction - if the module cannot be assembled
+        LinkError - if the module exports a label that it doesn't define
+    '''
+    cache = ModuleCache(cacheDir) if cacheDir is not None else None
+    if cache is not None:
+        module = cache.get(path)
+        if module is not None:
+            return module
+
+    asm = ModuleAssembler(path)
+    asm.parse()
+    module = Module.fromAssembler(asm)
+    if cache is not None:
+        cache.put(module)
+
+    return module
+
+
+def link(modules):
+    '''Link the modules in a program
+
+    The code of the modules is placed in the given order, then their data, in the same order.
+
+    Returns:
+        An objfile.Program, its labels are the exported ones and the ones of the first module, its
+        line numbers are the ones of the first module
+
+    Raises:
+        LinkError - if a label is exported by more than one module, is not defined anywhere or
+            its address cannot be encoded in an instruction (eg: a branch too far away)
+    '''
+    codeBases = []
+    adr = 0
+    for module in modules:
+        codeBases.append(adr)
+        adr += module.codeSize
+    dataBases = []
+    for module in modules:
+        dataBases.append(adr)
+        adr += len(module.words) - module.codeSize
+
+    words = array('h', [0] * adr)
+    exported = {}
+    owners = {}
+    for (module, codeBase, dataBase) in zip(modules, codeBases, dataBases):
+        words[codeBase:codeBase + module.codeSize] = module.words[:module.codeSize]
+        words[dataBase:dataBase + len(module.words) - module.codeSize] = module.words[module.codeSize:]
+        for label in sorted(module.exports):
+            if label in exported:
+                raise LinkError('{} is exported by both {} and {}'.format(label, owners[label], module.path))
+            exported[label] = module.labelAddress(label, codeBase, dataBase)
+            owners[label] = module.path
+
+    asm = Assembler()
+    lblToAddr = dict(exported)
+    for (i, (module, codeBase, dataBase)) in enumerate(zip(modules, codeBases, dataBases)):
+        asm.lblToAddr = dict(exported)
+        asm.lblToAddr.update((label, module.labelAddress(label, codeBase, dataBase)) for label in module.lblToAddr)
+        if i == 0:
+            lblToAddr.update(asm.lblToAddr)
+
+        for (relocationAdr, tokens, line) in module.relocations:
+            try:
+                encoded = asm._encode(tokens)
+                if asm._unresolved:
+                    raise asm._unresolved[0][1]
+            except (ParseError, InvalidInstruction) as e:
+                raise LinkError('{}:{}: {}'.format(module.path, line, e))
+
+            adr = module.address(relocationAdr, codeBase, dataBase)
+            words[adr:adr + len(encoded)] = array('h', [toWord(word) for word in encoded])
+
+    adrToLine = {}
+    if modules:
+        adrToLine = {modules[0].address(adr, codeBases[0], dataBases[0]): line
+            for (adr, line) in modules[0].adrToLine.items()}
+
+    return Program(words, lblToAddr, adrToLine)
+
+
+def build(paths, workers=None, cacheDir=None):
+    '''Assemble the modules in parallel and link them
+
+    Only the modules that are not in the cache are assembled, in a pool of processes if there
+    is more than one.
+
+    Args:
+        paths - the *.asm files of the modules, see link for their order
+        workers - the number of processes, the number of CPUs if None
+        cacheDir - the directory of the ModuleCache, None to always assemble the modules
+
+    Returns:
+        An objfile.Program
+
+    Raises:
+        ParseError, InvalidInstruction, LinkError - see assembleModule and link
+    '''
+    cache = ModuleCache(cacheDir) if cacheDir is not None else None
+    modules = [cache.get(path) if cache is not None else None for path in paths]
+    missing = [path for (path, module) in zip(paths, modules) if module is None]
+
+    if len(missing) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            assembled = list(pool.map(assembleModule, missing, [cacheDir] * len(missing)))
+    else:
+        assembled = [assembleModule(path, cacheDir) for path in missing]
+
+    assembled.reverse()
+    modules = [module if module is not None else assembled.pop() for module in modules]
+
+    return link(modules)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assemble modules and link them in an object file')
+    parser.add_argument('modules', nargs='+', metavar='MODULE',
+        help='the *.asm files, the first one is placed at address 0')
+    parser.add_argument('-o', '--output', metavar='FILE', required=True,
+        help='the object file to write, it can be run with main.py')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='the number of modules assembled in parallel (default: the number of CPUs)')
+    parser.add_argument('--cache', metavar='DIR',
+        help='keep the assembled modules in DIR, a module is assembled again only when its source changes')
+    args = parser.parse_args()
+
+    try:
+        program = build(args.modules, args.jobs, args.cache)
+    except (ParseError, InvalidInstruction, LinkError, OSError) as e:
+        sys.exit('{}: {}'.format(type(e).__name__, e))
+
+    program.save(args.output)
@@ -2,9 +2,18 @@
 
 from instr import *
 from uinstr import MPM
-from seq import Seq, Cpu
-from asm import Assembler
+from seq import Seq, Cpu, ExecEnd, StopReason
+from isa import IsaEngine
+from ucomp import CompiledSeq
+from block import BlockEngine
+from objfile import assemble
 from debugger import Debugger
+from stats import ExecStats
+from profiler import GuestProfiler
+from tracer import Tracer, TraceFile
+
+import argparse
+import sys
 
 def showExampleEncodings():
     print('{:<20}\t{:>5}\t{:>10}'.format('Instr', 'Hex', 'Bin'))
@@ -107,26 +116,112 @@ def showOpCodes():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run an assembly program on the CPU emulator')
+    parser.add_argument('file', nargs='?', default='examples/mov.asm',
+        help='the *.asm (or *.obj) file to run, - for the source on stdin (default: %(default)s)')
+    parser.add_argument('-e', '--engine', choices=['micro', 'compiled', 'isa', 'block'], default='micro',
+        help='micro: step through the microprogram in the debugger, '
+            'compiled: run the compiled microroutines, '
+            'isa: execute whole instructions, '
+            'block: execute cached basic blocks; '
+            'all but micro only show the final state (default: %(default)s)')
+    parser.add_argument('--stats', action='store_true',
+        help='run the microprogram without the debugger and report where the micro-cycles went')
+    parser.add_argument('--stats-json', metavar='FILE',
+        help='like --stats, but also write the counters to FILE, as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+        help='run the microprogram without the debugger, profile the guest routines and write '
+            'the collapsed call stacks (for flame graphs) to FILE')
+    parser.add_argument('--profile-interval', metavar='N', type=int, default=1,
+        help='sample the guest every N micro-cycles (default: %(default)s)')
+    parser.add_argument('--trace', metavar='FILE',
+        help='run the microprogram without the debugger and write a binary trace to FILE, see tracer.py')
+    parser.add_argument('--trace-level', choices=['micro', 'instr'], default='micro',
+        help='trace every micro-cycle or only the fetch of every instruction (default: %(default)s)')
+    parser.add_argument('--cache', metavar='DIR',
+        help='keep the assembled program in DIR, it is not parsed again until the source changes')
+    parser.add_argument('-o', '--output', metavar='FILE',
+        help='write the assembled program to the object file FILE and exit')
+    parser.add_argument('--record', action='store_true',
+        help='record the execution in the debugger from the start, so "rs" and "rc" can go back to any cycle')
+    parser.add_argument('--load-address', metavar='ADR', type=lambda x: int(x, 0), default=0,
+        help='load the program at ADR and start it from there, the program is assembled for address 0, '
+            'so it must not use the addresses of its labels (default: %(default)s)')
+    parser.add_argument('--stack-base', metavar='ADR', type=lambda x: int(x, 0),
+        help='the lowest address of the stack (default: right after the program)')
+    parser.add_argument('--stack-size', metavar='N', type=lambda x: int(x, 0), default=32,
+        help='the number of words in the stack (default: %(default)s)')
+    args = parser.parse_args()
+
     #showOpCodes()
     #showExampleEncodings()
     #print()
-    #asm = Assembler('examples/factorial.asm')
-    #asm = Assembler('examples/misc.asm')
-    #asm = Assembler('examples/mul.asm')
-    #asm = Assembler('examples/int.asm')
-    asm = Assembler('examples/mov.asm')
-    #asm = Assembler('examples/br.asm')
+    program = assemble(args.file, args.cache)
     #print('generated code:')
-
-    program_memory = asm.parse()
-    #for i in program_memory:
-    #    print('0x{0:04X}\t0b{0:016b}'.format(i))
-
-    cpu = Cpu(program_memory)
-    seq = Seq(MPM, cpu)
+    #for i in program.words:
+    #    print('0x{0:04X}\t0b{0:016b}'.format(i & 0xFFFF))
+
+    if args.output:
+        program.save(args.output)
+        sys.exit()
+
+    cpu = Cpu(program.words, args.load_address, args.stack_base, args.stack_size)
+    labels = {lbl: adr + args.load_address for (lbl, adr) in program.lblToAddr.items()}
+
+    if args.engine == 'isa':
+        result = IsaEngine(cpu).run()
+        print(cpu)
+        if result.reason != StopReason.END:
+            print('Stopped: {}'.format(result.reason.value))
+    elif args.engine == 'block':
+        engine = BlockEngine(cpu)
+        result = engine.run()
+        print(cpu)
+        print('Translation cache: {}'.format(engine.cacheStats()))
+        if result.reason != StopReason.END:
+            print('Stopped: {}'.format(result.reason.value))
+    elif args.engine == 'compiled':
+        seq = CompiledSeq(MPM, cpu)
+        result = seq.run()
+        print(cpu)
+        if result.reason != StopReason.END:
+            print('Stopped: {}'.format(result.reason.value))
+    elif args.stats or args.stats_json or args.profile or args.trace:
+        seq = Seq(MPM, cpu)
+        stats = ExecStats(seq)
+        profiler = GuestProfiler(seq, labels, args.profile_interval)
+        if args.stats or args.stats_json:
+            stats.attach()
+        if args.profile:
+            profiler.attach()
+        if args.trace:
+            traceFile = TraceFile(args.trace, args.trace_level)
+            tracer = Tracer(seq, traceFile, args.trace_level)
+            tracer.attach()
+
+        result = seq.run()
+        if args.trace:
+            tracer.detach()
+            traceFile.close()
+        profiler.detach()
+        stats.detach()
+
+        print(cpu)
+        print('Stopped: {} after {} micro-cycles'.format(result.reason.value, result.cycles))
+        if args.stats or args.stats_json:
+            print(stats.report())
+        if args.stats_json:
+            with open(args.stats_json, 'w') as f:
+                f.write(stats.toJson(indent=2))
+        if args.profile:
+            print(profiler.report())
+            with open(args.profile, 'w') as f:
+                f.write(profiler.collapsed())
+    else:
+        seq = Seq(MPM, cpu)
 #TODO: intreruperi
-    dbg = Debugger(seq)
-    dbg.attach()
+        dbg = Debugger(seq, labels, args.record)
+        dbg.attach()
 
     # print(cpu.__dict__)
     # print(seq.__dict__)
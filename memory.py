@@ -0,0 +1,152 @@
+from array import array
+
+# the memory has 2 ** ADDRESS_BITS words, the addresses wrap around
+ADDRESS_BITS = 16
+MEMORY_SIZE = 1 << ADDRESS_BITS
+ADDRESS_MASK = MEMORY_SIZE - 1
+
+# the memory is allocated and snapshotted in pages of 2 ** PAGE_BITS words
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_COUNT = MEMORY_SIZE >> PAGE_BITS
+OFFSET_MASK = PAGE_SIZE - 1
+PAGE_MASK = PAGE_COUNT - 1
+
+# the pages that were never written share this one, which is never written either
+_ZERO_PAGE = array('h', [0] * PAGE_SIZE)
+# a page that holds only zeros, in a snapshot
+ZERO_BYTES = _ZERO_PAGE.tobytes()
+
+class Memory(object):
+    '''The whole address space, MEMORY_SIZE signed 16 bit words, allocated one page at a time
+
+    A page is allocated only when one of its words is written, the other pages read as zeros, so
+    the memory taken is proportional to the number of pages written. The addresses are wrapped
+    to ADDRESS_BITS (eg: -1 is the last word). The values stored must be wrapped with toWord first.
+
+    Every store also marks its page as dirty, so the memory can be snapshotted in copy-on-write pages.
+    A snapshot is a tuple of immutable pages (bytes), the pages that were not written since the
+    previous snapshot or restore are shared with it, so taking or restoring a snapshot is
+    proportional to the number of pages touched, not to the size of the memory.
+    '''
+    __slots__ = ['pages', 'dirty', 'base']
+
+    def __init__(self, words=(), adr=0):
+        '''Init the memory with the given words, stored from adr, the other words are 0
+
+        Args:
+            words - iterable of signed 16 bit words
+        '''
+        self.pages = [_ZERO_PAGE] * PAGE_COUNT # an array('h') of PAGE_SIZE words for every page
+        self.dirty = set() # the numbers of the pages written since the last snapshot or restore
+        self.base = None # the last snapshot taken or restored
+        self.load(words, adr)
+
+    def __len__(self):
+        return MEMORY_SIZE
+
+    def __getitem__(self, adr):
+        return self.pages[(adr >> PAGE_BITS) & PAGE_MASK][adr & OFFSET_MASK]
+
+    def __setitem__(self, adr, val):
+        n = (adr >> PAGE_BITS) & PAGE_MASK
+        page = self.pages[n]
+        if page is _ZERO_PAGE:
+            page = self.pages[n] = array('h', _ZERO_PAGE)
+        page[adr & OFFSET_MASK] = val
+        self.dirty.add(n)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def __copy__(self):
+        mem = Memory()
+        mem.pages = [page if page is _ZERO_PAGE else array('h', page) for page in self.pages]
+        mem.dirty = set(self.dirty)
+        mem.base = self.base
+
+        return mem
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def allocated(self):
+        '''Get the numbers of the allocated pages, in increasing order'''
+        return [n for (n, page) in enumerate(self.pages) if page is not _ZERO_PAGE]
+
+    def words(self, start, count):
+        '''Get count words from start (the addresses wrap around) as an array('h')'''
+        words = array('h')
+        while count > 0:
+            start &= ADDRESS_MASK
+            offset = start & OFFSET_MASK
+            n = min(count, PAGE_SIZE - offset)
+            words.extend(self.pages[start >> PAGE_BITS][offset:offset + n])
+            start += n
+            count -= n
+
+        return words
+
+    def load(self, words, adr=0):
+        '''Store the words from adr (the addresses wrap around), a page at a time'''
+        words = words if isinstance(words, array) and words.typecode == 'h' else array('h', words)
+        i = 0
+        while i < len(words):
+            adr &= ADDRESS_MASK
+            offset = adr & OFFSET_MASK
+            n = min(len(words) - i, PAGE_SIZE - offset)
+            page = adr >> PAGE_BITS
+            if self.pages[page] is _ZERO_PAGE:
+                self.pages[page] = array('h', _ZERO_PAGE)
+            self.pages[page][offset:offset + n] = words[i:i + n]
+            self.dirty.add(page)
+            adr += n
+            i += n
+
+    def snapshot(self):
+        '''Get an immutable copy of the memory
+
+        Returns:
+            A tuple of PAGE_COUNT pages, each one holds the bytes of PAGE_SIZE words, the pages
+            that were never written are ZERO_BYTES
+        '''
+        if self.base is None:
+            pages = [ZERO_BYTES if page is _ZERO_PAGE else page.tobytes() for page in self.pages]
+        else:
+            pages = list(self.base)
+            for n in self.dirty:
+                pages[n] = self.pages[n].tobytes()
+
+        self.base = tuple(pages)
+        self.dirty = set()
+
+        return self.base
+
+    def restore(self, pages):
+        '''Load the memory from a snapshot
+
+        Only the pages written since the last snapshot or restore and the pages that differ
+        between it and the restored snapshot are copied, the pages that hold only zeros are freed.
+
+        Raises:
+            ValueError - if the snapshot has a different size than the memory
+        '''
+        if len(pages) != PAGE_COUNT or any(len(page) != len(ZERO_BYTES) for page in pages):
+            raise ValueError('The snapshot does not match the size of the memory')
+
+        if self.base is None:
+            changed = range(PAGE_COUNT)
+        else:
+            changed = self.dirty.union(n for n in range(PAGE_COUNT) if pages[n] is not self.base[n])
+
+        for n in changed:
+            if pages[n] == ZERO_BYTES:
+                self.pages[n] = _ZERO_PAGE
+            else:
+                page = array('h')
+                page.frombytes(pages[n])
+                self.pages[n] = page
+
+        self.base = pages
+        self.dirty = set()
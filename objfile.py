@@ -0,0 +1,196 @@
+from asm import Assembler, readSource, ASSEMBLER_VERSION
+from seq import toWord
+
+from array import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+# the object file format, all the numbers are little endian:
+#   HEADER: magic, format version, assembler version, the number of words, line map entries and symbols
+#   the words, as signed 16 bit numbers
+#   LINE: an (address, line number) pair for every instruction
+#   SYMBOL: the address of every label and the length of its (UTF-8) name, followed by the name
+MAGIC = b'CPUO'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIII')
+LINE = struct.Struct('<II')
+SYMBOL = struct.Struct('<IH')
+
+class ObjectError(Exception):
+    pass
+
+class Program(object):
+    '''An assembled program: its code and the information needed to map it back to the source'''
+    def __init__(self, words, lblToAddr=None, adrToLine=None):
+        '''Init the program
+
+        Args:
+            words - the encoded program, they are wrapped to signed 16 bit words
+            lblToAddr - dict of label -> address, see Assembler.lblToAddr
+            adrToLine - dict of instruction address -> source line, see Assembler.adrToLine
+        '''
+        self.words = words if isinstance(words, array) and words.typecode == 'h' \
+            else array('h', [toWord(word) for word in words])
+        self.lblToAddr = dict(lblToAddr or {})
+        self.adrToLine = dict(adrToLine or {})
+
+    @classmethod
+    def fromAssembler(cls, asm):
+        '''Get the program assembled by an Assembler, parse() must have been called'''
+        return cls(asm.programCode, asm.lblToAddr, asm.adrToLine)
+
+    def save(self, path):
+        '''Write the program to an object file'''
+        words = array('h', self.words)
+        if sys.byteorder != 'little':
+            words.byteswap()
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, ASSEMBLER_VERSION, len(words), len(self.adrToLine),
+                len(self.lblToAddr)))
+            f.write(words.tobytes())
+            f.write(b''.join(LINE.pack(adr, line) for (adr, line) in sorted(self.adrToLine.items())))
+            for (lbl, adr) in sorted(self.lblToAddr.items(), key=lambda item: item[1]):
+                name = lbl.encode('utf-8')
+                f.write(SYMBOL.pack(adr, len(name)))
+                f.write(name)
+
+    @classmethod
+    def load(cls, path):
+        '''Read an object file written by save
+
+        The file is mapped in memory and the words are copied from the mapping in one go,
+        the result can be passed directly to Cpu.
+
+        Raises:
+            ObjectError - if the file is not an object file, has an unknown version or is truncated
+        '''
+        with open(path, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # an empty file cannot be mapped
+                raise ObjectError('{} is not an object file'.format(path))
+
+        with data:
+            try:
+                (magic, version, asmVersion, wordCount, lineCount, symbolCount) = HEADER.unpack_from(data)
+            except struct.error:
+                raise ObjectError('{} is not an object file'.format(path))
+            if magic != MAGIC:
+                raise ObjectError('{} is not an object file'.format(path))
+            if version != VERSION:
+                raise ObjectError('{} has the unsupported version {}'.format(path, version))
+
+            offset = HEADER.size
+            end = offset + 2 * wordCount
+            if end > len(data):
+                raise ObjectError('{} is truncated'.format(path))
+            words = array('h')
+            words.frombytes(data[offset:end])
+            if sys.byteorder != 'little':
+                words.byteswap()
+            offset = end
+
+            try:
+                adrToLine = dict(LINE.iter_unpack(data[offset:offset + LINE.size * lineCount]))
+                offset += LINE.size * lineCount
+
+                lblToAddr = {}
+                for i in range(symbolCount):
+                    (adr, length) = SYMBOL.unpack_from(data, offset)
+                    offset += SYMBOL.size
+                    lblToAddr[data[offset:offset + length].decode('utf-8')] = adr
+                    offset += length
+            except (struct.error, UnicodeDecodeError):
+                raise ObjectError('{} is truncated or corrupted'.format(path))
+
+            if len(adrToLine) != lineCount or offset > len(data):
+                raise ObjectError('{} is truncated'.format(path))
+
+        return cls(words, lblToAddr, adrToLine)
+
+
+class AsmCache(object):
+    '''An on-disk cache of assembled programs
+
+    The programs are stored as object files named after the hash of the source text (including the
+    files it includes) and of the assembler version, so a source that did not change is never parsed again, no matter its path,
+    and upgrading the assembler invalidates the whole cache.
+    The files are written atomically, so several processes can share the cache.
+    '''
+    def __init__(self, directory):
+        '''Init the cache, the directory is created if it does not exist'''
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source):
+        '''Get the cache key of a source text, given as bytes'''
+        digest = hashlib.sha256(str(ASSEMBLER_VERSION).encode('ascii') + b'\0' + source)
+
+        return digest.hexdigest()
+
+    def assemble(self, path):
+        '''Get the program in the *.asm file, parsed only if it is not in the cache
+
+        Returns:
+            A Program
+
+        Raises:
+            ParseError - if the program is not in the cache and cannot be parsed
+        '''
+        source = readSource(path)
+        objPath = os.path.join(self.directory, self.key(source) + '.obj')
+
+        try:
+            program = Program.load(objPath)
+            self.hits += 1
+            return program
+        except (FileNotFoundError, ObjectError):
+            pass
+
+        asm = Assembler(path)
+        asm.parse()
+        program = Program.fromAssembler(asm)
+        self.misses += 1
+
+        (fd, tmpPath) = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        try:
+            program.save(tmpPath)
+            os.replace(tmpPath, objPath)
+        except OSError:
+            os.unlink(tmpPath)
+            raise
+
+        return program
+
+
+def assemble(path, cacheDir=None):
+    '''Assemble a *.asm file, or load it if it is an object file (*.obj)
+
+    Args:
+        path - the file, - for the source read from stdin (it is not cached)
+        cacheDir - the directory of the AsmCache used for the *.asm files, None to always parse them
+
+    Returns:
+        A Program
+    '''
+    if path == '-':
+        asm = Assembler()
+        asm.parseLines(sys.stdin)
+        return Program.fromAssembler(asm)
+    if path.endswith('.obj'):
+        return Program.load(path)
+    if cacheDir is not None:
+        return AsmCache(cacheDir).assemble(path)
+
+    asm = Assembler(path)
+    asm.parse()
+
+    return Program.fromAssembler(asm)
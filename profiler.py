@@ -0,0 +1,199 @@
+from instr import OpCode
+from uinstr import Mem
+from seq import WORD_MASK, instanceOverride
+
+from bisect import bisect_right
+from collections import Counter
+
+class GuestProfiler(object):
+    '''Samples where the guest program spends its micro-cycles
+
+    Every interval micro-cycles the address of the instruction being executed and the
+    guest call stack are recorded. The call stack is rebuilt from the executed instructions:
+    a CALL pushes its target (the PC right after it) and a RET pops the innermost frame.
+    The addresses are turned into names with the labels of the program (Assembler.lblToAddr).
+
+    The call stack and the PC are updated by a hook on the instruction fetch (like Tracer's INSTR
+    level), once per instruction; every micro-cycle only pays for a wrapper of execMicroInstr that
+    counts down to the next sample. That wrapper is still an extra Python call per micro-cycle: a run
+    takes about 1.2 times as long, whatever the interval (it was 1.5 times, at interval 1, when the
+    wrapper also followed the CALLs and RETs). Like ExecStats, the profiler replaces
+    the sequencer's execMicroInstr (and its memTable) only while attached.
+    '''
+    def __init__(self, seq, lblToAddr=None, interval=1):
+        '''Init the profiler for the given sequencer
+
+        Args:
+            seq - the Seq running the program
+            lblToAddr - dict of label -> address, as built by the Assembler
+            interval - take a sample every interval micro-cycles
+        '''
+        if interval < 1:
+            raise ValueError('The sampling interval must be at least 1, not {}'.format(interval))
+
+        self.seq = seq
+        self.interval = interval
+        self.attached = False
+        self.entry = seq.cpu.code[0][0] # the load address of the program, where its execution starts
+
+        labels = sorted((adr, lbl) for (lbl, adr) in (lblToAddr or {}).items())
+        self._labelAdrs = [adr for (adr, lbl) in labels]
+        self._labelNames = [lbl for (adr, lbl) in labels]
+
+        self.reset()
+
+    def reset(self):
+        '''Drop the samples and the call stack'''
+        attached = self.attached
+        self.detach()
+
+        self.samples = Counter() # (call stack, PC) -> number of samples
+        self.stack = (self.seq.cpu.pc,) # the entry addresses of the active routines, outermost first
+
+        if attached:
+            self.attach()
+
+    def attach(self):
+        '''Start sampling'''
+        if self.attached:
+            return
+
+        seq = self.seq
+        cpu = seq.cpu
+        samples = self.samples
+        interval = self.interval
+        execMicroInstr = seq.execMicroInstr
+        memIfchOp = seq.memTable[Mem.IFCH]
+        profiler = self
+        countdown = interval
+        key = (self.stack, cpu.pc) # (call stack, the address of the instruction being executed)
+
+        def profiledMemIfch():
+            nonlocal key
+            # the previous instruction is done, IR still holds it
+            ir = cpu.ir & WORD_MASK
+            if ir >> 6 == OpCode.CALL: # ONE_OP opcodes take the upper 10 bits
+                profiler.stack += (cpu.pc,)
+            elif ir == OpCode.RET and len(profiler.stack) > 1:
+                profiler.stack = profiler.stack[:-1]
+            key = (profiler.stack, cpu.pc) # the PC is incremented later in the micro-cycle
+            memIfchOp()
+
+        def sampledExecMicroInstr():
+            nonlocal countdown
+            execMicroInstr()
+
+            countdown -= 1
+            if countdown == 0:
+                countdown = interval
+                samples[key] += 1
+
+        self._memTable = seq.memTable
+        seq.memTable = list(seq.memTable)
+        seq.memTable[Mem.IFCH] = profiledMemIfch
+        self._execMicroInstr = instanceOverride(seq, 'execMicroInstr')
+        seq.execMicroInstr = sampledExecMicroInstr
+        self.attached = True
+
+    def detach(self):
+        '''Stop sampling, the samples are kept'''
+        if not self.attached:
+            return
+
+        seq = self.seq
+        seq.memTable = self._memTable
+        if self._execMicroInstr is None:
+            del seq.execMicroInstr
+        else:
+            seq.execMicroInstr = self._execMicroInstr
+        self.attached = False
+
+    def labelFor(self, adr):
+        '''Get the name of an address: the closest label before it, with the distance to it
+
+        Returns:
+            A string like "FACT", "FACT+3" or "0x0010" if there is no label before adr
+        '''
+        i = bisect_right(self._labelAdrs, adr) - 1
+        if i < 0:
+            return '0x{:04X}'.format(adr)
+        if self._labelAdrs[i] == adr:
+            return self._labelNames[i]
+
+        return '{}+{}'.format(self._labelNames[i], adr - self._labelAdrs[i])
+
+    def routineFor(self, adr):
+        '''Get the name of the routine starting at adr'''
+        i = bisect_right(self._labelAdrs, adr) - 1
+        if i >= 0 and self._labelAdrs[i] == adr:
+            return self._labelNames[i]
+
+        return 'main' if adr == self.entry else '0x{:04X}'.format(adr)
+
+    def flat(self):
+        '''Get the micro-cycles spent in every routine itself (not in the routines it called)
+
+        Returns:
+            A Counter of routine name -> micro-cycles
+        '''
+        counts = Counter()
+        for ((stack, pc), n) in self.samples.items():
+            counts[self.routineFor(stack[-1])] += n * self.interval
+
+        return counts
+
+    def cumulative(self):
+        '''Get the micro-cycles spent in every routine and in the routines it called
+
+        Returns:
+            A Counter of routine name -> micro-cycles
+        '''
+        counts = Counter()
+        for ((stack, pc), n) in self.samples.items():
+            for name in set(self.routineFor(adr) for adr in stack):
+                counts[name] += n * self.interval
+
+        return counts
+
+    def byLabel(self):
+        '''Get the micro-cycles spent after every label (eg: in every loop of a routine)
+
+        Returns:
+            A Counter of label -> micro-cycles, the PCs are named by labelFor
+        '''
+        counts = Counter()
+        for ((stack, pc), n) in self.samples.items():
+            counts[self.labelFor(pc)] += n * self.interval
+
+        return counts
+
+    def collapsed(self):
+        '''Get the samples in the collapsed stack format used by the flame graph tools
+
+        Returns:
+            A string with a "outer;inner;innermost cycles" line for every call stack
+        '''
+        counts = Counter()
+        for ((stack, pc), n) in self.samples.items():
+            counts[';'.join(self.routineFor(adr) for adr in stack)] += n * self.interval
+
+        return ''.join('{} {}\n'.format(stack, n) for (stack, n) in sorted(counts.items()))
+
+    def report(self, top=20):
+        '''Get a text report of the flat and cumulative profiles
+
+        Args:
+            top - the number of entries displayed in each table, None for all of them
+
+        Returns:
+            The report, as a string
+        '''
+        total = sum(self.samples.values()) * self.interval or 1
+        lines = ['Sampled micro-cycles: {} (every {})'.format(sum(self.samples.values()) * self.interval,
+            self.interval)]
+
+        for (title, counts) in (('Flat', self.flat()), ('Cumulative', self.cumulative()), ('Label', self.byLabel())):
+            lines += ['', '{}\tCycles\t%'.format(title)]
+            lines += ['{}\t{}\t{:.1f}'.format(name, n, 100 * n / total) for (name, n) in counts.most_common(top)]
+
+        return '\n'.join(lines) + '\n'
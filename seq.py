@@ -1,5 +1,11 @@
 from uinstr import *
 from instr import *
+from memory import Memory, MEMORY_SIZE, ADDRESS_MASK
+
+from array import array
+from collections import namedtuple, OrderedDict
+from enum import Enum, unique
+import time
 
 import pdb
 
@@ -9,86 +15,239 @@ class ExecEnd(Exception):
 class StackOverflow(Exception):
     pass
 
+class MicroprogramError(Exception):
+    pass
+
+class Breakpoint(Exception):
+    '''Raised after a micro-cycle that hit a breakpoint or a watchpoint (see breakpoints.py),
+    args[0] is the StopReason'''
+    pass
+
+@unique
+class StopReason(Enum):
+    '''Why Seq.run returned'''
+    END = 'end' # the program ended, PC left the code area
+    CYCLE_LIMIT = 'cycle limit'
+    INSTR_LIMIT = 'instruction limit'
+    PC = 'pc reached'
+    HALT = 'halt'
+    WAIT = 'wait'
+    PREDICATE = 'predicate'
+    STACK_OVERFLOW = 'stack overflow'
+    INVALID_INSTRUCTION = 'invalid instruction' # the microprogram jumped outside of the MPM
+    MEMORY_FAULT = 'memory fault' # an address outside of the memory was accessed
+    BREAKPOINT = 'breakpoint' # an MPM breakpoint, see breakpoints.py
+    WATCHPOINT = 'watchpoint' # a memory word or a register was accessed, see breakpoints.py
+
+# the result of Seq.run: the StopReason, the executed micro-cycles and (whole) instructions
+# and the time it took, in seconds
+RunResult = namedtuple('RunResult', ['reason', 'cycles', 'instructions', 'elapsed'])
+
+WORD_BITS = 16
+WORD_MASK = (1 << WORD_BITS) - 1
+WORD_SIGN = 1 << (WORD_BITS - 1)
+
+# bits of Cpu.flags
+FLAG_Z = 0b0001
+FLAG_C = 0b0010
+FLAG_V = 0b0100
+FLAG_S = 0b1000
+
+def instanceOverride(obj, name):
+    '''Get the attribute of obj that hides the method of its class with the same name (eg: an
+    execMicroInstr replaced by ExecStats), or None if there is no such attribute
+
+    obj.__dict__ is not read: on recent Pythons that makes every later attribute access on obj slower.
+    '''
+    attr = getattr(obj, name)
+    if getattr(attr, '__self__', None) is obj and getattr(attr, '__func__', None) is getattr(type(obj), name):
+        return None
+
+    return attr
+
+def toWord(val):
+    '''Wrap a number to a 16 bit two's complement word
+
+    Args:
+        val - the number to be wrapped
+
+    Returns: the signed value of the low 16 bits of val
+    '''
+    return ((val + WORD_SIGN) & WORD_MASK) - WORD_SIGN
+
+
+# the formats of the CPU state, see Cpu.__str__
+REG_HEADER = '{:<5}\t{:>5}\t{:>10}\t{:>11}\n'.format('Reg', 'Hex', 'Bin', 'Dec')
+REG_TPL = 'R{0}:\t0x{1:04X}\t0b{1:016b}\t{2}\n'
+MEM_HEADER = '{:<5}\t{:>5}\t{:>10}\t{:>11}\n'.format('Adr', 'Hex', 'Bin', 'Dec')
+MEM_TPL = '{0:04X}:\t0x{1:04X}\t0b{1:016b}\t{2}\n'
+FLAG_HEADER = '{:<5}\t{:>12}\n'.format('Flag', 'Val')
+FLAG_TPL = '{0:<10}:\t{1}\n'
+STATE_HEADER = '{:<5}\t{:>12}\n'.format('Reg', 'Val')
+STATE_TPL = '{0}:\t0x{1:04X}\t0b{1:016b}\t{2}\n'
+
+# the displayed name of every flag -> its bit in Cpu.flags
+FLAG_NAMES = OrderedDict([('(Z)ero', FLAG_Z), ('(C)arry', FLAG_C), ('O(v)erflow', FLAG_V), ('(S)ign', FLAG_S)])
+# the displayed name of every internal register -> its Cpu field
+STATE_FIELDS = OrderedDict([('IR', 'ir'), ('PC', 'pc'), ('T', 't'), ('ADR', 'adr'), ('MDR', 'mdr'), ('SP', 'sp')])
+
+def _flagProperty(bit, doc):
+    def getFlag(self):
+        return self.flags & bit != 0
+
+    def setFlag(self, val):
+        if val:
+            self.flags |= bit
+        else:
+            self.flags &= ~bit
+
+    return property(getFlag, setFlag, doc=doc)
+
+
 class Cpu(object):
-    '''Holds the CPU state'''
-    def __init__(self, memory):
-        '''Init the CPU states'''
-        self.STACK_SIZE = 32
-        self.mem = memory + [0] * self.STACK_SIZE
-        self.STACK_LIMIT = len(self.mem)
+    '''Holds the CPU state
+
+    The memory (a Memory, the whole address space) and the general registers (an array) hold
+    signed 16 bit words, the values stored in them must be wrapped with toWord first.
+    The condition flags are packed in the flags field and accessed through the z, c, v, s properties.
+
+    The stack takes the STACK_SIZE words below STACK_LIMIT. The program ends when PC leaves the
+    code, the images loaded by __init__ and load (their address ranges are in code).
+    '''
+    __slots__ = ['STACK_SIZE', 'STACK_LIMIT', 'code', 'mem', 'sp', 'ir', 'pc', 'adr', 'mdr', 't',
+        'r', 'rIndex', 'ivr', 'intr', 'flags', 'sbus', 'dbus']
+
+    def __init__(self, memory, loadAdr=0, stackBase=None, stackSize=32):
+        '''Init the CPU states
+
+        Args:
+            memory - list of words to be loaded at loadAdr, they are wrapped to 16 bits;
+                an array('h') (eg: objfile.Program.words) is copied as it is
+            loadAdr - the address of the program, where the execution starts
+            stackBase - the lowest address of the stack, None to place it right after the program
+            stackSize - the number of words in the stack
+
+        Raises:
+            ValueError - if the program or the stack do not fit in the memory
+        '''
+        self.mem = Memory()
+        self.code = ()
+        self.load(memory, loadAdr)
+
+        (start, end) = self.code[0]
+        if stackBase is None:
+            stackBase = end
+        if not 0 <= stackBase <= stackBase + stackSize <= MEMORY_SIZE or stackSize < 0:
+            raise ValueError('The stack must be inside the memory')
+        self.STACK_SIZE = stackSize
+        self.STACK_LIMIT = stackBase + stackSize
 
         self.sp = self.STACK_LIMIT
         self.ir = -1
-        self.pc = 0
+        self.pc = loadAdr
 
         self.adr = -1
         self.mdr = -1
 
         self.t = -1
 
-        self.r = [-1] * 16
+        self.r = array('h', [-1] * 16)
         self.rIndex = -1
 
         self.ivr = 0
         self.intr = False
 
-        self.z = False
-        self.c = False
-        self.v = False
-        self.s = False
+        self.flags = 0
 
         self.sbus = 0
         self.dbus = 0
         #TODO bvi
 
-    def _regToStr(self):
-        REG_TPL = 'R{0}:\t0x{1:04X}\t0b{1:016b}\t{2}\n'
-        retval = '{:<5}\t{:>5}\t{:>10}\t{:>11}\n'.format('Reg', 'Hex', 'Bin', 'Dec')
+    z = _flagProperty(FLAG_Z, 'Zero flag')
+    c = _flagProperty(FLAG_C, 'Carry flag')
+    v = _flagProperty(FLAG_V, 'Overflow flag')
+    s = _flagProperty(FLAG_S, 'Sign flag')
 
-        for i in range(0,16):
-            retval += REG_TPL.format(i, self._toTwosComplement(self.r[i]), self.r[i])
+    def load(self, words, adr):
+        '''Load an image of code (eg: a routine called by the program) in memory
 
-        return retval
+        Args:
+            words - list of words, they are wrapped to 16 bits; an array('h') is copied as it is
+            adr - the address of the first word
 
-    def _memToStr(self):
-        MEM_TPL = '{0:04X}:\t0x{1:04X}\t0b{1:016b}\t{2}\n'
-        retval = '{:<5}\t{:>5}\t{:>10}\t{:>11}\n'.format('Adr', 'Hex', 'Bin', 'Dec')
+        Raises:
+            ValueError - if the image does not fit in the memory
+        '''
+        if not (isinstance(words, array) and words.typecode == 'h'):
+            words = array('h', [toWord(word) for word in words])
+        if not 0 <= adr <= adr + len(words) <= MEMORY_SIZE:
+            raise ValueError('The image must be inside the memory')
 
-        for i in range(0,len(self.mem) - self.STACK_SIZE):
-            retval += MEM_TPL.format(i, self._toTwosComplement(self.mem[i]), self.mem[i])
+        self.mem.load(words, adr)
+        self.code += ((adr, adr + len(words)),)
 
-        retval += 'Stack:\n'
-        for i in range(len(self.mem) - self.STACK_SIZE, len(self.mem)):
-            retval += MEM_TPL.format(i, self._toTwosComplement(self.mem[i]), self.mem[i])
+    def inCode(self, adr):
+        '''Check if an instruction can be fetched from adr, ie: adr is in one of the images loaded'''
+        for (start, end) in self.code:
+            if start <= adr < end:
+                return True
 
-        return retval
+        return False
 
-    def _flagsToStr(self):
-        FLAG_TPL = '{0:<10}:\t{1}\n'
-        retval = '{:<5}\t{:>12}\n'.format('Flag', 'Val')
+    def _regLines(self, indices=range(16)):
+        '''Format the given general registers, a line for each one'''
+        return [REG_TPL.format(i, self._toTwosComplement(self.r[i]), self.r[i]) for i in indices]
 
-        retval += FLAG_TPL.format('(Z)ero', self.z)
-        retval += FLAG_TPL.format('(C)arry', self.c)
-        retval += FLAG_TPL.format('O(v)erflow', self.v)
-        retval += FLAG_TPL.format('(S)ign', self.s)
+    def _memLines(self, adrs):
+        '''Format the words at the given (increasing) addresses, a line for each one
 
-        return retval
+        A "Stack:" line is inserted before the first address in the stack.
+        '''
+        stack = self.STACK_LIMIT - self.STACK_SIZE
+        lines = []
+        for adr in adrs:
+            if stack <= adr < self.STACK_LIMIT:
+                lines.append('Stack:\n')
+                stack = self.STACK_LIMIT
+            lines.append(MEM_TPL.format(adr, self._toTwosComplement(self.mem[adr]), self.mem[adr]))
 
-    def _internalStateToStr(self):
-        STATE_TPL = '{0}:\t0x{1:04X}\t0b{1:016b}\t{2}\n'
-        retval = '{:<5}\t{:>12}\n'.format('Reg', 'Val')
+        return lines
+
+    def _flagLines(self, names=FLAG_NAMES):
+        '''Format the given flags (names from FLAG_NAMES), a line for each one'''
+        return [FLAG_TPL.format(name, self.flags & FLAG_NAMES[name] != 0) for name in names]
 
-        retval += STATE_TPL.format('IR', self._toTwosComplement(self.ir), self.ir)
-        retval += STATE_TPL.format('PC', self._toTwosComplement(self.pc), self.pc)
-        retval += STATE_TPL.format('T', self._toTwosComplement(self.t), self.t)
-        retval += STATE_TPL.format('ADR', self._toTwosComplement(self.adr), self.adr)
-        retval += STATE_TPL.format('MDR', self._toTwosComplement(self.mdr), self.mdr)
-        retval += STATE_TPL.format('SP', self._toTwosComplement(self.sp), self.sp)
+    def _internalStateLines(self, names=STATE_FIELDS):
+        '''Format the given internal registers (names from STATE_FIELDS), a line for each one'''
+        lines = []
+        for name in names:
+            val = getattr(self, STATE_FIELDS[name])
+            lines.append(STATE_TPL.format(name, self._toTwosComplement(val), val))
 
-        return retval
+        return lines
+
+    def _regToStr(self):
+        return REG_HEADER + ''.join(self._regLines())
+
+    def _memToStr(self, start=None, count=None):
+        '''Format count words of the memory from start (to its end if count is None),
+        or the code and the stack if start is None'''
+        if start is None:
+            adrs = [adr for (first, end) in self.code for adr in range(first, end)]
+            adrs.extend(range(self.STACK_LIMIT - self.STACK_SIZE, self.STACK_LIMIT))
+        else:
+            adrs = range(max(start, 0), len(self.mem) if count is None else min(start + count, len(self.mem)))
+
+        return MEM_HEADER + ''.join(self._memLines(adrs))
+
+    def _flagsToStr(self):
+        return FLAG_HEADER + ''.join(self._flagLines())
+
+    def _internalStateToStr(self):
+        return STATE_HEADER + ''.join(self._internalStateLines())
 
     def __str__(self):
-        return self._regToStr() + self. _flagsToStr() + self._memToStr() + self._internalStateToStr()
+        return ''.join([self._regToStr(), self._flagsToStr(), self._memToStr(), self._internalStateToStr()])
 
     def _toTwosComplement(self, x, num_bits=16):
         '''Turn a number to its two's complement representation
@@ -106,13 +265,197 @@ class Cpu(object):
         return twos_complement
 
 
+# the offset of the entries that do not decode to an instruction, it sends the sequencer outside of the MPM
+INVALID_OFFSET = 0x7FFF
+
+# where each group's instructions are in IR: the opcode is IR >> shift
+GROUP_SHIFTS = {Group.TWO_OP: 12, Group.BRANCH: 8, Group.ONE_OP: 6, Group.OTHER: 0}
+
+def buildIndexTable():
+    '''Precompute the offset that every Index field adds to the next microinstruction address,
+    for every possible IR
+
+    The OPCODE, ONE_OP and TWO_OP offsets are the distance between the instruction and the first
+    one in its group (BR, CLR, MOV), this implies that the MPM must have the same order
+    as the instructions appear in the enums. Every microroutine takes 2 microinstructions,
+    except CALL which takes 4, so the ONE_OP instructions after it are shifted by 2.
+
+    Returns:
+        A list indexed by Index, each element is an array of 2 ** 16 offsets, indexed by IR
+    '''
+    def noGroup(opcode):
+        return opcode - getOpcodeGroup(opcode)
+
+    size = 2 ** 16
+    table = [array('h', [0]) * size for i in range(len(Index))]
+    for index in [Index.OPCODE, Index.ONE_OP, Index.TWO_OP]:
+        table[index] = array('h', [INVALID_OFFSET]) * size
+
+    for opcode in OpCode:
+        shift = GROUP_SHIFTS[getOpcodeGroup(opcode)]
+        first = opcode << shift
+        last = ((opcode + 1) << shift) - 1
+
+        # every IR in [first, last] must decode to opcode, otherwise the groups overlap
+        if getOpcode(first) != opcode or getOpcode(last) != opcode:
+            raise MicroprogramError('The encoding of {} overlaps with another instruction'
+                .format(opcode.name))
+
+        count = last - first + 1
+        offsets = [
+            (Index.OPCODE, (noGroup(opcode) - noGroup(OpCode.BR)) * 2),
+            (Index.ONE_OP, (noGroup(opcode) - noGroup(OpCode.CLR)) * 2 +
+                (2 if noGroup(opcode) > noGroup(OpCode.CALL) else 0)),
+            (Index.TWO_OP, (noGroup(opcode) - noGroup(OpCode.MOV)) * 2),
+        ]
+        for (index, offset) in offsets:
+            table[index][first:last + 1] = array('h', [offset]) * count
+
+    table[Index.MAS] = array('h', [getMas(ir) * 2 for ir in range(size)])
+    table[Index.MAD] = array('h', [getMad(ir) * 2 for ir in range(size)])
+
+    return table
+
+
+def buildNoMicroroutineTable(mpm, labels):
+    '''Find the instructions whose microroutine is not written yet: their label points to an empty
+    microinstruction, which goes back to IFCH1 without fetching another instruction
+
+    Args:
+        mpm - the microprogram memory
+        labels - dict from microroutine name to its address in the MPM (eg: MPM_LABELS)
+
+    Returns:
+        A bytearray of 2 ** 16 entries indexed by IR, 1 for the IRs of such instructions
+    '''
+    empty = build_uinstr()
+    table = bytearray(2 ** 16)
+    for opcode in OpCode:
+        adr = labels.get(opcode.name)
+        if adr is not None and mpm[adr] == empty:
+            shift = GROUP_SHIFTS[getOpcodeGroup(opcode)]
+            table[opcode << shift:(opcode + 1) << shift] = b'\x01' * (1 << shift)
+
+    return table
+
+
+def validateIndexTable(table, umpm, labels):
+    '''Check that every instruction and addressing mode is dispatched to its microroutine
+
+    Args:
+        table - the table built by buildIndexTable
+        umpm - the predecoded MPM
+        labels - dict from microroutine name to its address in the MPM (eg: MPM_LABELS)
+
+    Raises:
+        MicroprogramError - if a microinstruction dispatches to the wrong microroutine
+    '''
+    groups = {
+        Index.OPCODE: [Group.BRANCH, Group.OTHER],
+        Index.ONE_OP: [Group.ONE_OP],
+        Index.TWO_OP: [Group.TWO_OP],
+    }
+    routines = set(labels.values())
+
+    def check(adr, target, name, expected):
+        if expected is None:
+            # no microroutine yet, it must not end up in another one
+            if target in routines:
+                raise MicroprogramError('{} (from {}) is dispatched to the microroutine at {}, but it has none'
+                    .format(name, adr, target))
+        elif target != expected:
+            raise MicroprogramError('{} (from {}) is dispatched to {}, but its microroutine is at {}'
+                .format(name, adr, target, expected))
+
+    for (adr, u) in enumerate(umpm):
+        for (address, index) in [(u.address_true, u.index_true), (u.address_false, u.index_false)]:
+            if index in groups:
+                for opcode in OpCode:
+                    group = getOpcodeGroup(opcode)
+                    if group in groups[index]:
+                        target = address + table[index][opcode << GROUP_SHIFTS[group]]
+                        check(adr, target, opcode.name, labels.get(opcode.name))
+            elif index == Index.MAS:
+                for mode in AddrMode:
+                    target = address + table[index][mode << 10]
+                    check(adr, target, SRC_FETCH_LABELS[mode], labels.get(SRC_FETCH_LABELS[mode]))
+            elif index == Index.MAD:
+                for mode in AddrMode:
+                    target = address + table[index][mode << 4]
+                    check(adr, target, DST_FETCH_LABELS[mode], labels.get(DST_FETCH_LABELS[mode]))
+
+
+INDEX_TABLE = buildIndexTable()
+
+# the (MPM, labels) pairs already checked by validateIndexTable -> their buildNoMicroroutineTable
+_validated = {}
+
+# the table of buildNoMicroroutineTable when there are no labels to find the microroutines
+_NO_LABELS = bytes(2 ** 16)
+
+# MPM contents -> the result of predecode, shared by all the sequencers running the same microprogram
+_predecoded = {}
+
+
+def irIndexToOffset(index, ir):
+    '''Compute the offset that an Index field adds to the next microinstruction address
+
+    Args:
+        index - the Index field of the microinstruction
+        ir - the instruction being executed
+
+    Returns:
+        The offset relative to the address field of the microinstruction
+    '''
+    return INDEX_TABLE[index][ir]
+
+
+def buildDispatchTable(size, handlers, default):
+    '''Build a table that maps every value of a microinstruction field to its handler
+
+    Args:
+        size - the size (in bits) of the field
+        handlers - dict from the field value (eg: SBus.REG) to the function implementing it
+        default - the function used for the values that have no handler
+
+    Returns:
+        A list of 2 ** size functions, indexed by the numerical value of the field
+    '''
+    table = [default] * (2 ** size)
+    for value, handler in handlers.items():
+        table[value] = handler
+
+    return table
+
+
 class Seq(object):
     '''Implements the sequencer automaton for a given CPU and microprogram memory'''
-    def __init__(self, mpm, cpu):
-        '''Init the class as if the computer just booted up'''
-        self.mir = None # micro instruction register
+    def __init__(self, mpm, cpu, labels=MPM_LABELS):
+        '''Init the class as if the computer just booted up
+
+        Args:
+            mpm - the microprogram memory
+            cpu - the Cpu to run
+            labels - the addresses of the microroutines in mpm (see MPM_LABELS), used to check
+                that the instructions are dispatched to their microroutines, None skips the check
+
+        Raises:
+            MicroprogramError - if an instruction is dispatched to the wrong microroutine
+        '''
         self.mar = 0 # micro instruction address register
         self.mpm = mpm # micro program memory
+        key = tuple(mpm)
+        if key not in _predecoded:
+            _predecoded[key] = tuple(predecode(mpm))
+        self.umpm = _predecoded[key] # the MPM with every field already decoded
+
+        self.noMicroroutine = _NO_LABELS # IR -> 1 if its microroutine is not written yet
+        if labels is not None:
+            key = (key, tuple(labels.items()))
+            if key not in _validated:
+                validateIndexTable(INDEX_TABLE, self.umpm, labels)
+                _validated[key] = buildNoMicroroutineTable(mpm, labels)
+            self.noMicroroutine = _validated[key]
 
         self.cpu = cpu
 
@@ -121,79 +464,196 @@ class Seq(object):
         self.v = False
         self.s = False
 
+        self._buildDispatchTables()
+
+    def _buildDispatchTables(self):
+        '''Bind every micro-operation code to the method implementing it'''
+        self.sbusTable = buildDispatchTable(SBUS_SIZE, {
+            SBus.NONE: self._sbusZero,
+            SBus.ZERO: self._sbusZero,
+            SBus.REG: self._sbusReg,
+            SBus.T: self._sbusT,
+            SBus.MDR: self._sbusMdr,
+            SBus.IR_OFFSET: self._sbusIrOffset,
+            SBus.MINUS_ONE: self._sbusMinusOne,
+            SBus.ONE: self._sbusOne,
+        }, self._sbusInvalid)
+
+        self.dbusTable = buildDispatchTable(DBUS_SIZE, {
+            DBus.NONE: self._dbusZero,
+            DBus.ZERO: self._dbusZero,
+            DBus.PC: self._dbusPc,
+            DBus.REG: self._dbusReg,
+            DBus.MDR: self._dbusMdr,
+            DBus.NOT_MDR: self._dbusNotMdr,
+            DBus.T: self._dbusT,
+            DBus.SP: self._dbusSp,
+        }, self._dbusInvalid)
+
+        self.rbusTable = buildDispatchTable(RBUS_SIZE, {
+            RBus.ADR: self._rbusAdr,
+            RBus.T: self._rbusT,
+            RBus.MDR: self._rbusMdr,
+            RBus.REG: self._rbusReg,
+            RBus.PC: self._rbusPc,
+        }, self._rbusNone)
+
+        self.aluTable = buildDispatchTable(ALU_SIZE, {
+            Alu.SUM: self._aluSum,
+            Alu.SUB: self._aluSub,
+            Alu.AND: self._aluAnd,
+            Alu.OR: self._aluOr,
+            Alu.XOR: self._aluXor,
+            Alu.ASL: self._aluAsl,
+            Alu.ASR: self._aluAsr,
+            #TODO: continue here
+        }, self._aluNone)
+
+        self.miscTable = buildDispatchTable(MISC_SIZE, {
+            Misc.INC_PC: self._miscIncPc,
+            Misc.COND: self._miscCond,
+            Misc.SET_C: self._miscSetC,
+            Misc.SET_V: self._miscSetV,
+            Misc.SET_Z: self._miscSetZ,
+            Misc.SET_S: self._miscSetS,
+            Misc.CLEAR_C: self._miscClearC,
+            Misc.CLEAR_V: self._miscClearV,
+            Misc.CLEAR_Z: self._miscClearZ,
+            Misc.CLEAR_S: self._miscClearS,
+            Misc.SET_FLAG: self._miscSetFlag,
+            Misc.CLEAR_FLAG: self._miscClearFlag,
+            Misc.INC_SP: self._miscIncSp,
+            Misc.DEC_SP: self._miscDecSp,
+        }, self._nop)
+
+        self.memTable = buildDispatchTable(MEM_SIZE, {
+            Mem.IFCH: self._memIfch,
+            Mem.READ: self._memRead,
+            Mem.WRITE: self._memWrite,
+        }, self._nop)
+
+        self.condTable = buildDispatchTable(COND_SIZE, {
+            Cond.NO_OP: self._condNoOp,
+            Cond.ONE_OP: self._condOneOp,
+            Cond.REG_DEST: self._condRegDest,
+            Cond.INT: self._condInt,
+            Cond.Z: self._condZ,
+            Cond.NZ: self._condNZ,
+            Cond.S: self._condS,
+            Cond.NS: self._condNS,
+            Cond.V: self._condV,
+            Cond.NV: self._condNV,
+            Cond.C: self._condC,
+            Cond.NC: self._condNC,
+        }, self._condTrue)
+
+    def _nop(self):
+        pass
+
+    def _sbusZero(self):
+        self.cpu.sbus = 0
+
+    def _sbusReg(self):
+        self.cpu.rIndex = getRs(self.cpu.ir)
+        self.cpu.sbus = self.cpu.r[self.cpu.rIndex]
+
+    def _sbusT(self):
+        self.cpu.sbus = self.cpu.t
+
+    def _sbusMdr(self):
+        self.cpu.sbus = self.cpu.mdr
+
+    def _sbusIrOffset(self):
+        # BRs are relative to the current PC
+        self.cpu.sbus = getBrOffset(self.cpu.ir) - self.cpu.pc
+
+    def _sbusMinusOne(self):
+        self.cpu.sbus = -1
+
+    def _sbusOne(self):
+        self.cpu.sbus = 1
+
+    def _sbusInvalid(self):
+        self.cpu.sbus = None
+
     def setSBus(self, sbus):
-        if sbus == SBus.NONE or sbus == SBus.ZERO:
-            self.cpu.sbus = 0
-        elif sbus == SBus.REG:
-            self.cpu.rIndex = getRs(self.cpu.ir)
-            self.cpu.sbus = self.cpu.r[self.cpu.rIndex]
-        elif sbus == SBus.T:
-            self.cpu.sbus = self.cpu.t
-        elif sbus == SBus.MDR:
-            self.cpu.sbus = self.cpu.mdr
-        elif sbus == SBus.IR_OFFSET:
-            # BRs are relative to the current PC
-            self.cpu.sbus = getBrOffset(self.cpu.ir) - self.cpu.pc
-        elif sbus == SBus.MINUS_ONE:
-            self.cpu.sbus = -1
-        elif sbus == SBus.ONE:
-            self.cpu.sbus = 1
-        else:
-            self.cpu.sbus = None
+        self.sbusTable[sbus]()
+
+    def _dbusZero(self):
+        self.cpu.dbus = 0
+
+    def _dbusPc(self):
+        self.cpu.dbus = self.cpu.pc
+
+    def _dbusReg(self):
+        self.cpu.rIndex = getRd(self.cpu.ir)
+        self.cpu.dbus = self.cpu.r[self.cpu.rIndex]
+
+    def _dbusMdr(self):
+        self.cpu.dbus = self.cpu.mdr
+
+    def _dbusNotMdr(self):
+        self.cpu.dbus = ~self.cpu.mdr
+
+    def _dbusT(self):
+        self.cpu.dbus = self.cpu.t
+
+    def _dbusSp(self):
+        self.cpu.dbus = self.cpu.sp
+
+    def _dbusInvalid(self):
+        self.cpu.dbus = None
 
     def setDBus(self, dbus):
-        if dbus == DBus.NONE or dbus == DBus.ZERO:
-            self.cpu.dbus = 0
-        elif dbus == DBus.PC:
-            self.cpu.dbus = self.cpu.pc
-        elif dbus == DBus.REG:
-            self.cpu.rIndex = getRd(self.cpu.ir)
-            self.cpu.dbus = self.cpu.r[self.cpu.rIndex]
-        elif dbus == DBus.MDR:
-            self.cpu.dbus = self.cpu.mdr
-        elif dbus == DBus.NOT_MDR:
-            self.cpu.dbus = ~self.cpu.mdr
-        elif dbus == DBus.T:
-            self.cpu.dbus = self.cpu.t
-        elif dbus == DBus.SP:
-            self.cpu.dbus = self.cpu.sp
-        else:
-            self.cpu.dbus = None
+        self.dbusTable[dbus]()
+
+    def _rbusAdr(self, val):
+        self.cpu.adr = val
+
+    def _rbusT(self, val):
+        self.cpu.t = val
+
+    def _rbusMdr(self, val):
+        self.cpu.mdr = val
+
+    def _rbusReg(self, val):
+        self.cpu.r[self.cpu.rIndex] = toWord(val)
+
+    def _rbusPc(self, val):
+        self.cpu.pc = val & ADDRESS_MASK
+
+    def _rbusNone(self, val):
+        pass
 
     def setRBus(self, rbus, val):
-        if rbus == RBus.ADR:
-            self.cpu.adr = val
-        elif rbus == RBus.T:
-            self.cpu.t = val
-        elif rbus == RBus.MDR:
-            self.cpu.mdr = val
-        elif rbus == RBus.REG:
-            self.cpu.r[self.cpu.rIndex] = val
-        elif rbus == RBus.PC:
-            self.cpu.pc = val
-        elif rbus == RBus.NONE:
-            pass
+        self.rbusTable[rbus](val)
+
+    def _aluNone(self):
+        return None
+
+    def _aluSum(self):
+        return self.cpu.sbus + self.cpu.dbus
+
+    def _aluSub(self):
+        return self.cpu.sbus - self.cpu.dbus
+
+    def _aluAnd(self):
+        return self.cpu.sbus & self.cpu.dbus
+
+    def _aluOr(self):
+        return self.cpu.sbus | self.cpu.dbus
+
+    def _aluXor(self):
+        return self.cpu.sbus ^ self.cpu.dbus
+
+    def _aluAsl(self):
+        return self.cpu.dbus << 1
+
+    def _aluAsr(self):
+        return self.cpu.dbus >> 1
 
     def execAlu(self, op):
-        rval = None
-
-        if op == Alu.NONE:
-            pass
-        elif op == Alu.SUM:
-            rval = self.cpu.sbus + self.cpu.dbus
-        elif op == Alu.SUB:
-            rval = self.cpu.sbus - self.cpu.dbus
-        elif op == Alu.AND:
-            rval = self.cpu.sbus & self.cpu.dbus
-        elif op == Alu.OR:
-            rval = self.cpu.sbus | self.cpu.dbus
-        elif op == Alu.XOR:
-            rval = self.cpu.sbus ^ self.cpu.dbus
-        elif op == Alu.ASL:
-            rval = self.cpu.dbus << 1
-        elif op == Alu.ASR:
-            rval = self.cpu.dbus >> 1
-            #TODO: continue here
+        rval = self.aluTable[op]()
 
         if rval != None:
             self.z = rval == 0
@@ -203,159 +663,266 @@ class Seq(object):
 
         return rval
 
+    def _miscIncPc(self):
+        self.cpu.pc = (self.cpu.pc + 1) & ADDRESS_MASK
+
+    def _miscCond(self):
+        self.cpu.z = self.z
+        self.cpu.c = self.c
+        self.cpu.v = self.v
+        self.cpu.s = self.s
+
+    def _miscSetC(self):
+        self.cpu.c = True
+
+    def _miscSetV(self):
+        self.cpu.v = True
+
+    def _miscSetZ(self):
+        self.cpu.z = True
+
+    def _miscSetS(self):
+        self.cpu.s = True
+
+    def _miscClearC(self):
+        self.cpu.c = False
+
+    def _miscClearV(self):
+        self.cpu.v = False
+
+    def _miscClearZ(self):
+        self.cpu.z = False
+
+    def _miscClearS(self):
+        self.cpu.s = False
+
+    def _miscSetFlag(self):
+        self.cpu.c = True
+        self.cpu.v = True
+        self.cpu.s = True
+        self.cpu.z = True
+
+    def _miscClearFlag(self):
+        self.cpu.c = False
+        self.cpu.v = False
+        self.cpu.s = False
+        self.cpu.z = False
+
+    def _miscIncSp(self):
+        self.cpu.sp += 1
+
+    def _miscDecSp(self):
+        if self.cpu.sp > self.cpu.STACK_LIMIT - self.cpu.STACK_SIZE:
+            self.cpu.sp -= 1
+        else:
+            raise StackOverflow()
+
     def execMisc(self, op):
-        if op == Misc.INC_PC:
-            self.cpu.pc += 1
-        if op == Misc.CLEAR_C:
-            self.cpu.c = False
-        elif op == Misc.COND:
-            self.cpu.z = self.z
-            self.cpu.c = self.c
-            self.cpu.v = self.v
-            self.cpu.s = self.s
-        elif op == Misc.SET_C:
-            self.cpu.c = True
-        elif op == Misc.SET_V:
-            self.cpu.v = True
-        elif op == Misc.SET_Z:
-            self.cpu.z = True
-        elif op == Misc.SET_S:
-            self.cpu.s = True
-        elif op == Misc.CLEAR_C:
-            self.cpu.c = False
-        elif op == Misc.CLEAR_V:
-            self.cpu.v = False
-        elif op == Misc.CLEAR_Z:
-            self.cpu.z = False
-        elif op == Misc.CLEAR_S:
-            self.cpu.s = False
-        elif op == Misc.SET_FLAG:
-            self.cpu.c = True
-            self.cpu.v = True
-            self.cpu.s = True
-            self.cpu.z = True
-        elif op == Misc.CLEAR_FLAG:
-            self.cpu.c = False
-            self.cpu.v = False
-            self.cpu.s = False
-            self.cpu.z = False
-        elif op == Misc.INC_SP:
-            self.cpu.sp += 1
-        elif op == Misc.DEC_SP:
-            if self.cpu.sp > self.cpu.STACK_LIMIT - self.cpu.STACK_SIZE:
-                self.cpu.sp -= 1
-            else:
-                raise StackOverflow()
-        elif op == Misc.NONE:
-            pass
+        self.miscTable[op]()
+
+    def _memIfch(self):
+        if not self.cpu.inCode(self.cpu.pc):
+            raise ExecEnd() # PC left the code
+        self.cpu.ir = self.cpu.mem[self.cpu.pc] & WORD_MASK
+
+    def _memRead(self):
+        self.cpu.mdr = self.cpu.mem[self.cpu.adr]
+
+    def _memWrite(self):
+        self.cpu.mem[self.cpu.adr] = toWord(self.cpu.mdr)
 
     def execMem(self, mem):
-        if mem == Mem.IFCH:
-            if self.cpu.pc >= self.cpu.STACK_LIMIT - self.cpu.STACK_SIZE:
-                raise ExecEnd() # do not execute code from the stack
-            try:
-                self.cpu.ir = self.cpu.mem[self.cpu.pc]
-            except IndexError:
-                raise ExecEnd()
-        elif mem == Mem.READ:
-            self.cpu.mdr = self.cpu.mem[self.cpu.adr]
-        elif mem == Mem.WRITE:
-            self.cpu.mem[self.cpu.adr] = self.cpu.mdr
-        elif mem == Mem.NONE:
-            pass
+        self.memTable[mem]()
 
-    def testCond(self, cond):
-        rval = True
-
-        if cond == Cond.TRUE:
-            pass
-        elif cond == Cond.NO_OP:
-            group = getOpcodeGroup(getOpcode(self.cpu.ir))
-            rval = group != Group.ONE_OP and group != Group.TWO_OP
-        elif cond == Cond.ONE_OP:
-            group = getOpcodeGroup(getOpcode(self.cpu.ir))
-            rval = group == Group.ONE_OP
-        elif cond == Cond.REG_DEST:
-            rval = AddrMode.DIRECT == AddrMode(getMad(self.cpu.ir))
-        elif cond == Cond.INT:
-            rval = self.cpu.intr
-        elif cond == Cond.Z:
-            rval = self.cpu.z
-        elif cond == Cond.NZ:
-            rval = not self.cpu.z
-        elif cond == Cond.S:
-            rval = self.cpu.s
-        elif cond == Cond.NS:
-            rval = not self.cpu.s
-        elif cond == Cond.V:
-            rval = self.cpu.v
-        elif cond == Cond.NV:
-            rval = not self.cpu.v
-        elif cond == Cond.C:
-            rval = self.cpu.c
-        elif cond == Cond.NC:
-            rval = not self.cpu.c
+    def _condTrue(self):
+        return True
 
-        return rval
+    def _condNoOp(self):
+        group = decode(self.cpu.ir).group
+        return group != Group.ONE_OP and group != Group.TWO_OP
+
+    def _condOneOp(self):
+        return decode(self.cpu.ir).group == Group.ONE_OP
+
+    def _condRegDest(self):
+        return AddrMode.DIRECT == AddrMode(getMad(self.cpu.ir))
+
+    def _condInt(self):
+        return self.cpu.intr
+
+    def _condZ(self):
+        return self.cpu.z
+
+    def _condNZ(self):
+        return not self.cpu.z
+
+    def _condS(self):
+        return self.cpu.s
+
+    def _condNS(self):
+        return not self.cpu.s
+
+    def _condV(self):
+        return self.cpu.v
+
+    def _condNV(self):
+        return not self.cpu.v
+
+    def _condC(self):
+        return self.cpu.c
+
+    def _condNC(self):
+        return not self.cpu.c
+
+    @property
+    def mir(self):
+        '''The micro instruction register: the microinstruction at MAR, executed by the next micro-cycle
+        (None if MAR is outside of the MPM)
+
+        It is loaded from the MPM at the start of every micro-cycle, so it is derived from MAR
+        instead of being stored by execMicroInstr.
+        '''
+        if self.mar < len(self.mpm):
+            return self.mpm[self.mar]
+
+        return None
+
+    def testCond(self, cond):
+        return self.condTable[cond]()
 
     def indexToOffset(self, index):
-        rval = None
-
-        if index == Index.NONE:
-            rval = 0
-        elif index == Index.MAS:
-            rval = getMas(self.cpu.ir)
-        elif index == Index.MAD:
-            rval = getMad(self.cpu.ir)
-        elif index == Index.OPCODE:
-            # get the offset between the current instruction and the BR one
-            # this implies that the MPM must have the same order as the instructions appear
-            # in the enums
-            br_ir = encode_br(OpCode.BR, 0)[0]
-            rval = (getOpcodeNoGroup(self.cpu.ir) - getOpcodeNoGroup(br_ir))
-        elif index == Index.ONE_OP:
-            # get the offset between the current instruction and the CLR one
-            # this implies that the MPM must have the same order as the instructions appear
-            # in the enums
-            one_op_ir = encode_one_op(OpCode.CLR, AddrMode.DIRECT, 0)[0]
-            rval = (getOpcodeNoGroup(self.cpu.ir) - getOpcodeNoGroup(one_op_ir))
-        elif index == Index.TWO_OP:
-            # get the offset between the current instruction and the MOVE one
-            # this implies that the MPM must have the same order as the instructions appear
-            # in the enums
-            two_op_ir = encode_two_op(OpCode.MOV, AddrMode.DIRECT, 0, AddrMode.DIRECT, 0)[0]
-            rval = (getOpcodeNoGroup(self.cpu.ir) - getOpcodeNoGroup(two_op_ir))
-
-        rval *= 2
-        # the CALL microroutie has 4 (not 2) micro-instructions, so I need to shift the rest in that group by 2
-        if index == Index.ONE_OP and \
-            getOpcodeNoGroup(self.cpu.ir) > getOpcodeNoGroup(encode_one_op(OpCode.CALL, AddrMode.IMMEDIATE, 0)[0]):
-            rval += 2
-        return rval
+        return INDEX_TABLE[index][self.cpu.ir]
 
     def execMicroInstr(self):
         '''Execute a microinstruction'''
-        self.mir = self.mpm[self.mar]
-
-        self.setSBus(getSBus(self.mir))
-        self.setDBus(getDBus(self.mir))
-        alu_res = self.execAlu(getAlu(self.mir))
-        self.setRBus(getRBus(self.mir), alu_res)
-        self.execMem(getMem(self.mir))
-        self.execMisc(getMisc(self.mir))
+        (sbus, dbus, alu, rbus, misc, mem, cond,
+            address_true, address_false, index_true, index_false) = self.umpm[self.mar]
+
+        self.sbusTable[sbus]()
+        self.dbusTable[dbus]()
+        alu_res = self.aluTable[alu]()
+        if alu_res != None:
+            self.z = alu_res == 0
+            self.s = alu_res < 0
+        self.rbusTable[rbus](alu_res)
+        self.memTable[mem]()
+        self.miscTable[misc]()
 
         adr = 0
         index = 0
-        if self.testCond(getCond(self.mir)):
-            adr = getAddressTrue(self.mir)
-            index = self.indexToOffset(getIndexTrue(self.mir))
+        if self.condTable[cond]():
+            adr = address_true
+            index = INDEX_TABLE[index_true][self.cpu.ir]
         else:
-            adr = getAddressFalse(self.mir)
-            index = self.indexToOffset(getIndexFalse(self.mir))
+            adr = address_false
+            index = INDEX_TABLE[index_false][self.cpu.ir]
 
         # the addresses in the MPM are absolute
         self.mar = adr + index
 
+    def _boundaryStop(self, first, instructions, maxInstrs, stopAt, stopOnHalt, predicates):
+        '''Check the stop conditions tested between two instructions
+
+        Args:
+            first - True if nothing has been executed yet, the PC and predicate
+                conditions are not tested then, so a run can resume from where it stopped
+
+        Returns:
+            The StopReason, or None if the execution can go on
+        '''
+        cpu = self.cpu
+        pc = cpu.pc
+        if not cpu.inCode(pc):
+            return StopReason.END
+        if maxInstrs is not None and instructions >= maxInstrs:
+            return StopReason.INSTR_LIMIT
+        if not first:
+            if pc in stopAt:
+                return StopReason.PC
+            for predicate in predicates:
+                if predicate(self):
+                    return StopReason.PREDICATE
+        word = cpu.mem[pc] & WORD_MASK
+        if self.noMicroroutine[word]:
+            # its microroutine would go back to IFCH1 without fetching, forever
+            return StopReason.INVALID_INSTRUCTION
+        if stopOnHalt:
+            # the OTHER instructions have no operands
+            if word == OpCode.HALT:
+                return StopReason.HALT
+            if word == OpCode.WAIT:
+                return StopReason.WAIT
+
+        return None
+
+    def _indexErrorReason(self):
+        '''Get the StopReason for an IndexError raised while executing a microinstruction'''
+        if self.mar >= len(self.mpm):
+            return StopReason.INVALID_INSTRUCTION
+
+        return StopReason.MEMORY_FAULT
+
+    def run(self, maxCycles=None, maxInstrs=None, stopAt=(), stopOnHalt=True, predicates=()):
+        '''Execute microinstructions until a stop condition is met
+
+        Unlike stepping with execMicroInstr, the end of the program is detected before
+        the instruction fetch, so no exception is raised when the program ends.
+        The PC, instruction and predicate conditions are tested only between two instructions.
+
+        Args:
+            maxCycles - the maximum number of micro-cycles to execute, None for no limit
+            maxInstrs - the maximum number of instructions to execute, None for no limit
+            stopAt - the PC values to stop at (before the instruction there is executed)
+            stopOnHalt - stop before executing HALT or WAIT, which have no microroutine
+            predicates - functions taking this Seq, the execution stops when one returns True
+
+        The instructions whose microroutine is not written yet (see buildNoMicroroutineTable) are
+        not executed: the run stops before them with StopReason.INVALID_INSTRUCTION.
+
+        Returns:
+            A RunResult
+        '''
+        stopAt = frozenset(stopAt)
+        predicates = tuple(predicates)
+        execMicroInstr = self.execMicroInstr
+
+        cycles = 0
+        instructions = 0
+        reason = None
+        start = time.perf_counter()
+        try:
+            while True:
+                if self.mar == 0:
+                    reason = self._boundaryStop(cycles == 0, instructions, maxInstrs,
+                        stopAt, stopOnHalt, predicates)
+                    if reason is not None:
+                        break
+
+                if maxCycles is not None and cycles >= maxCycles:
+                    reason = StopReason.CYCLE_LIMIT
+                    break
+
+                execMicroInstr()
+                cycles += 1
+                if self.mar == 0:
+                    instructions += 1
+        except Breakpoint as e:
+            # the micro-cycle was completed
+            cycles += 1
+            if self.mar == 0:
+                instructions += 1
+            reason = e.args[0]
+        except ExecEnd:
+            reason = StopReason.END
+        except StackOverflow:
+            reason = StopReason.STACK_OVERFLOW
+        except IndexError:
+            reason = self._indexErrorReason()
+        except ValueError: # IR does not hold a valid instruction
+            reason = StopReason.INVALID_INSTRUCTION
+
+        return RunResult(reason, cycles, instructions, time.perf_counter() - start)
+
     def showMem(self):
         return self.cpu._memToStr()
 
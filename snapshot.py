@@ -0,0 +1,173 @@
+from uinstr import MPM
+from seq import Seq, Cpu
+from memory import Memory, MEMORY_SIZE, PAGE_SIZE, PAGE_COUNT, ZERO_BYTES
+
+from array import array
+import struct
+import sys
+
+# the Cpu fields saved in a snapshot, besides the code ranges, the memory and the general registers
+CPU_FIELDS = ['STACK_SIZE', 'STACK_LIMIT', 'sp', 'ir', 'pc', 'adr', 'mdr', 't', 'rIndex', 'ivr', 'intr',
+    'flags', 'sbus', 'dbus']
+
+# the Seq fields saved in a snapshot: the micro instruction address register (MIR is derived from it)
+# and the latched flags
+SEQ_FIELDS = ['mar', 'z', 'c', 'v', 's']
+
+# the snapshot file format, all the numbers are little endian:
+#   HEADER: magic, version, the memory size in words, the number of pages that follow
+#   STATE: the CPU_FIELDS, the SEQ_FIELDS and the 16 general registers
+#   the number of code ranges, then the start and end address of every one (see Cpu.code)
+#   for every page with at least a non zero word: the page number and its words
+MAGIC = b'CPUS'
+VERSION = 3
+HEADER = struct.Struct('<4sHII')
+STATE = struct.Struct('<qqqqqqqqqq?Bqqq????16h')
+CODE_COUNT = struct.Struct('<I')
+CODE_RANGE = struct.Struct('<II')
+PAGE_NUMBER = struct.Struct('<I')
+
+class SnapshotError(Exception):
+    pass
+
+class Snapshot(object):
+    '''An immutable copy of the state of a Cpu and of the Seq running it
+
+    The state includes everything needed to resume the execution in the middle of an
+    instruction: the micro instruction address register (MAR), the flags latched by the sequencer,
+    the buses, the registers and the memory.
+
+    The memory is kept as copy-on-write pages (see Memory.snapshot): the pages that were not
+    written since the previous snapshot are shared with it, so snapshotting a running program
+    repeatedly only copies what it touched. Restoring a snapshot in the sequencer it was taken
+    from copies back only the pages written since.
+    '''
+    __slots__ = ['cpuState', 'seqState', 'code', 'r', 'mem']
+
+    def __init__(self, seq):
+        '''Take a snapshot of the given sequencer and of its Cpu
+
+        Args:
+            seq - a Seq (or a CompiledSeq)
+        '''
+        cpu = seq.cpu
+        self.cpuState = tuple(getattr(cpu, name) for name in CPU_FIELDS)
+        self.seqState = tuple(getattr(seq, name) for name in SEQ_FIELDS)
+        self.code = cpu.code
+        self.r = tuple(cpu.r)
+        self.mem = cpu.mem.snapshot()
+
+    def restore(self, seq):
+        '''Bring the sequencer and its Cpu back to the state of the snapshot
+
+        Raises:
+            ValueError - if the memory of the Cpu has a different size
+        '''
+        cpu = seq.cpu
+        cpu.mem.restore(self.mem)
+        cpu.code = self.code
+        cpu.r[:] = array('h', self.r)
+        for (name, val) in zip(CPU_FIELDS, self.cpuState):
+            setattr(cpu, name, val)
+        for (name, val) in zip(SEQ_FIELDS, self.seqState):
+            setattr(seq, name, val)
+
+    def fork(self, mpm=MPM, engine=Seq):
+        '''Get a new sequencer, with its own Cpu, in the state of the snapshot
+
+        Only the memory pages that hold non zero words are copied.
+
+        Args:
+            mpm - the microprogram memory
+            engine - the class of the sequencer, eg: Seq or CompiledSeq
+
+        Returns:
+            An engine instance, running a new Cpu
+        '''
+        cpu = Cpu.__new__(Cpu)
+        cpu.mem = Memory()
+        cpu.r = array('h', self.r)
+
+        seq = engine(mpm, cpu)
+        self.restore(seq)
+
+        return seq
+
+    def save(self, path):
+        '''Write the snapshot to a binary file, the pages that hold only zeros are not written'''
+        pages = [(n, page) for (n, page) in enumerate(self.mem) if page != ZERO_BYTES]
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, MEMORY_SIZE, len(pages)))
+            f.write(STATE.pack(*(list(self.cpuState) + list(self.seqState) + list(self.r))))
+            f.write(CODE_COUNT.pack(len(self.code)))
+            for (start, end) in self.code:
+                f.write(CODE_RANGE.pack(start, end))
+            for (n, page) in pages:
+                f.write(PAGE_NUMBER.pack(n))
+                f.write(_littleEndian(page))
+
+    @classmethod
+    def load(cls, path):
+        '''Read a snapshot written by save
+
+        Raises:
+            SnapshotError - if the file is not a snapshot, has an unknown version or is truncated
+        '''
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        try:
+            (magic, version, size, count) = HEADER.unpack_from(data)
+        except struct.error:
+            raise SnapshotError('{} is not a snapshot'.format(path))
+        if magic != MAGIC:
+            raise SnapshotError('{} is not a snapshot'.format(path))
+        if version != VERSION:
+            raise SnapshotError('{} has the unsupported version {}'.format(path, version))
+        if size != MEMORY_SIZE:
+            raise SnapshotError('{} has a memory of {} words, not {}'.format(path, size, MEMORY_SIZE))
+
+        try:
+            state = STATE.unpack_from(data, HEADER.size)
+            offset = HEADER.size + STATE.size
+
+            (codeCount,) = CODE_COUNT.unpack_from(data, offset)
+            offset += CODE_COUNT.size
+            code = []
+            for i in range(codeCount):
+                code.append(CODE_RANGE.unpack_from(data, offset))
+                offset += CODE_RANGE.size
+
+            pages = [ZERO_BYTES] * PAGE_COUNT
+            for i in range(count):
+                (n,) = PAGE_NUMBER.unpack_from(data, offset)
+                offset += PAGE_NUMBER.size
+                page = data[offset:offset + 2 * PAGE_SIZE]
+                if len(page) != 2 * PAGE_SIZE:
+                    raise SnapshotError('{} is truncated'.format(path))
+                pages[n] = _littleEndian(page)
+                offset += len(page)
+        except (struct.error, IndexError):
+            raise SnapshotError('{} is truncated or corrupted'.format(path))
+
+        snapshot = cls.__new__(cls)
+        snapshot.cpuState = state[:len(CPU_FIELDS)]
+        snapshot.seqState = state[len(CPU_FIELDS):len(CPU_FIELDS) + len(SEQ_FIELDS)]
+        snapshot.code = tuple(code)
+        snapshot.r = state[len(CPU_FIELDS) + len(SEQ_FIELDS):]
+        snapshot.mem = tuple(pages)
+
+        return snapshot
+
+
+def _littleEndian(page):
+    '''Convert the bytes of a page between the native and the little endian word order'''
+    if sys.byteorder == 'little':
+        return page
+
+    words = array('h')
+    words.frombytes(page)
+    words.byteswap()
+
+    return words.tobytes()
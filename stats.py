@@ -0,0 +1,216 @@
+from uinstr import Mem, MPM_LABELS
+from instr import decode, AddrMode, Group
+from seq import instanceOverride
+
+from collections import Counter
+import json
+import time
+
+def labelFor(mar, labels=MPM_LABELS):
+    '''Get a readable name for an MPM address, relative to the closest label before it
+
+    Args:
+        mar - the MPM address
+        labels - the addresses of the microroutines, see MPM_LABELS
+
+    Returns:
+        A string like "IFCH1" or "MOV+1"
+    '''
+    best = None
+    for (name, adr) in labels.items():
+        if adr <= mar and (best is None or adr > labels[best]):
+            best = name
+
+    if best is None:
+        return str(mar)
+    if labels[best] == mar:
+        return best
+
+    return '{}+{}'.format(best, mar - labels[best])
+
+
+class ExecStats(object):
+    '''Counts where the micro-cycles of a Seq go
+
+    While attached, every executed microinstruction is counted by its MPM address and by the
+    instruction (IR) it belongs to, and every memory operation is timed by its kind.
+    The per instruction counts are aggregated by OpCode and by addressing modes only when the
+    results are requested.
+
+    Nothing is instrumented until attach() is called, and detach() restores the original
+    methods, so a Seq without attached stats runs at full speed.
+    '''
+    def __init__(self, seq, labels=MPM_LABELS):
+        '''Init the counters for the given sequencer
+
+        Args:
+            seq - the Seq to be instrumented
+            labels - the addresses of the microroutines, used to name the MPM addresses in the reports
+        '''
+        self.seq = seq
+        self.labels = labels
+        self.attached = False
+        self.reset()
+
+    def reset(self):
+        '''Zero all the counters'''
+        attached = self.attached
+        self.detach()
+
+        self.marCounts = [0] * len(self.seq.mpm) # MPM address -> executions
+        self.irCycles = Counter() # IR -> micro-cycles
+        self.memTime = Counter() # Mem -> seconds
+        self.memCounts = Counter() # Mem -> executions
+
+        if attached:
+            self.attach()
+
+    def attach(self):
+        '''Start counting, replaces the sequencer's execMicroInstr and memory operations'''
+        if self.attached:
+            return
+
+        seq = self.seq
+        cpu = seq.cpu
+        marCounts = self.marCounts
+        irCycles = self.irCycles
+        execMicroInstr = seq.execMicroInstr
+
+        def countedExecMicroInstr():
+            marCounts[seq.mar] += 1
+            execMicroInstr()
+            irCycles[cpu.ir] += 1
+
+        self._memTable = seq.memTable
+        seq.memTable = [self._timed(Mem(kind), op) if kind != Mem.NONE else op
+            for (kind, op) in enumerate(seq.memTable)]
+        self._execMicroInstr = instanceOverride(seq, 'execMicroInstr')
+        seq.execMicroInstr = countedExecMicroInstr
+        self.attached = True
+
+    def detach(self):
+        '''Stop counting and restore the sequencer'''
+        if not self.attached:
+            return
+
+        seq = self.seq
+        seq.memTable = self._memTable
+        if self._execMicroInstr is None:
+            del seq.execMicroInstr
+        else:
+            seq.execMicroInstr = self._execMicroInstr
+        self.attached = False
+
+    def _timed(self, kind, op):
+        memTime = self.memTime
+        memCounts = self.memCounts
+        clock = time.perf_counter
+
+        def timedOp():
+            start = clock()
+            try:
+                op()
+            finally:
+                memTime[kind] += clock() - start
+                memCounts[kind] += 1
+
+        return timedOp
+
+    def byAddress(self):
+        '''Get the executions of every MPM address that was executed at least once
+
+        Returns:
+            A list of (address, label, count), the most executed first
+        '''
+        counts = [(adr, labelFor(adr, self.labels), n) for (adr, n) in enumerate(self.marCounts) if n]
+
+        return sorted(counts, key=lambda c: -c[2])
+
+    def byOpcode(self):
+        '''Get the micro-cycles spent for every OpCode
+
+        Returns:
+            A Counter of OpCode name -> micro-cycles
+        '''
+        counts = Counter()
+        for (ir, n) in self.irCycles.items():
+            try:
+                counts[decode(ir).opcode.name] += n
+            except ValueError:
+                counts['invalid'] += n
+
+        return counts
+
+    def byAddrModes(self):
+        '''Get the micro-cycles spent for every (source, destination) addressing mode combination
+
+        The instructions without a source or destination operand use "-" for it.
+
+        Returns:
+            A Counter of "mas,mad" -> micro-cycles
+        '''
+        counts = Counter()
+        for (ir, n) in self.irCycles.items():
+            try:
+                d = decode(ir)
+            except ValueError:
+                continue
+
+            (mas, mad) = ('-', '-')
+            if d.group == Group.TWO_OP:
+                mas = AddrMode(d.mas).name
+            if d.group == Group.TWO_OP or d.group == Group.ONE_OP:
+                mad = AddrMode(d.mad).name
+            counts['{},{}'.format(mas, mad)] += n
+
+        return counts
+
+    def byMem(self):
+        '''Get the time spent in each memory operation kind
+
+        Returns:
+            A dict of Mem name -> (executions, seconds)
+        '''
+        return {kind.name: (self.memCounts[kind], self.memTime[kind]) for kind in self.memCounts}
+
+    def toDict(self):
+        '''Get all the counters, as plain data'''
+        return {
+            'cycles': sum(self.marCounts),
+            'address': [{'address': adr, 'label': label, 'count': n} for (adr, label, n) in self.byAddress()],
+            'opcode': dict(self.byOpcode()),
+            'addrModes': dict(self.byAddrModes()),
+            'mem': {kind: {'count': n, 'seconds': t} for (kind, (n, t)) in self.byMem().items()},
+        }
+
+    def toJson(self, **kwargs):
+        '''Get all the counters as a JSON string, kwargs are passed to json.dumps'''
+        return json.dumps(self.toDict(), **kwargs)
+
+    def report(self, top=20):
+        '''Get a text report of the hot spots
+
+        Args:
+            top - the number of entries displayed in each table, None for all of them
+
+        Returns:
+            The report, as a string
+        '''
+        total = sum(self.marCounts) or 1
+        lines = ['Micro-cycles: {}'.format(sum(self.marCounts)), '', 'MPM address\tLabel\tCount\t%']
+        lines += ['{}\t{}\t{}\t{:.1f}'.format(adr, label, n, 100 * n / total)
+            for (adr, label, n) in self.byAddress()[:top]]
+
+        lines += ['', 'OpCode\tCycles\t%']
+        lines += ['{}\t{}\t{:.1f}'.format(name, n, 100 * n / total)
+            for (name, n) in self.byOpcode().most_common(top)]
+
+        lines += ['', 'Modes (src,dst)\tCycles\t%']
+        lines += ['{}\t{}\t{:.1f}'.format(modes, n, 100 * n / total)
+            for (modes, n) in self.byAddrModes().most_common(top)]
+
+        lines += ['', 'Mem\tCount\tSeconds']
+        lines += ['{}\t{}\t{:.6f}'.format(kind, n, t)
+            for (kind, (n, t)) in sorted(self.byMem().items(), key=lambda m: -m[1][1])]
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,84 @@
+'''Tests of the single pass assembler: the forward references, the errors and Assembler.stream'''
+from asm import Assembler, ParseError
+from instr import OpCode, encode_br
+from seq import toWord
+from test_vector import randomProgram
+
+import random
+import unittest
+
+EXAMPLES = ['br', 'factorial', 'misc', 'mov', 'mul']
+
+def words(program):
+    return [toWord(word) for word in program]
+
+
+class AssemblerTest(unittest.TestCase):
+    def testLabelsAreAddresses(self):
+        # a label is encoded as its address, whether it is defined before or after its use
+        self.assertEqual(
+            Assembler().parseLines(['jmp L', 'mov r1, L', 'L: nop', 'jmp L', 'mov r1, L']),
+            Assembler().parseLines(['jmp 4', 'mov r1, 4', 'nop', 'jmp 4', 'mov r1, 4']))
+
+    def testBranchOffsets(self):
+        # the branches hold the address of their target
+        program = Assembler().parseLines(['B: br F', 'nop', 'F: br B', 'bne F'])
+        self.assertEqual(encode_br(OpCode.BR, 2) + [OpCode.NOP] + encode_br(OpCode.BR, 0) +
+            encode_br(OpCode.BNE, 2), program)
+
+    def testLinesAndComments(self):
+        asm = Assembler()
+        program = asm.parseLines([
+            '; a comment',
+            '',
+            'START:',
+            '\tmov\tr1,2\t\t; the operands are separated by commas',
+            'END: nop',
+        ])
+        self.assertEqual({'START': 0, 'END': 2}, asm.lblToAddr)
+        self.assertEqual({0: 4, 2: 5}, asm.adrToLine)
+        self.assertEqual(3, len(program))
+
+    def testErrors(self):
+        for lines in [['br L'], ['L: nop', 'L: nop'], ['foo r1'], ['mov r1'], ['mov r1, r2, r3']]:
+            with self.subTest(lines=lines):
+                with self.assertRaises(ParseError):
+                    Assembler().parseLines(lines)
+
+    def assertStreamSameAsParse(self, lines):
+        '''Store every chunk of stream at its address, in order, it must give the program of parseLines'''
+        program = []
+        for (adr, chunk, line) in Assembler().stream(lines):
+            program.extend([0] * (adr + len(chunk) - len(program)))
+            program[adr:adr + len(chunk)] = chunk
+
+        self.assertEqual(words(Assembler().parseLines(lines)), words(program))
+
+    def testStreamExamples(self):
+        for name in EXAMPLES:
+            with self.subTest(example=name):
+                self.assertStreamSameAsParse(list(open('examples/{}.asm'.format(name))))
+
+    def testStreamRandomPrograms(self):
+        rng = random.Random(18)
+        for i in range(20):
+            with self.subTest(program=i):
+                self.assertStreamSameAsParse(randomProgram(rng, 50))
+
+    def testStreamForwardReference(self):
+        chunks = list(Assembler().stream(['jmp L', 'L: nop']))
+        (adr, jmp, line) = chunks[0]
+        self.assertEqual((0, 0, 1), (adr, jmp[1], line)) # 0 until L is defined
+        self.assertIn((0, Assembler().parseLines(['jmp 2']), 1), [tuple(chunk) for chunk in chunks[1:]])
+
+    def testStreamIsLazy(self):
+        def lines():
+            yield 'nop'
+            raise AssertionError('read past the first line')
+
+        chunk = next(Assembler().stream(lines()))
+        self.assertEqual((0, 1), (chunk.adr, len(chunk.words)))
+
+
+if __name__ == '__main__':
+    unittest.main()
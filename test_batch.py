@@ -0,0 +1,26 @@
+'''Tests of batch.runBatch: every path gets a result, whatever happens to its job'''
+from batch import runBatch
+
+import os
+import tempfile
+import unittest
+
+
+class BatchTest(unittest.TestCase):
+    def testEveryPathHasAResult(self):
+        with tempfile.TemporaryDirectory() as directory:
+            loop = os.path.join(directory, 'loop.asm')
+            with open(loop, 'w') as f:
+                f.write('L: jmp L\n')
+
+            paths = ['examples/mul.asm', loop, 'missing.asm', 'examples/br.asm']
+            results = {result['path']: result for result in runBatch(paths, workers=2, timeout=0.5)}
+
+        self.assertEqual(set(paths), set(results))
+        self.assertEqual('end', results['examples/mul.asm']['reason'])
+        self.assertEqual('timeout', results[loop]['reason'])
+        self.assertEqual('FileNotFoundError', results['missing.asm']['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+'''Differential tests of the other engines against Seq: isa.IsaEngine, block.BlockEngine and
+ucomp.CompiledSeq must stop for the same reason, after the same instructions, in the state Seq.run gives'''
+from uinstr import MPM
+from seq import Seq, Cpu, StopReason
+from asm import Assembler
+from isa import IsaEngine
+from block import BlockEngine
+from ucomp import CompiledSeq
+from link import build
+from incremental import AsmSession
+from breakpoints import Breakpoints, WRITE, MPM as MPM_BREAKPOINT
+from test_vector import randomProgram, state
+
+import random
+import unittest
+
+# int.asm is left out: the assembler does not know its interrupt instructions yet
+EXAMPLES = ['br', 'factorial', 'misc', 'mov', 'mul']
+
+ENGINES = {
+    'isa': lambda cpu, maxInstrs: IsaEngine(cpu).run(maxInstrs),
+    'block': lambda cpu, maxInstrs: BlockEngine(cpu).run(maxInstrs),
+    'compiled': lambda cpu, maxInstrs: CompiledSeq(MPM, cpu).run(maxInstrs=maxInstrs, stopOnHalt=False),
+}
+
+
+class EnginesTest(unittest.TestCase):
+    def assertSameAsSeq(self, makeCpu, maxInstrs=None, engines=ENGINES):
+        '''Run the CPU given by makeCpu() with Seq, then a new one with every engine, and compare
+        the results and the final states'''
+        cpu = makeCpu()
+        want = Seq(MPM, cpu).run(maxInstrs=maxInstrs, stopOnHalt=False)
+        wantState = state(cpu)
+
+        for name in engines:
+            if name == 'block' and want.reason == StopReason.INSTR_LIMIT:
+                continue # the budget is only tested between two blocks
+
+            cpu = makeCpu()
+            got = ENGINES[name](cpu, maxInstrs)
+            self.assertEqual((want.reason, want.instructions), (got.reason, got.instructions), name)
+            if got.cycles is not None:
+                self.assertEqual(want.cycles, got.cycles, name)
+            self.assertEqual(wantState, state(cpu), name)
+
+    def testExamples(self):
+        for name in EXAMPLES:
+            words = Assembler('examples/{}.asm'.format(name)).parse()
+            with self.subTest(example=name):
+                self.assertSameAsSeq(lambda: Cpu(words))
+
+    def testLinkedModules(self):
+        program = build(['examples/link/main.asm', 'examples/link/fact.asm', 'examples/link/mul.asm'], workers=1)
+        self.assertSameAsSeq(lambda: Cpu(program.words))
+
+    def testRandomPrograms(self):
+        rng = random.Random(3)
+        for i in range(50):
+            words = Assembler().parseLines(randomProgram(rng, 20))
+            values = [rng.randrange(-0x8000, 0x8000) for r in range(16)]
+
+            def makeCpu():
+                cpu = Cpu(words)
+                for (r, value) in enumerate(values):
+                    cpu.r[r] = value
+
+                return cpu
+
+            with self.subTest(program=i):
+                self.assertSameAsSeq(makeCpu, maxInstrs=300)
+
+    def testStackOverflowInsideARoutine(self):
+        # the compiled routine of CALL overflows after a few micro-cycles
+        words = Assembler().parseLines(['L: call L'])
+        self.assertSameAsSeq(lambda: Cpu(words))
+
+        seq = Seq(MPM, Cpu(words))
+        seq.run()
+        compiled = CompiledSeq(MPM, Cpu(words))
+        compiled.run()
+        self.assertEqual(seq.mar, compiled.mar)
+
+    def testSelfModifyingCode(self):
+        (inc,) = Assembler().parseLines(['inc r4'])
+        words = Assembler().parseLines([
+            'mov r5, 3',
+            'mov r2, L',
+            'mov r3, {}'.format(inc),
+            'L: dec r4', # becomes inc r4 after the first pass
+            'mov (r2), r3',
+            'dec r5',
+            'bne L',
+        ])
+        self.assertSameAsSeq(lambda: Cpu(words))
+
+        engine = BlockEngine(Cpu(words))
+        engine.run()
+        self.assertEqual(engine.cacheStats()['invalidations'], 3) # every pass writes to the loop
+
+    def testPatchedCode(self):
+        lines = ['mov r1, 0', 'mov r2, 5', 'L: add r1, 1', 'dec r2', 'bne L']
+        session = AsmSession(lines)
+        words = Assembler().parseLines(lines)
+        patch = session.setLine(2, 'L: add r1, 3')
+
+        cpu = Cpu(words)
+        engine = BlockEngine(cpu)
+        seqCpu = Cpu(words)
+        seq = Seq(MPM, seqCpu)
+        for run in (engine.run, lambda: seq.run(stopOnHalt=False)):
+            run()
+
+        # run the patched program again, the translated blocks are stale
+        patch.apply(cpu.mem)
+        patch.apply(seqCpu.mem)
+        for (adr, patched) in patch.runs:
+            engine.invalidate(adr, adr + len(patched))
+        cpu.pc = seqCpu.pc = 0
+        engine.run()
+        seq.run(stopOnHalt=False)
+
+        self.assertEqual(cpu.r[1], 15)
+        self.assertEqual(state(seqCpu), state(cpu))
+
+    def testBreakpoints(self):
+        words = Assembler('examples/factorial.asm').parse()
+        stops = []
+        for engine in (Seq, CompiledSeq):
+            seq = engine(MPM, Cpu(words))
+            breakpoints = Breakpoints(seq)
+            breakpoints.add(WRITE, seq.cpu.STACK_LIMIT - 1)
+            breakpoints.add(MPM_BREAKPOINT, 'RET')
+
+            results = []
+            for i in range(4):
+                result = breakpoints.run()
+                results.append((result.reason, result.cycles, result.instructions, seq.mar,
+                    breakpoints.hits, state(seq.cpu)))
+            stops.append(results)
+
+        self.assertEqual(stops[0], stops[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
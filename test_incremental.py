@@ -0,0 +1,97 @@
+'''Tests of incremental.AsmSession: after every edit, the session and the program patched with the
+returned Patch must hold what Assembler.parseLines gives for the edited source'''
+from asm import Assembler, ParseError
+from seq import toWord
+from incremental import AsmSession
+from test_vector import randomProgram
+
+import random
+import unittest
+
+def words(program):
+    return [toWord(word) for word in program]
+
+
+class AsmSessionTest(unittest.TestCase):
+    def assertSameAsAssembler(self, session, lines, image):
+        asm = Assembler()
+        expected = asm.parseLines(lines)
+        session.check()
+        self.assertEqual(words(expected), words(session.words))
+        self.assertEqual(words(expected), words(image))
+        self.assertEqual(asm.lblToAddr, session.lblToAddr)
+
+    def edit(self, session, image, start, end, new):
+        '''Edit the session and apply the Patch to image, which must grow and shrink with the program'''
+        patch = session.edit(start, end, new)
+        image.extend([0] * (patch.size - len(image)))
+        patch.apply(image)
+        self.assertTrue(all(word == 0 for word in image[patch.size:]))
+        del image[patch.size:]
+
+    def testEditsMatchTheAssembler(self):
+        lines = list(open('examples/factorial.asm'))
+        session = AsmSession(lines)
+        image = list(session.words)
+
+        edits = [
+            (19, 20, ['cmp r1, 2']), # the same size
+            (23, 23, ['mov r7, 0x1234', 'nop']), # the following labels move
+            (23, 25, []),
+            (0, 0, ['BEGIN: nop']),
+            (0, 1, []),
+        ]
+        for (start, end, new) in edits:
+            with self.subTest(edit=(start, end, new)):
+                self.edit(session, image, start, end, new)
+                lines[start:end] = new
+                self.assertSameAsAssembler(session, lines, image)
+
+    def testRandomEdits(self):
+        rng = random.Random(19)
+        length = 30
+        lines = randomProgram(rng, length)
+        session = AsmSession(lines)
+        image = list(session.words)
+
+        for i in range(200):
+            kind = rng.randrange(3)
+            if kind == 0:
+                # replace a line with another instruction, which keeps its label
+                index = rng.randrange(length)
+                start = lines.index(next(line for line in lines if line.startswith('L{}:'.format(index))))
+                (end, new) = (start + 1, [randomProgram(rng, length)[index]])
+            elif kind == 1:
+                start = end = rng.randrange(len(lines) + 1)
+                new = [rng.choice(['nop', 'mov r1, 5', 'add (r2)3, 0x100'])]
+            else:
+                unlabeled = [j for (j, line) in enumerate(lines) if not line.startswith('L')]
+                if not unlabeled:
+                    continue
+                start = rng.choice(unlabeled)
+                (end, new) = (start + 1, [])
+
+            with self.subTest(edit=i):
+                self.edit(session, image, start, end, new)
+                lines[start:end] = new
+                self.assertSameAsAssembler(session, lines, image)
+
+    def testErrors(self):
+        session = AsmSession(['L: nop', 'br L'])
+        program = list(session.words)
+
+        with self.assertRaises(ParseError):
+            session.setLine(1, 'L: nop') # L is already defined
+        with self.assertRaises(ParseError):
+            session.setLine(1, 'foo r1')
+        self.assertEqual(program, session.words)
+
+        session.setLine(0, 'nop')
+        with self.assertRaises(ParseError):
+            session.check() # L is not defined anymore
+        with self.assertRaises(ParseError):
+            Assembler().parseLines(['nop', 'br L'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''Tests of the directives (.include, .macro, .data, dw, .global) and of the module linker'''
+from uinstr import MPM
+from seq import Seq, Cpu, StopReason, toWord
+from asm import Assembler, ParseError
+from link import build, LinkError
+
+import os
+import tempfile
+import unittest
+
+LINK_EXAMPLE = ['examples/link/main.asm', 'examples/link/fact.asm', 'examples/link/mul.asm']
+
+def words(program):
+    return [toWord(word) for word in program]
+
+
+class DirectivesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        return path
+
+    def testDataAfterTheCode(self):
+        asm = Assembler()
+        program = asm.parseLines([
+            '.data',
+            'TABLE: dw 1, -2, END',
+            '.code',
+            'mov r1, TABLE',
+            'END: nop',
+        ])
+        self.assertEqual(words(Assembler().parseLines(['mov r1, 3', 'nop']) + [1, -2, 2]), words(program))
+        self.assertEqual({'TABLE': 3, 'END': 2}, asm.lblToAddr)
+
+    def testMacros(self):
+        program = Assembler().parseLines([
+            '.macro WAITZ reg',
+            'L: dec reg',
+            '   bne L',
+            '.endm',
+            'WAITZ r1',
+            'WAITZ r2',
+        ])
+        # every expansion has its own L
+        self.assertEqual(Assembler().parseLines(['A: dec r1', 'bne A', 'B: dec r2', 'bne B']), program)
+
+    def testIncludeIsRelativeToTheIncludingFile(self):
+        self.write('inc/regs.inc', ['.include "more.inc"', 'mov r1, 1'])
+        self.write('inc/more.inc', ['mov r2, 2'])
+        path = self.write('main.asm', ['.include "inc/regs.inc"', 'mov r3, 3'])
+
+        self.assertEqual(Assembler().parseLines(['mov r2, 2', 'mov r1, 1', 'mov r3, 3']),
+            Assembler(path).parse())
+
+    def testUnknownDirective(self):
+        with self.assertRaises(ParseError):
+            Assembler().parseLines(['.incldue "x.inc"'])
+
+    def testLinkedFactorial(self):
+        program = build(LINK_EXAMPLE, workers=1)
+        cpu = Cpu(program.words)
+        result = Seq(MPM, cpu).run()
+
+        self.assertEqual(StopReason.END, result.reason)
+        self.assertEqual(720, cpu.mem[program.lblToAddr['RESULT']])
+
+    def testCache(self):
+        cache = os.path.join(self.directory.name, 'cache')
+        first = build(LINK_EXAMPLE, workers=1, cacheDir=cache)
+        self.assertEqual(3, len(os.listdir(cache)))
+
+        second = build(LINK_EXAMPLE, workers=1, cacheDir=cache)
+        self.assertEqual(list(first.words), list(second.words))
+        self.assertEqual(first.lblToAddr, second.lblToAddr)
+
+    def testLinkErrors(self):
+        main = self.write('main.asm', ['call F', 'call G'])
+        f = self.write('f.asm', ['.global F', 'F: ret'])
+        g = self.write('g.asm', ['.global F, G', 'F: nop', 'G: ret'])
+        missing = self.write('missing.asm', ['.global H', 'ret'])
+
+        self.assertEqual(len(build([main, g], workers=1).words), 6)
+        for paths in [[main, f], [main, f, g], [main, missing]]:
+            with self.subTest(paths=[os.path.basename(path) for path in paths]):
+                with self.assertRaises(LinkError):
+                    build(paths, workers=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+'''Differential tests of vector.VecSeq against Seq: every lane must end in the state Seq.run gives'''
+from uinstr import MPM
+from seq import Seq, Cpu, StopReason, toWord
+from asm import Assembler
+from vector import VecSeq
+
+import random
+import unittest
+
+TWO_OP = ['mov', 'add', 'sub', 'cmp', 'and', 'or', 'xor']
+ONE_OP = ['clr', 'neg', 'inc', 'dec', 'asl', 'asr', 'push', 'pop']
+BRANCH = ['br', 'bne', 'beq', 'bpl', 'bmi', 'bcs', 'bcc', 'bvs', 'bvc']
+OTHER = ['clc', 'clv', 'clz', 'cls', 'ccc', 'sec', 'sev', 'sez', 'ses', 'scc', 'nop']
+
+def randomProgram(rng, length):
+    '''Generate a program of random instructions, in all the addressing modes, with branches and jumps
+    to random labels in it'''
+    def operand(source):
+        reg = rng.randrange(16)
+        mode = rng.randrange(4 if source else 3)
+        if mode == 0:
+            return 'r{}'.format(reg)
+        if mode == 1:
+            return '(r{})'.format(reg)
+        if mode == 2:
+            return '(r{}){}'.format(reg, rng.randrange(256))
+        return str(rng.randrange(0x10000))
+
+    lines = []
+    for i in range(length):
+        kind = rng.randrange(10)
+        if kind < 5:
+            line = '{} {}, {}'.format(rng.choice(TWO_OP), operand(False), operand(True))
+        elif kind < 8:
+            line = '{} {}'.format(rng.choice(ONE_OP), operand(False))
+        elif kind < 9:
+            line = '{} L{}'.format(rng.choice(BRANCH + ['jmp', 'call']), rng.randrange(length))
+        else:
+            line = rng.choice(OTHER + ['ret'])
+        lines.append('L{}: {}'.format(i, line))
+
+    return lines
+
+def state(cpu):
+    return (list(cpu.r), cpu.flags, cpu.pc, cpu.sp, cpu.ir, cpu.adr, cpu.mdr, cpu.t, cpu.mem.snapshot())
+
+
+class VecSeqTest(unittest.TestCase):
+    def assertSameAsSeq(self, makeCpus, maxCycles=None):
+        '''Run the CPUs given by makeCpus() with Seq, then a second set with VecSeq, and compare
+        the results and the final states'''
+        expected = []
+        for cpu in makeCpus():
+            result = Seq(MPM, cpu).run(maxCycles=maxCycles, stopOnHalt=False)
+            expected.append((result.reason, result.cycles, result.instructions, state(cpu)))
+
+        cpus = makeCpus()
+        vec = VecSeq(MPM, cpus)
+        vec.run(maxCycles=maxCycles, stopOnHalt=False)
+        vec.sync()
+        actual = [(result.reason, result.cycles, result.instructions, state(cpu))
+            for (result, cpu) in zip(vec.results(), cpus)]
+
+        for (i, (want, got)) in enumerate(zip(expected, actual)):
+            self.assertEqual(want, got, 'lane {}'.format(i))
+
+    def testMemoryOutsideOfTheImage(self):
+        words = Assembler().parseLines([
+            'mov r1, (r2)',
+            'mov r3, 7',
+            'mov (r2), r3',
+            'mov (r2)5, (r2)',
+            'add r1, (r2)5',
+            'mov (r4), r1',
+        ])
+
+        def makeCpus():
+            cpus = []
+            for (far, farther) in [(0x1000, 0x8000), (0x1000, 0x1001), (0x10FE, 0xFFFF), (0x20, 0x7F00)]:
+                cpu = Cpu(words)
+                cpu.r[2] = toWord(far)
+                cpu.r[4] = toWord(farther)
+                cpus.append(cpu)
+
+            return cpus
+
+        self.assertSameAsSeq(makeCpus)
+
+    def testClearedPage(self):
+        # the only data of the page at 0x1000 is cleared, sync must still write the page back
+        words = Assembler().parseLines(['mov r2, 0x1000', 'mov r3, 0', 'mov (r2), r3'])
+
+        def makeCpus():
+            cpus = [Cpu(words) for i in range(2)]
+            cpus[0].mem[0x1000] = 5
+            return cpus
+
+        self.assertSameAsSeq(makeCpus)
+
+    def testRandomPrograms(self):
+        rng = random.Random(14)
+        for i in range(20):
+            words = Assembler().parseLines(randomProgram(rng, 20))
+            registers = [[rng.randrange(-0x8000, 0x8000) for r in range(16)] for lane in range(8)]
+
+            def makeCpus():
+                cpus = []
+                for values in registers:
+                    cpu = Cpu(words)
+                    for (r, value) in enumerate(values):
+                        cpu.r[r] = value
+                    cpus.append(cpu)
+
+                return cpus
+
+            with self.subTest(program=i):
+                self.assertSameAsSeq(makeCpus, maxCycles=2000)
+
+    def testInstructionWithoutMicroroutine(self):
+        # LSR, ROL, ROR, RLC and RRC have no microroutine yet
+        words = Assembler('examples/misc.asm').parse()
+        self.assertSameAsSeq(lambda: [Cpu(words) for i in range(3)], maxCycles=10000)
+
+        vec = VecSeq(MPM, [Cpu(words)])
+        vec.run(maxCycles=10000)
+        self.assertEqual(vec.results()[0].reason, StopReason.INVALID_INSTRUCTION)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,313 @@
+#! /usr/bin/python3.5
+'''Record the execution of a Seq in a compact binary trace and decode it offline
+
+Usage:
+    ./main.py --trace factorial.trace examples/factorial.asm
+    ./tracer.py factorial.trace                         # print the records as text
+    ./tracer.py --npz factorial.npz factorial.trace     # save them as NumPy arrays
+'''
+from uinstr import Mem, MPM_LABELS
+from stats import labelFor
+from seq import instanceOverride
+
+import argparse
+import struct
+import sys
+
+# the trace levels: a record for every micro-cycle, or only for the fetch of every instruction
+MICRO = 'micro'
+INSTR = 'instr'
+LEVELS = [MICRO, INSTR]
+
+# a trace record, little endian: the micro-cycle number (the instruction number for INSTR traces),
+# the MPM address executed and the next one (0 for INSTR traces), the PC (before the micro-cycle) and IR,
+# the source and destination buses, the ALU result, the CPU flags, the memory operation (Mem),
+# STATUS_* bits, the memory address and the word read or written
+FIELDS = ['cycle', 'mar', 'next', 'pc', 'ir', 'sbus', 'dbus', 'result', 'flags', 'mem', 'status', 'memAdr', 'memVal']
+TYPES = 'IHHHHiiiHBBHi' # the struct type of every field
+RECORD = struct.Struct('<' + TYPES)
+
+STATUS_RESULT = 1 # the micro-cycle used the ALU, result is valid
+STATUS_Z = 2 # the zero and sign flags latched by the sequencer
+STATUS_S = 4
+
+# the trace file format: HEADER (magic, version, level, record size) followed by the records
+MAGIC = b'CPUT'
+VERSION = 1
+HEADER = struct.Struct('<4sHBH')
+
+class TraceError(Exception):
+    pass
+
+class RingBuffer(object):
+    '''Keeps the last records of a trace in a preallocated buffer'''
+    def __init__(self, records=1 << 20):
+        '''Allocate the buffer for the given number of records'''
+        self.buffer = bytearray(RECORD.size * records)
+        self.pos = 0 # the offset of the next record
+        self.wraps = 0 # how many times the buffer was filled
+
+    def full(self):
+        '''Called when the buffer is full, the oldest records are overwritten'''
+        self.wraps += 1
+
+    def close(self):
+        pass
+
+    def data(self):
+        '''Get the records kept, the oldest first, as bytes'''
+        if self.wraps:
+            return bytes(self.buffer[self.pos:] + self.buffer[:self.pos])
+
+        return bytes(self.buffer[:self.pos])
+
+    def save(self, path, level=MICRO):
+        '''Write the records kept to a trace file'''
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, LEVELS.index(level), RECORD.size))
+            f.write(self.data())
+
+
+class TraceFile(object):
+    '''Writes the records of a trace to a file, through a preallocated buffer'''
+    def __init__(self, path, level=MICRO, records=1 << 16):
+        '''Create the file
+
+        Args:
+            path - the trace file
+            level - the level of the Tracer writing to it
+            records - the number of records buffered before writing them
+        '''
+        self.buffer = bytearray(RECORD.size * records)
+        self.pos = 0
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, LEVELS.index(level), RECORD.size))
+
+    def full(self):
+        '''Called when the buffer is full, it is written to the file'''
+        self.file.write(self.buffer)
+
+    def close(self):
+        '''Write the buffered records and close the file'''
+        self.file.write(self.buffer[:self.pos])
+        self.pos = 0
+        self.file.close()
+
+
+class Tracer(object):
+    '''Records a binary trace of a Seq in a RingBuffer or a TraceFile
+
+    Every record is packed in place in the preallocated buffer of the sink, no string is formatted
+    and nothing is allocated while tracing, the records are decoded later (see decode and toNumpy).
+
+    Like ExecStats, the tracer replaces the sequencer's execMicroInstr only while attached. The sink
+    holds all the records once it is detached.
+    '''
+    def __init__(self, seq, sink, level=MICRO):
+        '''Init the tracer
+
+        Args:
+            seq - the Seq to trace
+            sink - a RingBuffer or a TraceFile
+            level - MICRO for a record every micro-cycle, INSTR for a record every instruction fetch
+        '''
+        if level not in LEVELS:
+            raise ValueError('Unknown trace level: {}'.format(level))
+
+        self.seq = seq
+        self.sink = sink
+        self.level = level
+        self.count = 0 # the number of records written
+        self.attached = False
+
+    def attach(self):
+        '''Start tracing'''
+        if self.attached:
+            return
+
+        seq = self.seq
+        cpu = seq.cpu
+        sink = self.sink
+        umpm = seq.umpm
+        aluTable = seq.aluTable
+        pack = RECORD.pack_into
+        size = RECORD.size
+        buffer = sink.buffer
+        end = len(buffer)
+        (memNone, memIfch) = (int(Mem.NONE), int(Mem.IFCH))
+        tracer = self
+        pos = sink.pos
+        count = self.count
+
+        if self.level == INSTR:
+            memIfchOp = seq.memTable[memIfch]
+
+            def tracedMemIfch():
+                nonlocal pos, count
+                pc = cpu.pc # the PC is incremented later in the micro-cycle
+                memIfchOp()
+
+                uinstr = umpm[seq.mar]
+                # the ALU operations only depend on the buses, which are left as they were
+                res = aluTable[uinstr[2]]()
+                status = (STATUS_Z if seq.z else 0) | (STATUS_S if seq.s else 0)
+                if res is None:
+                    res = 0
+                else:
+                    status |= STATUS_RESULT
+
+                pack(buffer, pos, count & 0xFFFFFFFF, seq.mar, 0, pc & 0xFFFF, cpu.ir, cpu.sbus, cpu.dbus, res,
+                    cpu.flags, memIfch, status, pc & 0xFFFF, cpu.ir)
+                count += 1
+                pos += size
+                if pos == end:
+                    sink.full()
+                    pos = 0
+
+            self._memTable = seq.memTable
+            seq.memTable = list(seq.memTable)
+            seq.memTable[memIfch] = tracedMemIfch
+        else:
+            execMicroInstr = seq.execMicroInstr
+
+            def tracedExecMicroInstr():
+                nonlocal pos, count
+                mar = seq.mar
+                pc = cpu.pc
+                execMicroInstr()
+
+                uinstr = umpm[mar]
+                mem = uinstr[5]
+                if mem == memNone:
+                    (memAdr, memVal) = (0, 0)
+                elif mem == memIfch:
+                    (memAdr, memVal) = (pc, cpu.ir)
+                else:
+                    (memAdr, memVal) = (cpu.adr, cpu.mdr)
+
+                res = aluTable[uinstr[2]]()
+                status = (STATUS_Z if seq.z else 0) | (STATUS_S if seq.s else 0)
+                if res is None:
+                    res = 0
+                else:
+                    status |= STATUS_RESULT
+
+                pack(buffer, pos, count & 0xFFFFFFFF, mar, seq.mar, pc & 0xFFFF, cpu.ir & 0xFFFF, cpu.sbus,
+                    cpu.dbus, res, cpu.flags, mem, status, memAdr & 0xFFFF, memVal)
+                count += 1
+                pos += size
+                if pos == end:
+                    sink.full()
+                    pos = 0
+
+            self._execMicroInstr = instanceOverride(seq, 'execMicroInstr')
+            seq.execMicroInstr = tracedExecMicroInstr
+
+        def sync():
+            sink.pos = pos
+            tracer.count = count
+
+        self._sync = sync
+        self.attached = True
+
+    def detach(self):
+        '''Stop tracing and restore the sequencer, the records are in the sink afterwards'''
+        if not self.attached:
+            return
+
+        seq = self.seq
+        self._sync()
+        if self.level == INSTR:
+            seq.memTable = self._memTable
+        elif self._execMicroInstr is None:
+            del seq.execMicroInstr
+        else:
+            seq.execMicroInstr = self._execMicroInstr
+        self.attached = False
+
+
+def load(path):
+    '''Read a trace file
+
+    Returns:
+        (level, data), data holds the records
+
+    Raises:
+        TraceError - if the file is not a trace or has an unknown version
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        (magic, version, level, size) = HEADER.unpack_from(data)
+    except struct.error:
+        raise TraceError('{} is not a trace'.format(path))
+    if magic != MAGIC:
+        raise TraceError('{} is not a trace'.format(path))
+    if version != VERSION or size != RECORD.size or level >= len(LEVELS):
+        raise TraceError('{} has the unsupported version {}'.format(path, version))
+
+    data = data[HEADER.size:]
+
+    return (LEVELS[level], data[:len(data) - len(data) % RECORD.size])
+
+
+def records(data):
+    '''Get the records in data as tuples, see FIELDS'''
+    return RECORD.iter_unpack(data)
+
+
+def decode(data, labels=MPM_LABELS):
+    '''Format the records in data as text, a line for every record
+
+    Returns:
+        A generator of strings
+    '''
+    names = {}
+    for (cycle, mar, nxt, pc, ir, sbus, dbus, result, flags, mem, status, memAdr, memVal) in records(data):
+        if mar not in names:
+            names[mar] = labelFor(mar, labels)
+
+        line = '{:>10} {:<12} PC={:04X} IR={:04X} SBUS={:04X} DBUS={:04X}'.format(cycle, names[mar], pc, ir,
+            sbus & 0xFFFF, dbus & 0xFFFF)
+        if status & STATUS_RESULT:
+            line += ' ALU={:04X}'.format(result & 0xFFFF)
+        if mem != Mem.NONE:
+            line += ' {} [{:04X}]={:04X}'.format(Mem(mem).name, memAdr, memVal & 0xFFFF)
+
+        yield line + ' -> {}'.format(nxt)
+
+
+def toNumpy(data):
+    '''Get the records in data as a NumPy structured array, without copying them
+
+    Returns:
+        An array with a field for every name in FIELDS
+    '''
+    import numpy as np
+
+    dtype = np.dtype([(name, '<' + code) for (name, code) in zip(FIELDS, TYPES)])
+
+    return np.frombuffer(data, dtype=dtype)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode a trace written by main.py --trace')
+    parser.add_argument('file', help='the trace file')
+    parser.add_argument('--npz', metavar='FILE',
+        help='save the records as NumPy arrays (one for every field) to FILE instead of printing them')
+    args = parser.parse_args()
+
+    try:
+        (level, data) = load(args.file)
+    except TraceError as e:
+        sys.exit(str(e))
+
+    if args.npz:
+        import numpy as np
+
+        array = toNumpy(data)
+        np.savez(args.npz, **{name: array[name] for name in FIELDS})
+    else:
+        for line in decode(data):
+            print(line)
@@ -0,0 +1,386 @@
+from uinstr import *
+from instr import *
+from seq import Seq, ExecEnd, StackOverflow, Breakpoint, StopReason, RunResult, irIndexToOffset, toWord, WORD_MASK
+from memory import ADDRESS_MASK
+
+import time
+
+class CompileError(Exception):
+    pass
+
+# the Python code implementing every value of the microinstruction fields
+# REG reads select the register from IR the same way Seq does
+SBUS_CODE = {
+    SBus.NONE: ['cpu.sbus = 0'],
+    SBus.ZERO: ['cpu.sbus = 0'],
+    SBus.REG: ['cpu.rIndex = getRs(ir)', 'cpu.sbus = cpu.r[cpu.rIndex]'],
+    SBus.T: ['cpu.sbus = cpu.t'],
+    SBus.MDR: ['cpu.sbus = cpu.mdr'],
+    SBus.IR_OFFSET: ['cpu.sbus = getBrOffset(ir) - cpu.pc'],
+    SBus.MINUS_ONE: ['cpu.sbus = -1'],
+    SBus.ONE: ['cpu.sbus = 1'],
+}
+
+DBUS_CODE = {
+    DBus.NONE: ['cpu.dbus = 0'],
+    DBus.ZERO: ['cpu.dbus = 0'],
+    DBus.PC: ['cpu.dbus = cpu.pc'],
+    DBus.REG: ['cpu.rIndex = getRd(ir)', 'cpu.dbus = cpu.r[cpu.rIndex]'],
+    DBus.MDR: ['cpu.dbus = cpu.mdr'],
+    DBus.NOT_MDR: ['cpu.dbus = ~cpu.mdr'],
+    DBus.T: ['cpu.dbus = cpu.t'],
+    DBus.SP: ['cpu.dbus = cpu.sp'],
+}
+
+ALU_CODE = {
+    Alu.SUM: 'cpu.sbus + cpu.dbus',
+    Alu.SUB: 'cpu.sbus - cpu.dbus',
+    Alu.AND: 'cpu.sbus & cpu.dbus',
+    Alu.OR: 'cpu.sbus | cpu.dbus',
+    Alu.XOR: 'cpu.sbus ^ cpu.dbus',
+    Alu.ASL: 'cpu.dbus << 1',
+    Alu.ASR: 'cpu.dbus >> 1',
+}
+
+RBUS_CODE = {
+    RBus.ADR: ['cpu.adr = res'],
+    RBus.T: ['cpu.t = res'],
+    RBus.MDR: ['cpu.mdr = res'],
+    RBus.REG: ['cpu.r[cpu.rIndex] = toWord(res)'],
+    RBus.PC: ['cpu.pc = res & ADDRESS_MASK'],
+}
+
+MEM_CODE = {
+    Mem.READ: ['cpu.mdr = cpu.mem[cpu.adr]'],
+    Mem.WRITE: ['cpu.mem[cpu.adr] = toWord(cpu.mdr)'],
+}
+
+# {adr} is replaced by the address of the microinstruction and {cycles} by the number of
+# micro-cycles the routine completed before it
+MISC_CODE = {
+    Misc.INC_PC: ['cpu.pc = (cpu.pc + 1) & ADDRESS_MASK'],
+    Misc.COND: ['cpu.z = seq.z', 'cpu.c = seq.c', 'cpu.v = seq.v', 'cpu.s = seq.s'],
+    Misc.SET_C: ['cpu.c = True'],
+    Misc.SET_V: ['cpu.v = True'],
+    Misc.SET_Z: ['cpu.z = True'],
+    Misc.SET_S: ['cpu.s = True'],
+    Misc.CLEAR_C: ['cpu.c = False'],
+    Misc.CLEAR_V: ['cpu.v = False'],
+    Misc.CLEAR_Z: ['cpu.z = False'],
+    Misc.CLEAR_S: ['cpu.s = False'],
+    Misc.SET_FLAG: ['cpu.c = True', 'cpu.v = True', 'cpu.s = True', 'cpu.z = True'],
+    Misc.CLEAR_FLAG: ['cpu.c = False', 'cpu.v = False', 'cpu.s = False', 'cpu.z = False'],
+    Misc.INC_SP: ['cpu.sp += 1'],
+    Misc.DEC_SP: [
+        'if cpu.sp > cpu.STACK_LIMIT - cpu.STACK_SIZE:',
+        '    cpu.sp -= 1',
+        'else:',
+        '    seq.mar = {adr} # Seq stops at the microinstruction that overflows',
+        '    raise StackOverflow({cycles})',
+    ],
+}
+
+# conditions that depend on the state of the CPU, not only on IR
+DYNAMIC_COND_CODE = {
+    Cond.INT: 'cpu.intr',
+    Cond.Z: 'cpu.z',
+    Cond.NZ: 'not cpu.z',
+    Cond.S: 'cpu.s',
+    Cond.NS: 'not cpu.s',
+    Cond.V: 'cpu.v',
+    Cond.NV: 'not cpu.v',
+    Cond.C: 'cpu.c',
+    Cond.NC: 'not cpu.c',
+}
+
+IFCH_CODE = [
+    'if not cpu.inCode(cpu.pc):',
+    '    raise ExecEnd() # PC left the code',
+    'cpu.ir = cpu.mem[cpu.pc] & WORD_MASK',
+]
+
+# compiled routines shared by every sequencer: (MPM, opcode, mas, mad) -> routine
+_routineCache = {}
+
+
+class MicroCompiler(object):
+    '''Compiles the path that an instruction takes through the microprogram memory
+    into a single, straight-line, Python function
+
+    Everything that decides the path except the flags and the interrupt request
+    (the group, the addressing modes and the opcode) is known from IR, so for a given
+    (opcode, mas, mad) the MPM can be walked symbolically, from IFCH back to IFCH.
+    The conditions that depend on the CPU state become if statements in the generated code.
+    '''
+    def __init__(self, mpm):
+        '''Init the compiler for a microprogram memory
+
+        Args:
+            mpm - the list of encoded microinstructions, it is read once, when the
+            compiler is created
+        '''
+        self.mpm = list(mpm)
+        self.umpm = predecode(self.mpm)
+        self.mpmKey = tuple(self.mpm)
+
+    def routineFor(self, ir):
+        '''Get the compiled routine executing the given instruction
+
+        Args:
+            ir - the encoded instruction
+
+        Returns:
+            A function routine(seq, cpu, ir) that executes the instruction (starting with its fetch)
+            and returns the number of micro-cycles it took. When the stack overflows, the routine
+            leaves MAR at the overflowing microinstruction, as Seq does, and raises
+            StackOverflow(the number of micro-cycles completed before it)
+
+        Raises:
+            CompileError - if the path through the MPM cannot be flattened (eg: it loops)
+            ValueError - if ir is not a valid instruction
+        '''
+        d = decode(ir)
+        key = (self.mpmKey, d.opcode, d.mas, d.mad)
+        try:
+            return _routineCache[key]
+        except KeyError:
+            pass
+
+        routine = self._compile(ir)
+        _routineCache[key] = routine
+
+        return routine
+
+    def source(self, ir):
+        '''Get the Python source generated for the given instruction, useful when debugging the MPM'''
+        d = decode(ir)
+        lines = ['def routine(seq, cpu, ir):',
+            '    # {} mas={} mad={}'.format(d.opcode.name, d.mas, d.mad)]
+        self._emitPath(0, ir, group=d.group, visited=(), count=0, indent=1, lines=lines)
+
+        return '\n'.join(lines) + '\n'
+
+    def _compile(self, ir):
+        src = self.source(ir)
+        code = compile(src, '<microroutine {}>'.format(decode(ir).opcode.name), 'exec')
+        namespace = {
+            'getRs': getRs,
+            'getRd': getRd,
+            'getBrOffset': getBrOffset,
+            'ExecEnd': ExecEnd,
+            'StackOverflow': StackOverflow,
+            'toWord': toWord,
+            'WORD_MASK': WORD_MASK,
+            'ADDRESS_MASK': ADDRESS_MASK,
+        }
+        exec(code, namespace)
+
+        return namespace['routine']
+
+    def _staticCond(self, cond, ir, group):
+        '''Evaluate a condition that only depends on IR
+
+        Returns: True/False, or None if the condition can only be tested at run time
+        '''
+        if cond in DYNAMIC_COND_CODE:
+            return None
+        elif cond == Cond.NO_OP:
+            return group != Group.ONE_OP and group != Group.TWO_OP
+        elif cond == Cond.ONE_OP:
+            return group == Group.ONE_OP
+        elif cond == Cond.REG_DEST:
+            return AddrMode.DIRECT == AddrMode(getMad(ir))
+
+        return True
+
+    def _emitUInstr(self, adr, count, indent, lines):
+        '''Emit the code of the microinstruction found at adr, the count-th one of the routine'''
+        (sbus, dbus, alu, rbus, misc, mem, cond,
+            address_true, address_false, index_true, index_false) = self.umpm[adr]
+
+        code = ['# {}'.format(adr)]
+        code += SBUS_CODE.get(sbus, ['cpu.sbus = None'])
+        code += DBUS_CODE.get(dbus, ['cpu.dbus = None'])
+
+        if alu in ALU_CODE:
+            code += ['res = ' + ALU_CODE[alu], 'seq.z = res == 0', 'seq.s = res < 0']
+        else:
+            code += ['res = None']
+
+        code += RBUS_CODE.get(rbus, [])
+
+        if mem == Mem.IFCH:
+            if adr != 0:
+                raise CompileError('Instruction fetch outside of IFCH, at {}'.format(adr))
+            code += IFCH_CODE
+        else:
+            code += MEM_CODE.get(mem, [])
+
+        code += [line.format(adr=adr, cycles=count - 1) for line in MISC_CODE.get(misc, [])]
+
+        lines.extend('    ' * indent + line for line in code)
+
+    def _emitPath(self, adr, ir, group, visited, count, indent, lines):
+        '''Emit the code for the path starting at adr, up to the next instruction fetch'''
+        if adr in visited:
+            raise CompileError('The microroutine loops through {}'.format(adr))
+        if adr >= len(self.umpm):
+            raise CompileError('The microroutine jumps outside of the MPM, to {}'.format(adr))
+
+        visited += (adr,)
+        count += 1
+        self._emitUInstr(adr, count, indent, lines)
+
+        u = self.umpm[adr]
+        target_true = u.address_true + irIndexToOffset(u.index_true, ir)
+        target_false = u.address_false + irIndexToOffset(u.index_false, ir)
+
+        taken = self._staticCond(u.cond, ir, group)
+        if taken is None:
+            lines.append('    ' * indent + 'if {}:'.format(DYNAMIC_COND_CODE[u.cond]))
+            self._emitNext(target_true, adr, ir, group, visited, count, indent + 1, lines)
+            lines.append('    ' * indent + 'else:')
+            self._emitNext(target_false, adr, ir, group, visited, count, indent + 1, lines)
+        elif taken:
+            self._emitNext(target_true, adr, ir, group, visited, count, indent, lines)
+        else:
+            self._emitNext(target_false, adr, ir, group, visited, count, indent, lines)
+
+    def _emitNext(self, target, adr, ir, group, visited, count, indent, lines):
+        if target == 0: # back to IFCH, the instruction is done
+            lines.append('    ' * indent + 'seq.mar = 0')
+            lines.append('    ' * indent + 'return {}'.format(count))
+        else:
+            self._emitPath(target, ir, group, visited, count, indent, lines)
+
+
+class CompiledSeq(Seq):
+    '''A sequencer that executes one compiled microroutine per instruction
+
+    The machine state after every instruction is the same as the one Seq leaves,
+    execMicroInstr can still be used to step through the microcode
+    '''
+    def __init__(self, mpm, cpu):
+        super(CompiledSeq, self).__init__(mpm, cpu)
+        self.compiler = MicroCompiler(mpm)
+        self.routines = {} # IR -> routine
+        self._ownTables = self._tables()
+
+    def _tables(self):
+        return (self.sbusTable, self.dbusTable, self.aluTable, self.rbusTable, self.memTable,
+            self.miscTable, self.condTable)
+
+    def _hooked(self):
+        '''Check if an observer (eg: Breakpoints, Tracer, ExecStats) replaced execMicroInstr or a dispatch
+        table, the compiled routines would bypass its hooks'''
+        return 'execMicroInstr' in vars(self) or any(table is not own
+            for (table, own) in zip(self._tables(), self._ownTables))
+
+    def _interpret(self, seq, cpu, ir):
+        '''Fallback for the instructions that cannot be compiled: step through their microcode'''
+        self.execMicroInstr()
+        count = 1
+        while self.mar != 0:
+            self.execMicroInstr()
+            count += 1
+
+        return count
+
+    def _routine(self, ir):
+        try:
+            routine = self.compiler.routineFor(ir)
+        except (CompileError, ValueError):
+            routine = self._interpret
+
+        self.routines[ir] = routine
+
+        return routine
+
+    def execInstr(self):
+        '''Execute the rest of the current instruction, or a whole one if none is in progress
+
+        Returns:
+            The number of micro-cycles executed
+        '''
+        if self.mar != 0:
+            return self._interpret(self, self.cpu, self.cpu.ir)
+
+        cpu = self.cpu
+        if not cpu.inCode(cpu.pc):
+            return self._interpret(self, cpu, None) # IFCH ends the execution
+        ir = cpu.mem[cpu.pc] & WORD_MASK
+
+        try:
+            routine = self.routines[ir]
+        except KeyError:
+            routine = self._routine(ir)
+
+        return routine(self, cpu, ir)
+
+    def run(self, maxCycles=None, maxInstrs=None, stopAt=(), stopOnHalt=True, predicates=()):
+        '''Same as Seq.run, but the compiled instructions are executed at once
+
+        The instructions without a compiled routine are still executed one microinstruction
+        at a time, so maxCycles can only be exceeded by the cycles of a compiled routine.
+        While an observer is hooked in the sequencer (see _hooked), every instruction is executed
+        one microinstruction at a time, as by Seq.run.
+        '''
+        stopAt = frozenset(stopAt)
+        predicates = tuple(predicates)
+        cpu = self.cpu
+        routines = self.routines
+        interpret = self._interpret
+        execMicroInstr = self.execMicroInstr
+        compiled = not self._hooked()
+
+        cycles = 0
+        instructions = 0
+        reason = None
+        start = time.perf_counter()
+        try:
+            while True:
+                if self.mar == 0:
+                    reason = self._boundaryStop(cycles == 0, instructions, maxInstrs,
+                        stopAt, stopOnHalt, predicates)
+                    if reason is not None:
+                        break
+
+                if maxCycles is not None and cycles >= maxCycles:
+                    reason = StopReason.CYCLE_LIMIT
+                    break
+
+                if self.mar == 0 and compiled:
+                    # _boundaryStop made sure that PC points inside the code
+                    ir = cpu.mem[cpu.pc] & WORD_MASK
+                    try:
+                        routine = routines[ir]
+                    except KeyError:
+                        routine = self._routine(ir)
+
+                    if routine != interpret:
+                        cycles += routine(self, cpu, ir)
+                        instructions += 1
+                        continue
+
+                execMicroInstr()
+                cycles += 1
+                if self.mar == 0:
+                    instructions += 1
+        except Breakpoint as e:
+            # the micro-cycle was completed
+            cycles += 1
+            if self.mar == 0:
+                instructions += 1
+            reason = e.args[0]
+        except ExecEnd:
+            reason = StopReason.END
+        except StackOverflow as e:
+            # a compiled routine passes the micro-cycles it completed
+            cycles += e.args[0] if e.args else 0
+            reason = StopReason.STACK_OVERFLOW
+        except IndexError:
+            reason = self._indexErrorReason()
+        except ValueError: # IR does not hold a valid instruction
+            reason = StopReason.INVALID_INSTRUCTION
+
+        return RunResult(reason, cycles, instructions, time.perf_counter() - start)
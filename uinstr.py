@@ -1,4 +1,4 @@
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
 from enum import unique, IntEnum
 
@@ -155,6 +155,18 @@ def build_uinstr(sbus=SBus.NONE, dbus=DBus.NONE, alu=Alu.NONE, rbus=RBus.NONE,
         | index_true << IT_RIGHTPAD | index_false
 
 
+DBUS_MASK = size_to_bitmask(DBUS_SIZE)
+RBUS_MASK = size_to_bitmask(RBUS_SIZE)
+MISC_MASK = size_to_bitmask(MISC_SIZE)
+MEM_MASK = size_to_bitmask(MEM_SIZE)
+ALU_MASK = size_to_bitmask(ALU_SIZE)
+COND_MASK = size_to_bitmask(COND_SIZE)
+AF_MASK = size_to_bitmask(ADDRESS_FALSE_SIZE)
+AT_MASK = size_to_bitmask(ADDRESS_TRUE_SIZE)
+IF_MASK = size_to_bitmask(INDEX_FALSE_SIZE)
+IT_MASK = size_to_bitmask(INDEX_TRUE_SIZE)
+
+
 def getSBus(mir):
     '''Get the SBus field of the micro instruction'''
     return SBus(mir >> SBUS_RIGHTPAD)
@@ -162,51 +174,86 @@ def getSBus(mir):
 
 def getDBus(mir):
     '''Get the DBus field of the micro instruction'''
-    return DBus((mir >> DBUS_RIGHTPAD) & size_to_bitmask(DBUS_SIZE))
+    return DBus((mir >> DBUS_RIGHTPAD) & DBUS_MASK)
 
 
 def getRBus(mir):
     '''Get the RBus field of the micro instruction'''
-    return RBus((mir >> RBUS_RIGHTPAD) & size_to_bitmask(RBUS_SIZE))
+    return RBus((mir >> RBUS_RIGHTPAD) & RBUS_MASK)
 
 
 def getMisc(mir):
     '''Get the Misc field of the micro instruction'''
-    return Misc((mir >> MISC_RIGHTPAD) & size_to_bitmask(MISC_SIZE))
+    return Misc((mir >> MISC_RIGHTPAD) & MISC_MASK)
 
 
 def getMem(mir):
     '''Get the Mem field of the micro instruction'''
-    return Mem((mir >> MEM_RIGHTPAD) & size_to_bitmask(MEM_SIZE))
+    return Mem((mir >> MEM_RIGHTPAD) & MEM_MASK)
 
 
 def getAlu(mir):
     '''Get the Alu field of the micro instruction'''
-    return Alu((mir >> ALU_RIGHTPAD) & size_to_bitmask(ALU_SIZE))
+    return Alu((mir >> ALU_RIGHTPAD) & ALU_MASK)
 
 
 def getCond(mir):
     '''Get the Cond field of the micro instruction'''
-    return Cond((mir >> COND_RIGHTPAD) & size_to_bitmask(COND_SIZE))
+    return Cond((mir >> COND_RIGHTPAD) & COND_MASK)
 
 
 def getAddressFalse(mir):
     '''Get the Address False field of the micro instruction'''
-    return (mir >> AF_RIGHTPAD) & size_to_bitmask(ADDRESS_FALSE_SIZE)
+    return (mir >> AF_RIGHTPAD) & AF_MASK
 
 
 def getIndexFalse(mir):
     '''Get the Index False field of the micro instruction'''
-    return Index(mir & size_to_bitmask(INDEX_FALSE_SIZE))
+    return Index(mir & IF_MASK)
 
 
 def getAddressTrue(mir):
     '''Get the Address True field of the micro instruction'''
-    return (mir >> AT_RIGHTPAD) & size_to_bitmask(ADDRESS_TRUE_SIZE)
+    return (mir >> AT_RIGHTPAD) & AT_MASK
 
 def getIndexTrue(mir):
     '''Get the Index True field of the micro instruction'''
-    return Index((mir >> IT_RIGHTPAD) & size_to_bitmask(INDEX_TRUE_SIZE))
+    return Index((mir >> IT_RIGHTPAD) & IT_MASK)
+
+
+# A microinstruction with all of its fields already extracted
+UInstr = namedtuple('UInstr', ['sbus', 'dbus', 'alu', 'rbus', 'misc', 'mem', 'cond',
+    'address_true', 'address_false', 'index_true', 'index_false'])
+
+
+def decode_uinstr(mir):
+    '''Split a microinstruction into its components, this is the inverse of build_uinstr
+
+    Args:
+        mir - the encoded microinstruction
+
+    Returns:
+        An UInstr holding the decoded fields
+    '''
+    return UInstr(getSBus(mir), getDBus(mir), getAlu(mir), getRBus(mir), getMisc(mir),
+        getMem(mir), getCond(mir), getAddressTrue(mir), getAddressFalse(mir),
+        getIndexTrue(mir), getIndexFalse(mir))
+
+
+def predecode(mpm):
+    '''Decode the whole microprogram memory (MPM) ahead of time
+
+    The MPM doesn't change while the sequencer runs, so every microinstruction
+    can be split into its fields just once, when the MPM is loaded
+
+    Args:
+        mpm - the list of encoded microinstructions
+
+    Returns:
+        A list of UInstr, the element at position i is the decoded mpm[i]
+    '''
+    return [decode_uinstr(mir) for mir in mpm]
+
 
 def lbl2adr(mem, lbl):
     '''Get the address of a microinstruction in the microprogram memory (MPM)
@@ -522,4 +569,23 @@ MPM = [
     build_uinstr(SBus.ZERO, DBus.MDR, Alu.SUM, RBus.PC, Misc.INC_SP, Mem.NONE, Cond.INT, 10, 0),
 
     #TODO: continue here
-]
\ No newline at end of file
+]
+# the address of every microroutine in the MPM, the instruction microroutines are named after their OpCode
+MPM_LABELS = OrderedDict([
+    ('IFCH', 0), ('IFCH1', 1),
+    ('IMMS', 2), ('DS', 4), ('IS', 6), ('XS', 8),
+    ('IMMD', 11), ('DD', 13), ('ID', 15), ('XD', 17),
+    ('WRITE_MEM', 19), ('INT', 20),
+    ('MOV', 27), ('ADD', 29), ('SUB', 31), ('CMP', 33), ('AND', 35), ('OR', 37), ('XOR', 39),
+    ('CLR', 41), ('NEG', 43), ('INC', 45), ('DEC', 47), ('ASL', 49), ('ASR', 51), ('LSR', 53),
+    ('ROL', 55), ('ROR', 57), ('RLC', 59), ('RRC', 61), ('JMP', 63), ('CALL', 65), ('PUSH', 69),
+    ('POP', 71),
+    ('BR', 73), ('BNE', 75), ('BEQ', 77), ('BPL', 79), ('BMI', 81), ('BCS', 83), ('BCC', 85),
+    ('BVS', 87), ('BVC', 89),
+    ('CLC', 91), ('CLV', 93), ('CLZ', 95), ('CLS', 97), ('CCC', 99), ('SEC', 101), ('SEV', 103),
+    ('SEZ', 105), ('SES', 107), ('SCC', 109), ('NOP', 111), ('RET', 113),
+])
+
+# the operand fetch microroutines, in AddrMode order
+SRC_FETCH_LABELS = ['IMMS', 'DS', 'IS', 'XS']
+DST_FETCH_LABELS = ['IMMD', 'DD', 'ID', 'XD']
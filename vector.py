@@ -0,0 +1,457 @@
+from uinstr import *
+from instr import OpCode, Group, AddrMode
+from seq import INDEX_TABLE, StopReason, RunResult, WORD_MASK, buildNoMicroroutineTable
+from memory import ADDRESS_MASK, PAGE_BITS, PAGE_SIZE, PAGE_COUNT, OFFSET_MASK
+
+from array import array
+import numpy as np
+import time
+
+# the order of the reasons in VecSeq.reason, -1 means the lane is still running
+REASONS = list(StopReason)
+RUNNING = -1
+
+def wrap(values):
+    '''Wrap an array of numbers to 16 bit two's complement words, see seq.toWord'''
+    return ((values + 0x8000) & WORD_MASK) - 0x8000
+
+
+def buildGroupTable():
+    '''Get the Group of every possible IR, as getOpcodeGroup(getOpcode(ir)) would
+
+    Returns:
+        An array of 2 ** 16 group values, indexed by IR, -1 for the words that are not instructions
+    '''
+    ir = np.arange(2 ** 16, dtype=np.int64)
+    other = (ir & Group.OTHER) == Group.OTHER
+    branch = ~other & (((ir >> 8) & Group.BRANCH) == Group.BRANCH)
+    oneOp = ~other & ~branch & (((ir >> 6) & Group.ONE_OP) == Group.ONE_OP)
+    twoOp = ~other & ~branch & ~oneOp
+
+    opcode = np.select([other, branch, oneOp], [ir, ir >> 8, ir >> 6], ir >> 12)
+    groups = np.select([other, branch, oneOp], [Group.OTHER, Group.BRANCH, Group.ONE_OP], Group.TWO_OP)
+    valid = np.isin(opcode, [op.value for op in OpCode])
+
+    return np.where(valid, groups, -1)
+
+_groupTable = None
+
+def groupTable():
+    '''Get the (lazily built) table of buildGroupTable'''
+    global _groupTable
+    if _groupTable is None:
+        _groupTable = buildGroupTable()
+
+    return _groupTable
+
+
+class VecSeq(object):
+    '''Runs many copies of the CPU in lockstep, one micro-cycle at a time
+
+    The state of the CPUs is kept as a structure of NumPy arrays: one element (or row, for
+    the registers and the memory) per CPU, called a lane. Every micro-cycle the running lanes
+    are grouped by their MPM address, and each microinstruction is executed for its whole group
+    with array operations, so lanes whose conditions diverged only cost an extra group.
+
+    The memory rows only hold the pages that are mapped: the pages allocated in any of the CPUs
+    and the ones accessed since, pageIndex gives the place of every page in the rows (-1 if the
+    page is not mapped, ie: it holds only zeros in every lane).
+
+    A lane stops for the same reasons Seq.run stops (the program ended, it faulted, etc.),
+    the other lanes go on. The results are the same as running every CPU through Seq.run.
+    '''
+    def __init__(self, mpm, cpus):
+        '''Load the state of the given CPUs
+
+        Args:
+            mpm - the microprogram memory
+            cpus - list of Cpu, their code and stack must be at the same addresses
+
+        Raises:
+            ValueError - if the CPUs cannot be run together
+        '''
+        if not cpus:
+            raise ValueError('There are no CPUs to run')
+        if len(set((cpu.code, cpu.STACK_SIZE, cpu.STACK_LIMIT) for cpu in cpus)) != 1:
+            raise ValueError('All the CPUs must have the same code and stack addresses')
+
+        self.mpm = mpm
+        self.umpm = predecode(mpm)
+        self.cpus = cpus
+        self.n = len(cpus)
+        self.STACK_SIZE = cpus[0].STACK_SIZE
+        self.STACK_LIMIT = cpus[0].STACK_LIMIT
+        self.codeStart = np.array([start for (start, end) in cpus[0].code], dtype=np.int64)
+        self.codeEnd = np.array([end for (start, end) in cpus[0].code], dtype=np.int64)
+
+        self.indexTable = np.array([np.frombuffer(offsets, dtype=np.int16) for offsets in INDEX_TABLE],
+            dtype=np.int64)
+        self.groups = groupTable()
+        self.noMicroroutine = np.frombuffer(buildNoMicroroutineTable(mpm, MPM_LABELS), dtype=np.uint8) != 0
+
+        def lanes(name, dtype=np.int64):
+            return np.array([getattr(cpu, name) for cpu in cpus], dtype=dtype)
+
+        allocated = [cpu.mem.allocated() for cpu in cpus]
+        pages = sorted(set(page for lane in allocated for page in lane))
+        self.pageIndex = np.full(PAGE_COUNT, -1, dtype=np.int64)
+        self.pageIndex[pages] = np.arange(len(pages))
+        self._allocatedSlots = [self.pageIndex[lane].tolist() for lane in allocated] # sync overwrites them
+        self.mem = np.zeros((self.n, len(pages) * PAGE_SIZE), dtype=np.int64)
+        for (i, cpu) in enumerate(cpus):
+            for (slot, page) in enumerate(pages):
+                self.mem[i, slot * PAGE_SIZE:(slot + 1) * PAGE_SIZE] = np.frombuffer(cpu.mem.pages[page],
+                    dtype=np.int16)
+        self.r = np.array([cpu.r for cpu in cpus], dtype=np.int64)
+        for name in ('pc', 'sp', 'ir', 'adr', 'mdr', 't', 'rIndex', 'sbus', 'dbus'):
+            setattr(self, name, lanes(name))
+        for name in ('z', 'c', 'v', 's', 'intr'):
+            setattr(self, name, lanes(name, np.bool_))
+
+        # the flags computed by the ALU, applied by Misc.COND, see Seq
+        self.seqZ = np.zeros(self.n, dtype=np.bool_)
+        self.seqS = np.zeros(self.n, dtype=np.bool_)
+        self.seqC = np.zeros(self.n, dtype=np.bool_)
+        self.seqV = np.zeros(self.n, dtype=np.bool_)
+
+        self.mar = np.zeros(self.n, dtype=np.int64)
+        self.reason = np.full(self.n, RUNNING, dtype=np.int64) # index in REASONS
+        self.cycles = np.zeros(self.n, dtype=np.int64)
+        self.instructions = np.zeros(self.n, dtype=np.int64)
+        self.elapsed = 0.0
+
+    def _stop(self, idx, reason):
+        self.reason[idx] = REASONS.index(reason)
+
+    def _drop(self, idx, mask, reason):
+        '''Stop the lanes of idx selected by mask
+
+        Returns:
+            The other lanes
+        '''
+        if not mask.any():
+            return idx
+
+        self._stop(idx[mask], reason)
+        return idx[~mask]
+
+    def _boundary(self, idx, stopOnHalt):
+        '''Stop the lanes that should not fetch another instruction
+
+        Returns:
+            The lanes that go on
+        '''
+        idx = self._dropEnded(idx)
+
+        if idx.size:
+            # the same order as Seq._boundaryStop
+            cols = self._columns(self.pc[idx])
+            word = self.mem[idx, cols] & WORD_MASK
+            invalid = self.noMicroroutine[word]
+            halted = stopOnHalt & (word == OpCode.HALT)
+            waiting = stopOnHalt & (word == OpCode.WAIT)
+            stopped = invalid | halted | waiting
+            if stopped.any():
+                self._stop(idx[invalid], StopReason.INVALID_INSTRUCTION)
+                self._stop(idx[halted], StopReason.HALT)
+                self._stop(idx[waiting], StopReason.WAIT)
+                idx = idx[~stopped]
+
+        return idx
+
+    def _dropEnded(self, idx):
+        '''Stop the lanes whose PC is outside of the code, as the instruction fetch would
+
+        Returns:
+            The other lanes
+        '''
+        pc = self.pc[idx][:, None]
+        ended = ~((pc >= self.codeStart) & (pc < self.codeEnd)).any(axis=1)
+
+        return self._drop(idx, ended, StopReason.END)
+
+    def _columns(self, adr):
+        '''Get the columns of the memory rows that hold the given addresses (they wrap around, as in
+        Memory), the pages that are not mapped yet are mapped first
+
+        Mapping a page replaces self.mem, so it must be read only after the columns are known.
+        '''
+        adr = adr & ADDRESS_MASK
+        page = adr >> PAGE_BITS
+        slot = self.pageIndex[page]
+        if (slot < 0).any():
+            missing = np.unique(page[slot < 0])
+            self.pageIndex[missing] = np.arange(missing.size) + self.mem.shape[1] // PAGE_SIZE
+            self.mem = np.concatenate([self.mem,
+                np.zeros((self.n, missing.size * PAGE_SIZE), dtype=np.int64)], axis=1)
+            slot = self.pageIndex[page]
+
+        return (slot << PAGE_BITS) | (adr & OFFSET_MASK)
+
+    def _execUInstr(self, adr, idx):
+        '''Execute the microinstruction found at adr for the given lanes
+
+        Returns:
+            The lanes that executed it completely
+        '''
+        (sbus, dbus, alu, rbus, misc, mem, cond,
+            address_true, address_false, index_true, index_false) = self.umpm[adr]
+        ir = self.ir[idx]
+
+        if sbus == SBus.NONE or sbus == SBus.ZERO:
+            value = 0
+        elif sbus == SBus.REG:
+            self.rIndex[idx] = (ir >> 6) & 0b1111
+            value = self.r[idx, self.rIndex[idx]]
+        elif sbus == SBus.T:
+            value = self.t[idx]
+        elif sbus == SBus.MDR:
+            value = self.mdr[idx]
+        elif sbus == SBus.IR_OFFSET:
+            value = (ir & 0xFF) - self.pc[idx]
+        elif sbus == SBus.MINUS_ONE:
+            value = -1
+        elif sbus == SBus.ONE:
+            value = 1
+        else:
+            self._stop(idx, StopReason.INVALID_INSTRUCTION)
+            return idx[:0]
+        self.sbus[idx] = value
+
+        if dbus == DBus.NONE or dbus == DBus.ZERO:
+            value = 0
+        elif dbus == DBus.PC:
+            value = self.pc[idx]
+        elif dbus == DBus.REG:
+            self.rIndex[idx] = ir & 0b1111
+            value = self.r[idx, self.rIndex[idx]]
+        elif dbus == DBus.MDR:
+            value = self.mdr[idx]
+        elif dbus == DBus.NOT_MDR:
+            value = ~self.mdr[idx]
+        elif dbus == DBus.T:
+            value = self.t[idx]
+        elif dbus == DBus.SP:
+            value = self.sp[idx]
+        else:
+            self._stop(idx, StopReason.INVALID_INSTRUCTION)
+            return idx[:0]
+        self.dbus[idx] = value
+
+        s = self.sbus[idx]
+        d = self.dbus[idx]
+        res = None
+        if alu == Alu.SUM:
+            res = s + d
+        elif alu == Alu.SUB:
+            res = s - d
+        elif alu == Alu.AND:
+            res = s & d
+        elif alu == Alu.OR:
+            res = s | d
+        elif alu == Alu.XOR:
+            res = s ^ d
+        elif alu == Alu.ASL:
+            res = d << 1
+        elif alu == Alu.ASR:
+            res = d >> 1
+
+        if res is not None:
+            self.seqZ[idx] = res == 0
+            self.seqS[idx] = res < 0
+
+            if rbus == RBus.ADR:
+                self.adr[idx] = res
+            elif rbus == RBus.T:
+                self.t[idx] = res
+            elif rbus == RBus.MDR:
+                self.mdr[idx] = res
+            elif rbus == RBus.REG:
+                self.r[idx, self.rIndex[idx]] = wrap(res)
+            elif rbus == RBus.PC:
+                self.pc[idx] = res & ADDRESS_MASK
+        elif rbus in (RBus.ADR, RBus.T, RBus.MDR, RBus.REG, RBus.PC):
+            # Seq would store None
+            self._stop(idx, StopReason.INVALID_INSTRUCTION)
+            return idx[:0]
+
+        if mem == Mem.IFCH:
+            idx = self._dropEnded(idx)
+            cols = self._columns(self.pc[idx])
+            self.ir[idx] = self.mem[idx, cols] & WORD_MASK
+        elif mem == Mem.READ:
+            cols = self._columns(self.adr[idx])
+            self.mdr[idx] = self.mem[idx, cols]
+        elif mem == Mem.WRITE:
+            cols = self._columns(self.adr[idx])
+            self.mem[idx, cols] = wrap(self.mdr[idx])
+
+        if misc == Misc.INC_PC:
+            self.pc[idx] = (self.pc[idx] + 1) & ADDRESS_MASK
+        elif misc == Misc.COND:
+            self.z[idx] = self.seqZ[idx]
+            self.c[idx] = self.seqC[idx]
+            self.v[idx] = self.seqV[idx]
+            self.s[idx] = self.seqS[idx]
+        elif misc == Misc.SET_C:
+            self.c[idx] = True
+        elif misc == Misc.SET_V:
+            self.v[idx] = True
+        elif misc == Misc.SET_Z:
+            self.z[idx] = True
+        elif misc == Misc.SET_S:
+            self.s[idx] = True
+        elif misc == Misc.CLEAR_C:
+            self.c[idx] = False
+        elif misc == Misc.CLEAR_V:
+            self.v[idx] = False
+        elif misc == Misc.CLEAR_Z:
+            self.z[idx] = False
+        elif misc == Misc.CLEAR_S:
+            self.s[idx] = False
+        elif misc == Misc.SET_FLAG or misc == Misc.CLEAR_FLAG:
+            value = misc == Misc.SET_FLAG
+            self.c[idx] = value
+            self.v[idx] = value
+            self.s[idx] = value
+            self.z[idx] = value
+        elif misc == Misc.INC_SP:
+            self.sp[idx] += 1
+        elif misc == Misc.DEC_SP:
+            overflow = self.sp[idx] <= self.STACK_LIMIT - self.STACK_SIZE
+            idx = self._drop(idx, overflow, StopReason.STACK_OVERFLOW)
+            self.sp[idx] -= 1
+
+        ir = self.ir[idx]
+        if cond in (Cond.NO_OP, Cond.ONE_OP):
+            group = self.groups[ir]
+            invalid = group < 0
+            if invalid.any():
+                self._stop(idx[invalid], StopReason.INVALID_INSTRUCTION)
+                (idx, ir, group) = (idx[~invalid], ir[~invalid], group[~invalid])
+            if cond == Cond.NO_OP:
+                taken = (group != Group.ONE_OP) & (group != Group.TWO_OP)
+            else:
+                taken = group == Group.ONE_OP
+        elif cond == Cond.REG_DEST:
+            taken = ((ir >> 4) & 0b11) == AddrMode.DIRECT
+        elif cond == Cond.INT:
+            taken = self.intr[idx]
+        elif cond in (Cond.Z, Cond.NZ):
+            taken = self.z[idx] == (cond == Cond.Z)
+        elif cond in (Cond.S, Cond.NS):
+            taken = self.s[idx] == (cond == Cond.S)
+        elif cond in (Cond.V, Cond.NV):
+            taken = self.v[idx] == (cond == Cond.V)
+        elif cond in (Cond.C, Cond.NC):
+            taken = self.c[idx] == (cond == Cond.C)
+        else:
+            taken = np.ones(idx.size, dtype=np.bool_)
+
+        # the addresses in the MPM are absolute
+        self.mar[idx] = np.where(taken,
+            address_true + self.indexTable[index_true][ir],
+            address_false + self.indexTable[index_false][ir])
+
+        return idx
+
+    def step(self, stopOnHalt=True):
+        '''Execute a micro-cycle on every running lane
+
+        Args:
+            stopOnHalt - stop the lanes that are about to execute HALT or WAIT, see Seq.run
+
+        Returns:
+            The number of lanes that executed the micro-cycle
+        '''
+        running = np.flatnonzero(self.reason == RUNNING)
+        if not running.size:
+            return 0
+
+        executed = 0
+        for (adr, idx) in self._groupByMar(running):
+            if adr >= len(self.umpm):
+                self._stop(idx, StopReason.INVALID_INSTRUCTION)
+                continue
+            if adr == 0:
+                idx = self._boundary(idx, stopOnHalt)
+                if not idx.size:
+                    continue
+
+            idx = self._execUInstr(int(adr), idx)
+            self.cycles[idx] += 1
+            self.instructions[idx] += self.mar[idx] == 0
+            executed += idx.size
+
+        return executed
+
+    def _groupByMar(self, lanes):
+        '''Split the lanes by their MPM address
+
+        Returns:
+            A list of (MPM address, lanes at that address)
+        '''
+        mars = self.mar[lanes]
+        first = mars[0]
+        if (mars == first).all(): # the usual case, the lanes did not diverge
+            return [(first, lanes)]
+
+        order = np.argsort(mars, kind='stable')
+        mars = mars[order]
+        cuts = np.flatnonzero(mars[1:] != mars[:-1]) + 1
+
+        return zip(mars[np.r_[0, cuts]], np.split(lanes[order], cuts))
+
+    def run(self, maxCycles=None, stopOnHalt=True):
+        '''Run until every lane stopped or maxCycles micro-cycles were executed
+
+        The lanes left running can be resumed by calling run again.
+
+        Returns:
+            The number of lanes still running
+        '''
+        start = time.perf_counter()
+        cycles = 0
+        while maxCycles is None or cycles < maxCycles:
+            if not self.step(stopOnHalt):
+                break
+            cycles += 1
+        self.elapsed += time.perf_counter() - start
+
+        return int(np.count_nonzero(self.reason == RUNNING))
+
+    def results(self):
+        '''Get the RunResult of every lane
+
+        The lanes still running are reported as stopped by the cycle limit,
+        the elapsed time is the one of the whole run.
+        '''
+        return [RunResult(StopReason.CYCLE_LIMIT if reason == RUNNING else REASONS[reason],
+            int(cycles), int(instructions), self.elapsed)
+            for (reason, cycles, instructions) in zip(self.reason, self.cycles, self.instructions)]
+
+    def sync(self):
+        '''Copy the state of the lanes back to the Cpu objects they were loaded from
+
+        Only the pages a lane holds data in, or that were allocated in its Cpu, are written, so the
+        Cpu objects must not be changed between the load (VecSeq()) and sync.
+        '''
+        pages = np.flatnonzero(self.pageIndex >= 0)
+        pageOf = dict(zip(self.pageIndex[pages].tolist(), pages.tolist()))
+        mem = self.mem.reshape(self.n, -1, PAGE_SIZE)
+        # most mapped pages stay zero in most lanes (eg: the stack of a lane that made fewer calls), only
+        # the pages holding data, or allocated in the Cpu (their old data must be cleared), are copied
+        used = mem.any(axis=2)
+        r = self.r.astype(np.int16)
+        words = {name: getattr(self, name).tolist() for name in ('pc', 'sp', 'ir', 'adr', 'mdr', 't', 'rIndex',
+            'sbus', 'dbus')}
+        flags = {name: getattr(self, name).astype(bool).tolist() for name in ('z', 'c', 'v', 's', 'intr')}
+
+        for (i, cpu) in enumerate(self.cpus):
+            for slot in set(np.flatnonzero(used[i]).tolist()).union(self._allocatedSlots[i]):
+                cpu.mem.load(array('h', mem[i, slot].astype(np.int16).tobytes()), pageOf[slot] << PAGE_BITS)
+            cpu.r[:] = array('h', r[i].tobytes())
+            for (name, values) in words.items():
+                setattr(cpu, name, values[i])
+            for (name, values) in flags.items():
+                setattr(cpu, name, values[i])